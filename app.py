@@ -5,10 +5,6 @@ from flask_migrate import Migrate
 from extensions import db
 from modules.shared.services.secrets import SecretsDBService
 
-from modules.flashcard.service import FlashcardService
-
-# from modules.flashcard.service import FlashcardService
-
 
 app = Flask(__name__)
 CORS(app)
@@ -21,14 +17,23 @@ app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 db.init_app(app)
 migrate = Migrate(app, db)
 
+from modules.chatbot.message_buffer import message_buffer, write_behind_enabled
+
+if write_behind_enabled():
+    message_buffer.init_app(app)
+
 # Import and register routes
 from modules.document import routes as document_routes
 from modules.chatbot import routes as chatbot_routes
 from modules.course import routes as course_routes
+from modules.flashcard import routes as flashcard_routes
+from modules.shared.services.bedrock_scheduler import bedrock_scheduler
+from modules.shared.services.prompt_cache import prompt_cache_stats
 
 document_routes.register_document_routes(app)
 chatbot_routes.register_chatbot_routes(app)
 course_routes.register_course_routes(app)
+flashcard_routes.register_flashcard_routes(app)
 
 
 @app.route("/health", methods=["GET"])
@@ -36,24 +41,15 @@ def healthcheck():
     return jsonify(status="ok"), 200
 
 
-# ############################
-flashcard_service = FlashcardService()
-from extensions import get_logger
-
-logger = get_logger("[FlashcardAPI]")
-
-
-@app.route("/flashcards", methods=["GET"])
-def get_flashcards():
-    try:
-        flashcards = flashcard_service.generate_flashcard(5, "en")
-        return jsonify({"flashcards": flashcards}), 200
-    except Exception as e:
-        logger.error(f"Error retrieving flashcards: {str(e)}")
-        return jsonify({"error": "Internal Server Error"}), 500
-
+@app.route("/metrics/bedrock", methods=["GET"])
+def bedrock_metrics():
+    return (
+        jsonify(
+            {**bedrock_scheduler.metrics(), "prompt_cache": prompt_cache_stats.snapshot()}
+        ),
+        200,
+    )
 
-# ########################
 
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=5000, debug=True)
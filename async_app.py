@@ -0,0 +1,55 @@
+"""
+Event-loop server of the chat endpoints.
+
+Serves /send_message and /send_message_stream with the async chatbot
+handlers, so a single process can hold hundreds of concurrent answer
+streams; every other endpoint stays on the Flask app. Route the two chat
+paths to this server, for example:
+
+    python async_app.py                # port ASYNC_PORT, 5001 by default
+"""
+
+import os
+
+from aiohttp import web
+
+from app import app
+from modules.chatbot.async_routes import register_chatbot_async_routes
+from modules.chatbot.services import async_bedrock
+
+
+@web.middleware
+async def cors_middleware(request, handler):
+    # Same policy as CORS(app): any origin
+    if request.method == "OPTIONS":
+        response = web.Response()
+    else:
+        response = await handler(request)
+    response.headers["Access-Control-Allow-Origin"] = "*"
+    if request.method == "OPTIONS":
+        response.headers["Access-Control-Allow-Methods"] = "GET, POST, OPTIONS"
+        response.headers["Access-Control-Allow-Headers"] = request.headers.get(
+            "Access-Control-Request-Headers", "*"
+        )
+    return response
+
+
+async def healthcheck(request):
+    return web.json_response({"status": "ok"})
+
+
+async def close_bedrock(web_app):
+    await async_bedrock.close()
+
+
+def create_async_app(flask_app=app):
+    web_app = web.Application(middlewares=[cors_middleware])
+    web_app["flask_app"] = flask_app
+    register_chatbot_async_routes(web_app)
+    web_app.router.add_get("/health", healthcheck)
+    web_app.on_cleanup.append(close_bedrock)
+    return web_app
+
+
+if __name__ == "__main__":
+    web.run_app(create_async_app(), port=int(os.getenv("ASYNC_PORT", "5001")))
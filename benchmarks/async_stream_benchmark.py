@@ -0,0 +1,153 @@
+"""
+Concurrent answer streams through the thread-per-stream BedrockService versus
+AsyncBedrockService on one event loop, against the local Bedrock stub.
+
+Run from the repository root:
+
+    python -m benchmarks.async_stream_benchmark --streams 300
+
+Reports time to first token, total stream time, wall time and the peak
+number of threads of each mode. Both modes get a scheduler lane and a
+connection pool as wide as --streams, so only the I/O model differs.
+"""
+
+import argparse
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from aiohttp import web
+
+from benchmarks.bedrock_stub import BedrockStub
+
+MODEL_ID = "anthropic.claude-3-5-sonnet-20240620-v1:0"
+PROMPT = "Explain the shared responsibility model in two paragraphs."
+
+
+class ThreadPeak:
+    def __init__(self):
+        self.peak = threading.active_count()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(0.01):
+            self.peak = max(self.peak, threading.active_count())
+
+
+def serve_stub(stub, port):
+    loop = asyncio.new_event_loop()
+    runner = web.AppRunner(stub.app())
+    loop.run_until_complete(runner.setup())
+    loop.run_until_complete(web.TCPSite(runner, "127.0.0.1", port).start())
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+
+
+def summary(name, first_token, totals, wall, threads):
+    first_ms = np.asarray(first_token) * 1000
+    total_ms = np.asarray(totals) * 1000
+    print(
+        f"{name:>6}: first token p50 {np.percentile(first_ms, 50):.0f}ms "
+        f"p95 {np.percentile(first_ms, 95):.0f}ms  "
+        f"stream p50 {np.percentile(total_ms, 50):.0f}ms "
+        f"p95 {np.percentile(total_ms, 95):.0f}ms  "
+        f"wall {wall:.2f}s  peak threads {threads}"
+    )
+
+
+def run_sync(streams):
+    import boto3
+    from botocore.config import Config
+
+    from modules.shared.services.bedrock import (
+        BEDROCK_ENDPOINT_URL,
+        BEDROCK_REGION,
+        BedrockService,
+    )
+    from modules.shared.services.bedrock_scheduler import INTERACTIVE
+
+    service = BedrockService(priority=INTERACTIVE)
+    service.client = boto3.client(
+        "bedrock-runtime",
+        region_name=BEDROCK_REGION,
+        endpoint_url=BEDROCK_ENDPOINT_URL,
+        config=Config(max_pool_connections=streams),
+    )
+
+    def one_stream():
+        started = time.perf_counter()
+        first = None
+        for _ in service.stream_text(PROMPT, MODEL_ID, max_tokens=1024):
+            if first is None:
+                first = time.perf_counter() - started
+        return first, time.perf_counter() - started
+
+    with ThreadPeak() as threads, ThreadPoolExecutor(max_workers=streams) as pool:
+        started = time.perf_counter()
+        results = list(pool.map(lambda _: one_stream(), range(streams)))
+        wall = time.perf_counter() - started
+    summary("sync", *zip(*results), wall, threads.peak)
+
+
+async def run_async(streams):
+    from modules.shared.services.bedrock_async import AsyncBedrockService
+    from modules.shared.services.bedrock_scheduler import INTERACTIVE
+
+    service = AsyncBedrockService(priority=INTERACTIVE)
+
+    async def one_stream():
+        started = time.perf_counter()
+        first = None
+        async for _ in service.stream_text(PROMPT, MODEL_ID, max_tokens=1024):
+            if first is None:
+                first = time.perf_counter() - started
+        return first, time.perf_counter() - started
+
+    with ThreadPeak() as threads:
+        started = time.perf_counter()
+        results = await asyncio.gather(*(one_stream() for _ in range(streams)))
+        wall = time.perf_counter() - started
+    await service.close()
+    summary("async", *zip(*results), wall, threads.peak)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--streams", type=int, default=200)
+    parser.add_argument("--port", type=int, default=8555)
+    parser.add_argument("--latency", type=float, default=0.5)
+    parser.add_argument("--chunks", type=int, default=40)
+    parser.add_argument("--chunk-interval", type=float, default=0.05)
+    parser.add_argument("--mode", choices=["both", "sync", "async"], default="both")
+    args = parser.parse_args()
+
+    # Read when the services are imported
+    os.environ["BEDROCK_ENDPOINT_URL"] = f"http://127.0.0.1:{args.port}"
+    os.environ["BEDROCK_DEFAULT_CONCURRENCY"] = str(args.streams)
+    os.environ["BEDROCK_ASYNC_POOL_CONNECTIONS"] = str(args.streams)
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "stub")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "stub")
+
+    stub = BedrockStub(args.latency, args.chunks, args.chunk_interval)
+    serve_stub(stub, args.port)
+
+    if args.mode in ("both", "sync"):
+        run_sync(args.streams)
+    if args.mode in ("both", "async"):
+        asyncio.run(run_async(args.streams))
+    print(f"stub: {stub.requests} requests, peak {stub.peak_in_flight} in flight")
+
+
+if __name__ == "__main__":
+    main()
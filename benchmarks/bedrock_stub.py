@@ -0,0 +1,197 @@
+"""
+Local stub of the Bedrock runtime API, for load tests and benchmarks that
+must not call (or pay for) the real models.
+
+Implements the three operations the services use:
+
+    POST /model/{model_id}/invoke                       embeddings and Anthropic messages
+    POST /model/{model_id}/converse                     Nova and other converse models
+    POST /model/{model_id}/invoke-with-response-stream  Anthropic streaming, as an eventstream
+
+Every answer waits --latency seconds; streamed answers then send --chunks
+text deltas --chunk-interval seconds apart. Requests are not authenticated.
+Point the services at it with BEDROCK_ENDPOINT_URL:
+
+    python -m benchmarks.bedrock_stub --port 8555
+    BEDROCK_ENDPOINT_URL=http://localhost:8555 python async_app.py
+"""
+
+import argparse
+import asyncio
+import base64
+import binascii
+import json
+import struct
+
+from aiohttp import web
+
+EMBEDDING_DIMENSION = 1024
+
+
+def encode_event(headers, payload):
+    """One message of the AWS eventstream encoding, with string headers only."""
+    encoded_headers = b""
+    for name, value in headers.items():
+        name, value = name.encode("utf-8"), value.encode("utf-8")
+        encoded_headers += (
+            struct.pack("!B", len(name))
+            + name
+            + b"\x07"
+            + struct.pack("!H", len(value))
+            + value
+        )
+    total_length = 16 + len(encoded_headers) + len(payload)
+    prelude = struct.pack("!II", total_length, len(encoded_headers))
+    prelude += struct.pack("!I", binascii.crc32(prelude))
+    message = prelude + encoded_headers + payload
+    return message + struct.pack("!I", binascii.crc32(message))
+
+
+def chunk_event(data):
+    payload = json.dumps(
+        {"bytes": base64.b64encode(json.dumps(data).encode("utf-8")).decode("ascii")}
+    ).encode("utf-8")
+    return encode_event(
+        {
+            ":event-type": "chunk",
+            ":content-type": "application/json",
+            ":message-type": "event",
+        },
+        payload,
+    )
+
+
+def usage(text):
+    return max(1, len(text) // 4)
+
+
+class BedrockStub:
+    def __init__(self, latency=0.5, chunks=40, chunk_interval=0.05):
+        self.latency = latency
+        self.chunks = chunks
+        self.chunk_interval = chunk_interval
+        self.requests = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+
+    def app(self):
+        web_app = web.Application()
+        web_app.router.add_post("/model/{model_id}/invoke", self.invoke)
+        web_app.router.add_post("/model/{model_id}/converse", self.converse)
+        web_app.router.add_post(
+            "/model/{model_id}/invoke-with-response-stream", self.invoke_stream
+        )
+        return web_app
+
+    def _start(self):
+        self.requests += 1
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+
+    async def invoke(self, request):
+        self._start()
+        try:
+            body = await request.json()
+            await asyncio.sleep(self.latency)
+            if "inputText" in body:
+                return web.json_response(
+                    {
+                        "embedding": [0.01] * EMBEDDING_DIMENSION,
+                        "inputTextTokenCount": usage(body["inputText"]),
+                    }
+                )
+            return web.json_response(
+                {
+                    "type": "message",
+                    "content": [{"type": "text", "text": "stub answer"}],
+                    "usage": {"input_tokens": 100, "output_tokens": 3},
+                }
+            )
+        finally:
+            self.in_flight -= 1
+
+    async def converse(self, request):
+        self._start()
+        try:
+            await request.json()
+            await asyncio.sleep(self.latency)
+            return web.json_response(
+                {
+                    "output": {
+                        "message": {
+                            "role": "assistant",
+                            "content": [{"text": "stub answer"}],
+                        }
+                    },
+                    "stopReason": "end_turn",
+                    "usage": {
+                        "inputTokens": 100,
+                        "outputTokens": 3,
+                        "totalTokens": 103,
+                    },
+                }
+            )
+        finally:
+            self.in_flight -= 1
+
+    async def invoke_stream(self, request):
+        self._start()
+        try:
+            await request.json()
+            await asyncio.sleep(self.latency)
+            response = web.StreamResponse(
+                headers={"Content-Type": "application/vnd.amazon.eventstream"}
+            )
+            await response.prepare(request)
+            await response.write(
+                chunk_event(
+                    {
+                        "type": "message_start",
+                        "message": {"usage": {"input_tokens": 100}},
+                    }
+                )
+            )
+            for position in range(self.chunks):
+                await response.write(
+                    chunk_event(
+                        {
+                            "type": "content_block_delta",
+                            "delta": {
+                                "type": "text_delta",
+                                "text": f"token{position} ",
+                            },
+                        }
+                    )
+                )
+                await asyncio.sleep(self.chunk_interval)
+            await response.write(
+                chunk_event(
+                    {
+                        "type": "message_stop",
+                        "amazon-bedrock-invocationMetrics": {
+                            "inputTokenCount": 100,
+                            "outputTokenCount": self.chunks,
+                        },
+                    }
+                )
+            )
+            await response.write_eof()
+            return response
+        finally:
+            self.in_flight -= 1
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8555)
+    parser.add_argument("--latency", type=float, default=0.5)
+    parser.add_argument("--chunks", type=int, default=40)
+    parser.add_argument("--chunk-interval", type=float, default=0.05)
+    args = parser.parse_args()
+
+    stub = BedrockStub(args.latency, args.chunks, args.chunk_interval)
+    web.run_app(stub.app(), port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""
+Scaling of flashcard chunk grouping, vectorized versus the original loop.
+
+Embeddings are synthetic: clusters of noisy copies of random centres, so
+the grouping has real work to do. The original pairwise loop is only run
+up to --legacy-max chunks, where both results are also compared.
+
+    python -m benchmarks.flashcard_grouping_benchmark --sizes 100 1000 10000 100000
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+from modules.flashcard.service import leader_clusters
+
+
+def cosine_similarity(vec1, vec2):
+    if vec1 is None or vec2 is None:
+        return 0.0
+
+    if not isinstance(vec1, np.ndarray):
+        vec1 = np.array(vec1)
+    if not isinstance(vec2, np.ndarray):
+        vec2 = np.array(vec2)
+
+    dot_product = np.dot(vec1, vec2)
+    norm_a = np.linalg.norm(vec1)
+    norm_b = np.linalg.norm(vec2)
+
+    if norm_a == 0 or norm_b == 0:
+        return 0
+
+    return dot_product / (norm_a * norm_b)
+
+
+def legacy_group(embeddings, threshold):
+    ungrouped = list(range(len(embeddings)))
+    groups = []
+    while ungrouped:
+        current = ungrouped.pop(0)
+        group = [current]
+        i = 0
+        while i < len(ungrouped):
+            if (
+                cosine_similarity(embeddings[current], embeddings[ungrouped[i]])
+                >= threshold
+            ):
+                group.append(ungrouped.pop(i))
+            else:
+                i += 1
+        groups.append(group)
+    return groups
+
+
+def synthetic_embeddings(n, dim, cluster_size, noise, rng):
+    centres = rng.normal(size=(max(1, n // cluster_size), dim)).astype(np.float32)
+    assignment = rng.integers(0, len(centres), size=n)
+    return centres[assignment] + rng.normal(0, noise, size=(n, dim)).astype(np.float32)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[100, 1000, 10000, 100000]
+    )
+    parser.add_argument("--dim", type=int, default=1024)
+    parser.add_argument("--cluster-size", type=int, default=5)
+    parser.add_argument("--noise", type=float, default=0.6)
+    parser.add_argument("--threshold", type=float, default=0.8)
+    parser.add_argument("--legacy-max", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    for n in args.sizes:
+        embeddings = synthetic_embeddings(
+            n, args.dim, args.cluster_size, args.noise / np.sqrt(args.dim), rng
+        )
+
+        started = time.perf_counter()
+        groups = leader_clusters(embeddings, args.threshold)
+        vectorized_seconds = time.perf_counter() - started
+
+        line = (
+            f"n={n:>7}  groups={len(groups):>7}  vectorized={vectorized_seconds:8.3f}s"
+        )
+        if n <= args.legacy_max:
+            started = time.perf_counter()
+            expected = legacy_group(embeddings, args.threshold)
+            legacy_seconds = time.perf_counter() - started
+            line += f"  legacy={legacy_seconds:8.3f}s  identical={groups == expected}"
+        print(line, flush=True)
+
+
+if __name__ == "__main__":
+    main()
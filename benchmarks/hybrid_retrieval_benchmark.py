@@ -0,0 +1,86 @@
+"""
+Latency and retrieval quality of vector-only versus hybrid chat retrieval.
+
+The evaluation set is a JSON Lines file with one labelled question per line:
+
+    {"session_id": 12, "question": "What does IAM stand for?", "relevant_chunk_ids": [431, 432]}
+
+Run from the repository root:
+
+    python -m benchmarks.hybrid_retrieval_benchmark eval.jsonl --top-k 10
+"""
+
+import argparse
+import json
+import time
+
+import numpy as np
+
+from app import app
+from modules.chatbot.services import ChatbotService
+
+
+def evaluate(service, samples, mode, top_k):
+    latencies, recalls, reciprocal_ranks = [], [], []
+    for sample in samples:
+        started = time.perf_counter()
+        chunks = service.retrieve_similar_chunks(
+            sample["embedding"],
+            sample["session_id"],
+            lang=sample["lang"],
+            top_k=top_k,
+            query_text=sample["question"],
+            mode=mode,
+        )
+        latencies.append(time.perf_counter() - started)
+
+        found = [chunk.id for chunk in chunks]
+        relevant = set(sample["relevant_chunk_ids"])
+        recalls.append(len(relevant & set(found)) / len(relevant))
+        reciprocal_ranks.append(
+            next(
+                (1.0 / rank for rank, cid in enumerate(found, 1) if cid in relevant),
+                0.0,
+            )
+        )
+
+    latencies_ms = np.asarray(latencies) * 1000
+    return {
+        "p50_ms": float(np.percentile(latencies_ms, 50)),
+        "p95_ms": float(np.percentile(latencies_ms, 95)),
+        f"recall@{top_k}": float(np.mean(recalls)),
+        "mrr": float(np.mean(reciprocal_ranks)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("eval_file")
+    parser.add_argument("--top-k", type=int, default=10)
+    args = parser.parse_args()
+
+    with open(args.eval_file, encoding="utf-8") as f:
+        samples = [json.loads(line) for line in f if line.strip()]
+
+    with app.app_context():
+        service = ChatbotService()
+        for sample in samples:
+            sample["lang"] = sample.get("lang") or service.detect_language(
+                sample["question"]
+            )
+            sample["embedding"] = service.bedrock.generate_embedding(sample["question"])
+
+        # Warm connections and caches so the first mode is not penalised.
+        evaluate(service, samples[:5], "vector", args.top_k)
+        evaluate(service, samples[:5], "hybrid", args.top_k)
+
+        for mode in ("vector", "hybrid"):
+            result = evaluate(service, samples, mode, args.top_k)
+            print(
+                f"{mode:>7}: "
+                + "  ".join(f"{name} {value:.3f}" for name, value in result.items())
+            )
+
+
+if __name__ == "__main__":
+    main()
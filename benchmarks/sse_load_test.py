@@ -0,0 +1,106 @@
+"""
+Load test of /send_message_stream: opens --streams concurrent SSE
+connections (started over --ramp seconds) and reads each answer to its
+[END] event.
+
+Run it against a server whose Bedrock calls go to the local stub, so the
+test measures the serving stack rather than the models:
+
+    python -m benchmarks.bedrock_stub --port 8555 &
+    BEDROCK_ENDPOINT_URL=http://localhost:8555 gunicorn -c gunicorn.conf.py app:app &
+    python -m benchmarks.sse_load_test http://localhost:5000 --session-id 1 --streams 500
+
+Reports completed streams, failures by status or error, time to the first
+event and time to [END].
+"""
+
+import argparse
+import asyncio
+import time
+from collections import Counter
+
+import aiohttp
+import numpy as np
+
+
+async def one_stream(session, url, params, delay, results):
+    await asyncio.sleep(delay)
+    started = time.perf_counter()
+    first_event = None
+    try:
+        async with session.get(url, params=params) as response:
+            if response.status != 200:
+                results["failures"][f"HTTP {response.status}"] += 1
+                return
+            async for line in response.content:
+                if not line.startswith(b"data:"):
+                    continue
+                if first_event is None:
+                    first_event = time.perf_counter() - started
+                if line.strip() == b"data: [END]":
+                    break
+            else:
+                results["failures"]["closed before [END]"] += 1
+                return
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        results["failures"][type(e).__name__] += 1
+        return
+    results["first_event"].append(first_event)
+    results["complete"].append(time.perf_counter() - started)
+
+
+def percentiles(samples):
+    if not samples:
+        return "-"
+    ms = np.asarray(samples) * 1000
+    return (
+        f"p50 {np.percentile(ms, 50):.0f}ms p95 {np.percentile(ms, 95):.0f}ms "
+        f"max {ms.max():.0f}ms"
+    )
+
+
+async def run(args):
+    url = args.base_url.rstrip("/") + "/send_message_stream"
+    results = {"first_event": [], "complete": [], "failures": Counter()}
+    connector = aiohttp.TCPConnector(limit=0)
+    timeout = aiohttp.ClientTimeout(total=args.timeout)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        started = time.perf_counter()
+        await asyncio.gather(
+            *(
+                one_stream(
+                    session,
+                    url,
+                    {
+                        "session_id": str(args.session_id),
+                        "message": f"{args.message} {i}",
+                    },
+                    args.ramp * i / args.streams,
+                    results,
+                )
+                for i in range(args.streams)
+            )
+        )
+        wall = time.perf_counter() - started
+
+    print(
+        f"streams:     {len(results['complete'])}/{args.streams} completed in {wall:.1f}s"
+    )
+    print(f"failures:    {dict(results['failures']) or 'none'}")
+    print(f"first event: {percentiles(results['first_event'])}")
+    print(f"complete:    {percentiles(results['complete'])}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("base_url")
+    parser.add_argument("--session-id", type=int, required=True)
+    parser.add_argument("--message", default="What is covered in this course?")
+    parser.add_argument("--streams", type=int, default=200)
+    parser.add_argument("--ramp", type=float, default=5.0)
+    parser.add_argument("--timeout", type=float, default=120.0)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
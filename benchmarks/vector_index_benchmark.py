@@ -0,0 +1,98 @@
+"""
+Compare chat retrieval through pgvector with the in-process hot vector index.
+
+Run from the repository root against a database that already holds ingested
+chunks for the organization:
+
+    python -m benchmarks.vector_index_benchmark --organization-id 1 --lang en
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+from app import app
+from extensions import db
+from modules.chatbot.vector_index import EMBEDDING_COLUMNS, HotVectorIndexCache
+from modules.document.entity import Courses, DocumentChunks, Documents
+
+
+def percentile(samples, q):
+    return float(np.percentile(np.asarray(samples) * 1000, q))
+
+
+def pgvector_search(organization_id, lang, embedding, top_k):
+    embedding_column = EMBEDDING_COLUMNS[lang]
+    rows = (
+        db.session.query(DocumentChunks.id)
+        .join(Documents, DocumentChunks.document_id == Documents.id)
+        .join(Courses, Documents.course_id == Courses.id)
+        .filter(Courses.organizationId == organization_id)
+        .order_by(embedding_column.op("<=>")(embedding))
+        .limit(top_k)
+        .all()
+    )
+    return [row.id for row in rows]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--organization-id", type=int, required=True)
+    parser.add_argument("--lang", default="en", choices=sorted(EMBEDDING_COLUMNS))
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--noise", type=float, default=0.05)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+
+    with app.app_context():
+        cache = HotVectorIndexCache(max_bytes=4 * 1024**3)
+
+        started = time.perf_counter()
+        index = cache.get_index(args.organization_id, args.lang)
+        load_seconds = time.perf_counter() - started
+        if index is None or len(index.ids) == 0:
+            raise SystemExit("No vectors found for this organization and language")
+
+        picks = rng.integers(0, len(index.ids), size=args.queries)
+        queries = index.matrix[picks] + rng.normal(
+            0, args.noise, size=(args.queries, index.matrix.shape[1])
+        ).astype(np.float32)
+
+        pg_times, index_times, recalls = [], [], []
+        for query in queries:
+            started = time.perf_counter()
+            expected = pgvector_search(
+                args.organization_id, args.lang, query.tolist(), args.top_k
+            )
+            pg_times.append(time.perf_counter() - started)
+
+            started = time.perf_counter()
+            found = [
+                chunk_id
+                for chunk_id, _ in cache.search(
+                    args.organization_id, args.lang, query, args.top_k
+                )
+            ]
+            index_times.append(time.perf_counter() - started)
+
+            if expected:
+                recalls.append(len(set(found) & set(expected)) / len(expected))
+
+    print(f"vectors: {len(index.ids)}  dim: {index.matrix.shape[1]}")
+    print(f"index memory: {index.nbytes / 1024**2:.1f} MiB")
+    print(f"index load: {load_seconds * 1000:.1f} ms")
+    for name, samples in (("pgvector", pg_times), ("hot index", index_times)):
+        print(
+            f"{name:>10}: p50 {percentile(samples, 50):.2f} ms  "
+            f"p95 {percentile(samples, 95):.2f} ms  "
+            f"p99 {percentile(samples, 99):.2f} ms"
+        )
+    print(f"overlap@{args.top_k} with pgvector: {np.mean(recalls):.3f}")
+
+
+if __name__ == "__main__":
+    main()
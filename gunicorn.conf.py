@@ -0,0 +1,45 @@
+"""
+Gunicorn settings of the Flask app and of the async chat server:
+
+    gunicorn -c gunicorn.conf.py app:app
+    WEB_WORKER_CLASS=aiohttp.GunicornWebWorker WEB_BIND=0.0.0.0:5001 \
+        gunicorn -c gunicorn.conf.py "async_app:create_async_app()"
+
+See "Serving" in README.md for the concurrency each worker class allows.
+"""
+
+import os
+
+bind = os.getenv("WEB_BIND", "0.0.0.0:5000")
+workers = int(os.getenv("WEB_WORKERS", "2"))
+# gthread: a thread per request. gevent: a greenlet per request, for many
+# long-lived streams. aiohttp.GunicornWebWorker: for async_app only.
+worker_class = os.getenv("WEB_WORKER_CLASS", "gthread")
+threads = int(os.getenv("WEB_THREADS", "16"))
+worker_connections = int(os.getenv("WEB_WORKER_CONNECTIONS", "1000"))
+# A worker whose main loop stops reporting for this long is restarted
+timeout = int(os.getenv("WEB_TIMEOUT", "300"))
+# On SIGTERM a worker stops accepting connections and lets the in-flight
+# requests and streams finish for this long
+graceful_timeout = int(os.getenv("WEB_GRACEFUL_TIMEOUT", "30"))
+keepalive = int(os.getenv("WEB_KEEPALIVE", "5"))
+# Every worker imports the app itself: the app starts background threads
+# (message buffer, executors) that would not survive a fork
+preload_app = False
+accesslog = "-"
+
+
+def post_worker_init(worker):
+    if worker_class == "gevent":
+        # psycopg2 waits on the database in C; make it yield to other greenlets
+        from psycogreen.gevent import patch_psycopg
+
+        patch_psycopg()
+
+
+def worker_exit(server, worker):
+    # In-flight requests are drained by now; write the chat messages still
+    # waiting in the write-behind buffer
+    from modules.chatbot.message_buffer import message_buffer
+
+    message_buffer.shutdown()
@@ -0,0 +1,171 @@
+import os
+import time
+import hashlib
+import threading
+
+import numpy as np
+
+from extensions import get_logger
+from modules.shared.services.content_version import content_versions
+
+
+def context_fingerprint(chunk_ids):
+    joined = ",".join(str(chunk_id) for chunk_id in sorted(chunk_ids))
+    return hashlib.sha1(joined.encode("utf-8")).hexdigest()
+
+
+class _OrganizationAnswers:
+    def __init__(self, version):
+        self.version = version
+        self.embeddings = []
+        self.entries = []
+        self._matrix = None
+
+    def matrix(self):
+        if self._matrix is None:
+            self._matrix = np.vstack(self.embeddings)
+        return self._matrix
+
+    def add(self, embedding, entry, max_entries):
+        self.embeddings.append(embedding)
+        self.entries.append(entry)
+        if len(self.entries) > max_entries:
+            del self.embeddings[0]
+            del self.entries[0]
+        self._matrix = None
+
+    def drop_expired(self, now):
+        keep = [i for i, entry in enumerate(self.entries) if entry["expires_at"] > now]
+        if len(keep) != len(self.entries):
+            self.embeddings = [self.embeddings[i] for i in keep]
+            self.entries = [self.entries[i] for i in keep]
+            self._matrix = None
+
+
+class SemanticAnswerCache:
+    """
+    Per-organization cache of chatbot answers keyed by question embedding.
+
+    A cached answer is served when a new question is at least
+    `similarity_threshold` cosine-similar to a cached one and retrieval
+    returned the same set of chunks for it. Entries expire after
+    `ttl_seconds` and the whole organization is dropped when its content
+    version moves.
+    """
+
+    def __init__(
+        self,
+        similarity_threshold=0.95,
+        ttl_seconds=3600,
+        max_entries_per_org=1000,
+        versions=content_versions,
+    ):
+        self.similarity_threshold = similarity_threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries_per_org = max_entries_per_org
+        self.versions = versions
+        self.logger = get_logger("[SemanticAnswerCache]")
+        self._lock = threading.Lock()
+        self._organizations = {}
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, organization_id, lang, embedding, chunk_ids):
+        query = self._normalize(embedding)
+        if query is None or not chunk_ids:
+            return self._miss()
+
+        fingerprint = context_fingerprint(chunk_ids)
+        version = self.versions.get(organization_id)
+
+        with self._lock:
+            answers = self._answers(organization_id, lang, version)
+            answers.drop_expired(time.monotonic())
+            answer, similarity = self._find(answers, query, fingerprint)
+            if answer is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+
+        self.logger.info(
+            f"[lookup] Hit for organization {organization_id} "
+            f"(similarity {similarity:.3f})"
+        )
+        return answer
+
+    def _find(self, answers, query, fingerprint):
+        if not answers.entries:
+            return None, None
+
+        scores = answers.matrix() @ query
+        for i in np.argsort(-scores):
+            if scores[i] < self.similarity_threshold:
+                break
+            if answers.entries[i]["fingerprint"] == fingerprint:
+                return answers.entries[i]["answer"], float(scores[i])
+        return None, None
+
+    def store(self, organization_id, lang, embedding, chunk_ids, answer):
+        vector = self._normalize(embedding)
+        if vector is None or not chunk_ids or not answer:
+            return
+
+        version = self.versions.get(organization_id)
+        entry = {
+            "fingerprint": context_fingerprint(chunk_ids),
+            "answer": answer,
+            "expires_at": time.monotonic() + self.ttl_seconds,
+        }
+        with self._lock:
+            self._answers(organization_id, lang, version).add(
+                vector, entry, self.max_entries_per_org
+            )
+
+    def invalidate(self, organization_id=None):
+        with self._lock:
+            if organization_id is None:
+                self._organizations.clear()
+                return
+            for key in [k for k in self._organizations if k[0] == organization_id]:
+                del self._organizations[key]
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": sum(
+                    len(answers.entries) for answers in self._organizations.values()
+                ),
+            }
+
+    def _answers(self, organization_id, lang, version):
+        key = (organization_id, lang)
+        answers = self._organizations.get(key)
+        if answers is None or answers.version != version:
+            answers = _OrganizationAnswers(version)
+            self._organizations[key] = answers
+        return answers
+
+    def _miss(self):
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def _normalize(self, embedding):
+        if embedding is None or len(embedding) == 0:
+            return None
+        vector = np.array(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        if norm == 0:
+            return None
+        return vector / norm
+
+
+answer_cache = SemanticAnswerCache(
+    similarity_threshold=float(os.getenv("CHAT_ANSWER_CACHE_THRESHOLD", "0.95")),
+    ttl_seconds=float(os.getenv("CHAT_ANSWER_CACHE_TTL_SECONDS", "3600")),
+    max_entries_per_org=int(os.getenv("CHAT_ANSWER_CACHE_MAX_ENTRIES", "1000")),
+)
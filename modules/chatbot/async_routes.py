@@ -0,0 +1,80 @@
+from aiohttp import web
+from modules.chatbot.services import ChatbotService
+from modules.shared.services.bedrock_errors import BedrockError, BedrockTimeout
+from extensions import get_logger
+
+logger = get_logger("[ChatbotAsyncRoutes]")
+
+
+def _bedrock_error_response(error):
+    # The turn is saved without an answer; the user can send it again
+    status = 504 if isinstance(error, BedrockTimeout) else 503
+    return web.json_response(
+        {"error": "The assistant is unavailable, try again later"}, status=status
+    )
+
+
+async def chatbot_message_handler(request):
+    try:
+        data = await request.json()
+    except ValueError:
+        data = None
+
+    if not data or "session_id" not in data or "message" not in data:
+        return web.json_response(
+            {"error": "Missing required fields: session_id, message"}, status=400
+        )
+
+    service = ChatbotService()
+    try:
+        response_data = await service.handle_message_async(
+            request.app["flask_app"], data["session_id"], data["message"]
+        )
+    except BedrockError as e:
+        return _bedrock_error_response(e)
+    return web.json_response(response_data)
+
+
+async def chatbot_message_stream_handler(request):
+    session_id = request.query.get("session_id")
+    message = request.query.get("message")
+    if not session_id or not message:
+        return web.json_response(
+            {"error": "Missing required fields: session_id, message"}, status=400
+        )
+
+    service = ChatbotService()
+    events = service.handle_message_stream_async(
+        request.app["flask_app"], session_id, message
+    )
+    # Failures before the first event still get a status code
+    try:
+        first_event = await events.__anext__()
+    except BedrockError as e:
+        await events.aclose()
+        return _bedrock_error_response(e)
+
+    response = web.StreamResponse(
+        headers={
+            "Content-Type": "text/event-stream",
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no",
+        }
+    )
+    try:
+        await response.prepare(request)
+        await response.write(first_event.encode("utf-8"))
+        async for event in events:
+            await response.write(event.encode("utf-8"))
+    except BedrockError as e:
+        logger.error(f"[chatbot_message_stream_handler] Session {session_id}: {e}")
+        await response.write(b"event: error\ndata: [END]\n\n")
+    finally:
+        await events.aclose()
+    return response
+
+
+def register_chatbot_async_routes(web_app):
+    web_app.router.add_post("/send_message", chatbot_message_handler)
+    # GET works better with EventSource
+    web_app.router.add_get("/send_message_stream", chatbot_message_stream_handler)
@@ -0,0 +1,166 @@
+import os
+
+import numpy as np
+
+from modules.shared.services.tokenizer import token_counter
+
+GENERATION_MODEL_ID = "amazon.nova-pro-v1:0"
+
+# Overlaps shorter than this are treated as coincidence rather than the
+# chunker's sentence overlap.
+MIN_OVERLAP_CHARS = 20
+MAX_OVERLAP_CHARS = 4000
+
+
+def maximal_marginal_relevance(query, matrix, k, lambda_mult=0.7):
+    """
+    Order rows of `matrix` (L2-normalized) by maximal marginal relevance to
+    `query` and return the indices of the first `k`.
+    """
+    n = matrix.shape[0]
+    if n == 0:
+        return []
+
+    relevance = matrix @ query
+    pairwise = matrix @ matrix.T
+    max_redundancy = np.zeros(n, dtype=np.float32)
+    available = np.ones(n, dtype=bool)
+
+    selected = []
+    for _ in range(min(k, n)):
+        scores = lambda_mult * relevance - (1 - lambda_mult) * max_redundancy
+        scores[~available] = -np.inf
+        best = int(np.argmax(scores))
+        selected.append(best)
+        available[best] = False
+        max_redundancy = np.maximum(max_redundancy, pairwise[best])
+    return selected
+
+
+def overlap_length(previous_text, next_text):
+    """Length of the longest suffix of `previous_text` that starts `next_text`."""
+    limit = min(len(previous_text), len(next_text), MAX_OVERLAP_CHARS)
+    if limit < MIN_OVERLAP_CHARS:
+        return 0
+
+    # Prefix function of next + separator + tail(previous): its last value is
+    # the longest prefix of `next_text` that is also a suffix of the tail.
+    combined = next_text[:limit] + "\x00" + previous_text[-limit:]
+    prefix = [0] * len(combined)
+    for i in range(1, len(combined)):
+        j = prefix[i - 1]
+        while j and combined[i] != combined[j]:
+            j = prefix[j - 1]
+        if combined[i] == combined[j]:
+            j += 1
+        prefix[i] = j
+
+    overlap = prefix[-1]
+    return overlap if overlap >= MIN_OVERLAP_CHARS else 0
+
+
+class ContextPacker:
+    """
+    Builds the chat prompt context from retrieved chunks.
+
+    Chunks are re-ranked with maximal marginal relevance over their
+    embeddings, the sentence overlap the chunker leaves between consecutive
+    chunks of one document is removed, and chunks are added in that order
+    until `token_budget` is used.
+    """
+
+    def __init__(self, token_budget=3000, lambda_mult=0.7, model_id=None):
+        self.token_budget = token_budget
+        self.lambda_mult = lambda_mult
+        self.counter = token_counter(model_id or GENERATION_MODEL_ID)
+
+    def pack(self, query_embedding, chunks, lang="en"):
+        if not chunks:
+            return "", []
+
+        order = self._rerank(query_embedding, chunks, lang)
+        overlaps = self._overlaps(chunks)
+
+        packed = []
+        used = 0
+        # Budget full texts first; stripping overlaps afterwards can only free
+        # tokens, which a second pass hands to the chunks that did not fit.
+        for _ in range(2):
+            for i in order:
+                if i in packed:
+                    continue
+                tokens = self.counter.count(self._text(chunks, i, packed, overlaps))
+                if used + tokens <= self.token_budget:
+                    packed.append(i)
+                    used += tokens
+            texts = [self._text(chunks, i, packed, overlaps) for i in packed]
+            used = sum(self.counter.count(text) for text in texts)
+
+        packed = self._reading_order(chunks, packed, order, overlaps)
+        context_text = "\n".join(
+            self._text(chunks, i, packed, overlaps) for i in packed
+        )
+        return context_text, [chunks[i] for i in packed]
+
+    def _reading_order(self, chunks, packed, order, overlaps):
+        # Keep MMR order between passages, but put a chunk whose overlap was
+        # stripped right after the chunk it continues.
+        rank = {i: r for r, i in enumerate(order)}
+        roots = {}
+        for i in packed:
+            root = i
+            while root in overlaps and overlaps[root][0] in packed:
+                root = overlaps[root][0]
+            roots.setdefault(root, []).append(i)
+
+        runs = sorted(roots.values(), key=lambda run: min(rank[i] for i in run))
+        return [i for run in runs for i in sorted(run, key=lambda i: chunks[i].id)]
+
+    def _text(self, chunks, i, packed, overlaps):
+        text = chunks[i].text_en or ""
+        previous, overlap = overlaps.get(i, (None, 0))
+        if overlap and previous in packed:
+            text = text[overlap:].lstrip()
+        return text
+
+    def _rerank(self, query_embedding, chunks, lang):
+        dimension = len(query_embedding)
+        matrix = np.zeros((len(chunks), dimension), dtype=np.float32)
+        for row, chunk in enumerate(chunks):
+            embedding = getattr(chunk, f"embeddings_{lang}")
+            if embedding is not None and len(embedding) == dimension:
+                matrix[row] = embedding
+
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        matrix /= norms
+
+        query = np.asarray(query_embedding, dtype=np.float32)
+        query_norm = np.linalg.norm(query)
+        if query_norm == 0:
+            return list(range(len(chunks)))
+        query = query / query_norm
+
+        return maximal_marginal_relevance(query, matrix, len(chunks), self.lambda_mult)
+
+    def _overlaps(self, chunks):
+        # Within a document, chunk ids follow chunker order, so a chunk can
+        # only repeat the end of the chunk with the id just before it.
+        by_id = {chunk.id: i for i, chunk in enumerate(chunks)}
+        overlaps = {}
+        for i, chunk in enumerate(chunks):
+            previous = by_id.get(chunk.id - 1)
+            if previous is None or chunks[previous].document_id != chunk.document_id:
+                continue
+            overlap = overlap_length(
+                chunks[previous].text_en or "", chunk.text_en or ""
+            )
+            if overlap:
+                overlaps[i] = (previous, overlap)
+        return overlaps
+
+
+context_packer = ContextPacker(
+    token_budget=int(os.getenv("CHAT_CONTEXT_TOKEN_BUDGET", "3000")),
+    lambda_mult=float(os.getenv("CHAT_MMR_LAMBDA", "0.7")),
+)
@@ -1,5 +1,13 @@
 from flask import request, jsonify, Response
 from modules.chatbot.services import ChatbotService
+from modules.chatbot.answer_cache import answer_cache
+from modules.shared.services.bedrock_errors import BedrockError, BedrockTimeout
+
+
+def _bedrock_error_response(error):
+    # The turn is saved without an answer; the user can send it again
+    status = 504 if isinstance(error, BedrockTimeout) else 503
+    return jsonify({"error": "The assistant is unavailable, try again later"}), status
 
 
 def chatbot_message_controller():
@@ -10,9 +18,12 @@ def chatbot_message_controller():
 
     service = ChatbotService()
 
-    response_data = service.handle_message(
-        session_id=data["session_id"], message=data["message"]
-    )
+    try:
+        response_data = service.handle_message(
+            session_id=data["session_id"], message=data["message"]
+        )
+    except BedrockError as e:
+        return _bedrock_error_response(e)
     return jsonify(response_data)
 
 
@@ -24,6 +35,12 @@ def chatbot_message_stream_controller():
     if not session_id or not message:
         return jsonify({"error": "Missing required fields: session_id, message"}), 400
 
-    return Response(
-        service.handle_message_stream(session_id, message), mimetype="text/event-stream"
-    )
+    try:
+        events = service.handle_message_stream(session_id, message)
+    except BedrockError as e:
+        return _bedrock_error_response(e)
+    return Response(events, mimetype="text/event-stream")
+
+
+def chatbot_cache_stats_controller():
+    return jsonify(answer_cache.stats())
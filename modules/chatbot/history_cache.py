@@ -0,0 +1,231 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from extensions import get_logger
+from modules.chatbot.prompts import HISTORY_SUMMARY_PROMPT
+from modules.shared.services.bedrock import BedrockService
+from modules.shared.services.tokenizer import token_counter
+
+SUMMARY_MODEL_ID = "anthropic.claude-3-haiku-20240307-v1:0"
+
+
+class SessionHistory:
+    def __init__(self, turns, version=None):
+        self.lock = threading.Lock()
+        self.turns = list(turns)
+        # Message version of the session when it was loaded, plus one per
+        # append(); None when the caller gave no way to check it
+        self.version = version
+        self.summary = ""
+        self.compacting = False
+        self.last_used = time.monotonic()
+
+    def tokens(self):
+        return sum(turn["tokens"] for turn in self.turns)
+
+
+class HistorySnapshot:
+    def __init__(self, summary, turns):
+        self.summary = summary
+        self.turns = turns
+
+
+class SessionHistoryCache:
+    """
+    In-memory chat history per active session with a rolling summary.
+
+    The cache is loaded from the database on first use and kept current by
+    `append()` on every write. Other processes write to the same sessions,
+    so `get()` compares the message version of the session, bumped by every
+    message stored, with the one the entry accounts for and reloads it when
+    they differ. Once the turns held for a session exceed
+    `token_budget`, the oldest ones are folded into a summary by a background
+    model call, so the history part of the prompt stays bounded.
+    """
+
+    def __init__(
+        self,
+        token_budget=1500,
+        summary_tokens=300,
+        max_message_tokens=600,
+        max_sessions=5000,
+        idle_seconds=1800,
+        summarizer=None,
+    ):
+        self.token_budget = token_budget
+        self.summary_tokens = summary_tokens
+        self.max_message_tokens = max_message_tokens
+        self.max_sessions = max_sessions
+        self.idle_seconds = idle_seconds
+        self.counter = token_counter(SUMMARY_MODEL_ID)
+        self.summarizer = summarizer or self._summarize
+        self.logger = get_logger("[SessionHistoryCache]")
+        self._lock = threading.Lock()
+        self._sessions = OrderedDict()
+        self._executor = ThreadPoolExecutor(
+            max_workers=2, thread_name_prefix="history-summary"
+        )
+        self._bedrock = None
+
+    def get(self, session_id, loader, version=None):
+        """
+        History of the session, from `loader(session_id)` on a miss.
+        `version(session_id)` is the message version of the session; an
+        entry loaded at another one, not counting its own appends, is
+        reloaded.
+        """
+        session_id = int(session_id)
+        current = version(session_id) if version is not None else None
+        entry = self._entry(session_id)
+        if entry is not None and entry.version != current:
+            self.logger.info(
+                f"[get] Session {session_id} changed elsewhere, reloading its history"
+            )
+            entry = None
+
+        if entry is None:
+            entry = SessionHistory(
+                (self._turn(msg) for msg in loader(session_id)), current
+            )
+            with self._lock:
+                self._sessions[session_id] = entry
+                self._sessions.move_to_end(session_id)
+                while len(self._sessions) > self.max_sessions:
+                    self._sessions.popitem(last=False)
+
+        with entry.lock:
+            entry.last_used = time.monotonic()
+            return HistorySnapshot(entry.summary, list(entry.turns))
+
+    def append(self, session_id, sender, message, created_at=None):
+        entry = self._entry(session_id)
+        if entry is None:
+            return
+
+        with entry.lock:
+            if entry.version is not None:
+                entry.version += 1
+            entry.turns.append(
+                {
+                    "sender": sender,
+                    "message": message,
+                    "created_at": created_at,
+                    "tokens": self.counter.count(message),
+                }
+            )
+        self._maybe_compact(session_id, entry)
+
+    def invalidate(self, session_id):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def render(self, snapshot):
+        lines = []
+        used = 0
+        for turn in reversed(snapshot.turns):
+            text = self.counter.truncate(turn["message"], self.max_message_tokens)
+            tokens = min(turn["tokens"], self.max_message_tokens)
+            if lines and used + tokens > self.token_budget:
+                break
+            lines.append(f"{turn['sender']}: {text}")
+            used += tokens
+        lines.reverse()
+
+        if snapshot.summary:
+            lines.insert(0, f"Summary of earlier conversation: {snapshot.summary}")
+        return "\n".join(lines)
+
+    def _entry(self, session_id):
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            if entry is None:
+                return None
+            if time.monotonic() - entry.last_used > self.idle_seconds:
+                del self._sessions[session_id]
+                return None
+            self._sessions.move_to_end(session_id)
+            return entry
+
+    def _turn(self, msg):
+        return {
+            "sender": msg.sender,
+            "message": msg.message,
+            "created_at": msg.created_at,
+            "tokens": self.counter.count(msg.message),
+        }
+
+    def _maybe_compact(self, session_id, entry):
+        with entry.lock:
+            if entry.compacting or entry.tokens() <= self.token_budget:
+                return
+
+            # Keep the newest turns that fit in half the budget (at least the
+            # last exchange) and fold everything older into the summary.
+            kept_tokens = 0
+            keep = 0
+            for turn in reversed(entry.turns):
+                if keep >= 2 and kept_tokens + turn["tokens"] > self.token_budget // 2:
+                    break
+                kept_tokens += turn["tokens"]
+                keep += 1
+            folded = entry.turns[: len(entry.turns) - keep]
+            if not folded:
+                return
+
+            entry.compacting = True
+            summary = entry.summary
+
+        self._executor.submit(self._compact, session_id, entry, summary, folded)
+
+    def _compact(self, session_id, entry, summary, folded):
+        try:
+            new_summary = self.summarizer(summary, folded)
+            if not isinstance(new_summary, str) or not new_summary.strip():
+                raise ValueError(f"Summarizer returned {new_summary!r}")
+
+            with entry.lock:
+                # Turns are only ever appended, so the folded ones are still
+                # at the front of the list.
+                del entry.turns[: len(folded)]
+                entry.summary = self.counter.truncate(
+                    new_summary.strip(), self.summary_tokens
+                )
+            self.logger.info(
+                f"[_compact] Folded {len(folded)} turns of session {session_id} into the summary"
+            )
+        except Exception as e:
+            self.logger.error(
+                f"[_compact] Failed to summarize session {session_id}: {e}"
+            )
+        finally:
+            with entry.lock:
+                entry.compacting = False
+
+    def _summarize(self, summary, turns):
+        if self._bedrock is None:
+            self._bedrock = BedrockService()
+
+        messages = "\n".join(f"{turn['sender']}: {turn['message']}" for turn in turns)
+        prompt = HISTORY_SUMMARY_PROMPT.format(
+            summary=summary or "(none)",
+            messages=messages,
+            max_words=int(self.summary_tokens * 0.7),
+        )
+        return self._bedrock.invoke_model_with_text(
+            prompt,
+            model_id=SUMMARY_MODEL_ID,
+            temperature=0,
+            max_tokens=self.summary_tokens,
+        )
+
+
+history_cache = SessionHistoryCache(
+    token_budget=int(os.getenv("CHAT_HISTORY_TOKEN_BUDGET", "1500")),
+    summary_tokens=int(os.getenv("CHAT_HISTORY_SUMMARY_TOKENS", "300")),
+    max_message_tokens=int(os.getenv("CHAT_HISTORY_MAX_MESSAGE_TOKENS", "600")),
+    max_sessions=int(os.getenv("CHAT_HISTORY_MAX_SESSIONS", "5000")),
+    idle_seconds=float(os.getenv("CHAT_HISTORY_IDLE_SECONDS", "1800")),
+)
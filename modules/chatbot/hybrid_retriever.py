@@ -0,0 +1,95 @@
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import cast, func
+from sqlalchemy.dialects.postgresql import REGCONFIG
+
+from extensions import db, get_logger
+from modules.document.entity import DocumentChunks, Documents, Courses
+from modules.shared.services.concurrency import submit_with_app_context
+
+TEXT_SEARCH_CONFIGS = {"en": "english", "fr": "french", "ar": "arabic"}
+
+TSVECTOR_COLUMNS = {
+    "en": DocumentChunks.tsv_en,
+    "fr": DocumentChunks.tsv_fr,
+    "ar": DocumentChunks.tsv_ar,
+}
+
+_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("CHAT_RETRIEVAL_WORKERS", "8")),
+    thread_name_prefix="hybrid-retrieval",
+)
+
+
+def reciprocal_rank_fusion(rankings, k=60):
+    scores = {}
+    for ranking in rankings:
+        for rank, chunk_id in enumerate(ranking, start=1):
+            scores[chunk_id] = scores.get(chunk_id, 0.0) + 1.0 / (k + rank)
+    return sorted(scores, key=lambda chunk_id: scores[chunk_id], reverse=True)
+
+
+class HybridRetriever:
+    """
+    Runs full-text and vector retrieval concurrently and fuses the two
+    rankings with reciprocal rank fusion.
+    """
+
+    def __init__(self, rrf_k=60, candidates=50):
+        self.rrf_k = rrf_k
+        self.candidates = candidates
+        self.logger = get_logger("[HybridRetriever]")
+
+    def retrieve(self, organization_id, lang, query_text, vector_search, top_k=10):
+        lexical_future = submit_with_app_context(
+            _executor,
+            self.lexical_search,
+            organization_id,
+            lang,
+            query_text,
+            self.candidates,
+        )
+        vector_future = submit_with_app_context(
+            _executor, vector_search, self.candidates
+        )
+
+        lexical_ids = lexical_future.result()
+        vector_ids = vector_future.result()
+        self.logger.info(
+            f"[retrieve] {len(lexical_ids)} lexical and {len(vector_ids)} vector candidates"
+        )
+
+        fused = reciprocal_rank_fusion([lexical_ids, vector_ids], k=self.rrf_k)
+        return fused[:top_k]
+
+    def lexical_search(self, organization_id, lang, query_text, limit):
+        # A chat question rarely contains only words that all occur in one
+        # chunk, so match any of them. Only the words are kept: quotes and
+        # minus signs would be read as phrase and negation operators.
+        words = re.findall(r"\w+", query_text or "")
+        if not words:
+            return []
+
+        config = cast(TEXT_SEARCH_CONFIGS[lang], REGCONFIG)
+        tsvector_column = TSVECTOR_COLUMNS[lang]
+        any_term_query = func.websearch_to_tsquery(config, " or ".join(words))
+
+        rows = (
+            db.session.query(DocumentChunks.id)
+            .join(Documents, DocumentChunks.document_id == Documents.id)
+            .join(Courses, Documents.course_id == Courses.id)
+            .filter(Courses.organizationId == organization_id)
+            .filter(tsvector_column.op("@@")(any_term_query))
+            .order_by(func.ts_rank_cd(tsvector_column, any_term_query).desc())
+            .limit(limit)
+            .all()
+        )
+        return [row.id for row in rows]
+
+
+hybrid_retriever = HybridRetriever(
+    rrf_k=int(os.getenv("CHAT_RRF_K", "60")),
+    candidates=int(os.getenv("CHAT_HYBRID_CANDIDATES", "50")),
+)
@@ -0,0 +1,245 @@
+import os
+import atexit
+import threading
+from collections import Counter
+from datetime import datetime
+
+from sqlalchemy import bindparam, insert, update
+from sqlalchemy.exc import DataError, IntegrityError
+
+from extensions import db, get_logger
+from modules.document.entity import ChatMessage, ChatSession
+
+# How many times version() reads the database before giving up when batches
+# keep being written meanwhile, and how long it waits for each write
+VERSION_ATTEMPTS = 3
+VERSION_WAIT_SECONDS = 1.0
+
+_sessions = ChatSession.__table__
+
+
+def insert_messages(rows):
+    """Insert chat messages and bump the message version of their sessions."""
+    db.session.execute(insert(ChatMessage), rows)
+    db.session.execute(
+        update(_sessions)
+        .where(_sessions.c.id == bindparam("session"))
+        .values(message_version=_sessions.c.message_version + bindparam("added")),
+        [
+            {"session": session_id, "added": added}
+            for session_id, added in Counter(row["session_id"] for row in rows).items()
+        ],
+    )
+
+
+class ChatMessageWriteBuffer:
+    """
+    Write-behind buffer for chat messages.
+
+    Messages are queued in arrival order and inserted in batches by a
+    background thread once `max_batch` messages are waiting or every
+    `flush_interval` seconds. Queued and in-flight messages stay visible
+    through `pending()` until their batch is committed, and `version()`
+    counts each of them once whether or not its batch is being written.
+
+    At most `max_queue` messages wait at once; past that, messages are
+    written directly so a slow database slows writers down instead of
+    growing the queue. A batch the database rejects is retried one row at a
+    time and the rows it still rejects are dropped.
+    """
+
+    def __init__(self, max_batch=100, flush_interval=0.5, max_queue=10000):
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self.logger = get_logger("[ChatMessageWriteBuffer]")
+        self.app = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        # Batches being written, and how many were written so far
+        self._writes = threading.Condition(self._lock)
+        self._writing = 0
+        self._written = 0
+        self._stopped = threading.Event()
+        self._queue = []
+        self._in_flight = []
+        self._thread = None
+
+    def init_app(self, app):
+        self.app = app
+        self._thread = threading.Thread(
+            target=self._run, name="chat-message-flusher", daemon=True
+        )
+        self._thread.start()
+        atexit.register(self.shutdown)
+
+    def add(self, session_id, message, sender, created_at=None):
+        try:
+            session_id = int(session_id)
+        except (TypeError, ValueError):
+            raise ValueError(f"Invalid chat session id: {session_id!r}")
+
+        row = {
+            "session_id": session_id,
+            "message": message,
+            "sender": sender,
+            "created_at": created_at or datetime.utcnow(),
+        }
+
+        if self.app is None or self._stopped.is_set():
+            insert_messages([row])
+            db.session.commit()
+            return row
+
+        with self._lock:
+            if len(self._queue) < self.max_queue:
+                self._queue.append(row)
+                if len(self._queue) >= self.max_batch:
+                    self._wake.set()
+                return row
+
+        insert_messages([row])
+        db.session.commit()
+        return row
+
+    def pending(self, session_id):
+        session_id = int(session_id)
+        with self._lock:
+            rows = self._in_flight + self._queue
+            return [dict(row) for row in rows if row["session_id"] == session_id]
+
+    def version(self, session_id, stored):
+        """
+        `stored(session_id)`, the message version of the session in the
+        database, plus the messages of the session waiting here. The database
+        is read between two batch writes, so that a batch committed meanwhile
+        is neither counted twice nor missed. None when writes never paused.
+        """
+        session_id = int(session_id)
+        for _ in range(VERSION_ATTEMPTS):
+            with self._lock:
+                self._writes.wait_for(
+                    lambda: not self._writing, timeout=VERSION_WAIT_SECONDS
+                )
+                written = self._written
+            version = stored(session_id) or 0
+            with self._lock:
+                if not self._writing and self._written == written:
+                    return version + sum(
+                        1
+                        for row in self._in_flight + self._queue
+                        if row["session_id"] == session_id
+                    )
+        return None
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                if not self._queue:
+                    return 0
+                self._in_flight = self._queue[: self.max_batch]
+                self._queue = self._queue[self.max_batch :]
+                batch = self._in_flight
+
+            try:
+                self._write(batch)
+            except Exception as e:
+                self.logger.error(
+                    f"[flush] Failed to write {len(batch)} messages, "
+                    f"retrying one at a time: {e}"
+                )
+                self._write_each(batch)
+
+            with self._lock:
+                if self._in_flight:
+                    # Rows _write_each dropped
+                    self._in_flight = []
+                    self._written += 1
+                if len(self._queue) >= self.max_batch:
+                    self._wake.set()
+            return len(batch)
+
+    def _write(self, rows):
+        # Committed rows leave _in_flight in the same critical section that
+        # ends the write, see version()
+        with self._lock:
+            self._writing += 1
+        committed = False
+        try:
+            with self.app.app_context():
+                try:
+                    insert_messages(rows)
+                    db.session.commit()
+                    committed = True
+                except Exception:
+                    db.session.rollback()
+                    raise
+        finally:
+            with self._lock:
+                if committed:
+                    written = {id(row) for row in rows}
+                    self._in_flight = [
+                        row for row in self._in_flight if id(row) not in written
+                    ]
+                self._writing -= 1
+                self._written += 1
+                self._writes.notify_all()
+
+    def _write_each(self, rows):
+        for position, row in enumerate(rows):
+            try:
+                self._write([row])
+            except (IntegrityError, DataError) as e:
+                self.logger.error(
+                    f"[_write_each] Dropping message of session "
+                    f"{row['session_id']}: {e}"
+                )
+            except Exception:
+                # Not this row's fault (e.g. the database is down): put the
+                # rest back and let _run retry later
+                with self._lock:
+                    self._queue = rows[position:] + self._queue
+                    self._in_flight = []
+                raise
+
+    def shutdown(self, timeout=10):
+        if self._stopped.is_set():
+            return
+        self._stopped.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+        while True:
+            try:
+                if not self.flush():
+                    break
+            except Exception:
+                break
+
+        with self._lock:
+            remaining = len(self._queue)
+        if remaining:
+            self.logger.error(f"[shutdown] {remaining} chat messages were not written")
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                while self.flush() >= self.max_batch:
+                    pass
+            except Exception:
+                self._stopped.wait(self.flush_interval)
+
+
+message_buffer = ChatMessageWriteBuffer(
+    max_batch=int(os.getenv("CHAT_WRITE_BUFFER_MAX_BATCH", "100")),
+    flush_interval=float(os.getenv("CHAT_WRITE_BUFFER_FLUSH_SECONDS", "0.5")),
+    max_queue=int(os.getenv("CHAT_WRITE_BUFFER_MAX_QUEUE", "10000")),
+)
+
+
+def write_behind_enabled():
+    return os.getenv("CHAT_WRITE_BEHIND_ENABLED", "true").lower() in ("1", "true")
@@ -1,4 +1,9 @@
-CHATBOT_RESPONSE_PROMPT = """
+from modules.shared.services.prompt_cache import CACHE_BREAK
+
+# Fixed rules, then the context retrieved for the message (often the same
+# chunks for follow-up questions), then the history, which grows every turn
+CHATBOT_RESPONSE_PROMPT = (
+    """
 You are an expert AI assistant that answers questions by carefully using ONLY the information provided in the context and chat history below.
 
 Please follow these rules when answering:
@@ -13,10 +18,14 @@ Please follow these rules when answering:
    - Generate quiz questions ONLY from the provided Context.
    - Clearly format them as Q1, Q2, Q3... with multiple-choice options (A, B, C, D).
    - Provide the correct answer(s) at the end under "Answer Key".
-
+"""
+    + CACHE_BREAK
+    + """
 Relevant context:
 {context}
-
+"""
+    + CACHE_BREAK
+    + """
 Chat history:
 {history}
 
@@ -24,3 +33,28 @@ Provide the best possible answer based on the context and history.
 User message: {message}
 Answer:
 """
+)
+
+HISTORY_SUMMARY_PROMPT = (
+    """
+You are maintaining a running summary of a conversation between a User and an AI Assistant.
+The summary replaces the original messages in later prompts, so keep everything needed to continue the conversation.
+
+Please follow these rules:
+1. Keep the topics the User asked about, the key facts given in the answers, and any open questions.
+2. If the Assistant produced a quiz, keep only its topic and the answer key, not the full questions.
+3. Do not add information that is not in the previous summary or the new messages.
+4. Write plain sentences, no more than {max_words} words.
+5. Respond with the summary only.
+"""
+    + CACHE_BREAK
+    + """
+Previous summary:
+{summary}
+
+New messages:
+{messages}
+
+Updated summary:
+"""
+)
@@ -13,3 +13,8 @@ def register_chatbot_routes(app):
         view_func=controller.chatbot_message_stream_controller,
         methods=["GET"],  # GET works better with EventSource
     )
+    app.add_url_rule(
+        "/chatbot/cache_stats",
+        view_func=controller.chatbot_cache_stats_controller,
+        methods=["GET"],
+    )
@@ -1,7 +1,26 @@
+import os
+import asyncio
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 from extensions import db, get_logger
 from langdetect import detect
-from modules.shared.services.bedrock import BedrockService
+from modules.shared.services.bedrock import BedrockService, model_chain
+from modules.shared.services.bedrock_async import AsyncBedrockService
+from modules.shared.services.bedrock_scheduler import INTERACTIVE
 from modules.chatbot.prompts import CHATBOT_RESPONSE_PROMPT
+from modules.chatbot.vector_index import hot_vector_index, hot_vector_index_enabled
+from modules.chatbot.hybrid_retriever import hybrid_retriever
+from modules.chatbot.answer_cache import answer_cache
+from modules.chatbot.message_buffer import message_buffer
+from modules.chatbot.history_cache import history_cache
+from modules.chatbot.context_packer import context_packer
+from modules.shared.services.concurrency import (
+    run_in_app_context,
+    submit_with_app_context,
+)
+from modules.shared.services.timing import StageTimer
 from modules.document.entity import (
     DocumentChunks,
     ChatMessage,
@@ -11,10 +30,43 @@ from modules.document.entity import (
     Documents,
 )
 
+RETRIEVAL_MODE = os.getenv("CHAT_RETRIEVAL_MODE", "vector")
+RETRIEVAL_CANDIDATES = int(os.getenv("CHAT_RETRIEVAL_CANDIDATES", "20"))
+
+# Answer models, tried in order within the latency budget of a turn. Answers
+# and query embeddings are hedged: a second request is sent when the first is
+# slower than the model's p95.
+CHAT_MODEL_CHAIN = model_chain(
+    os.getenv("CHAT_MODEL_CHAIN", "amazon.nova-pro-v1:0,amazon.nova-lite-v1:0")
+)
+CHAT_STREAM_MODEL_CHAIN = model_chain(
+    os.getenv(
+        "CHAT_STREAM_MODEL_CHAIN",
+        "anthropic.claude-3-5-sonnet-20240620-v1:0,anthropic.claude-3-haiku-20240307-v1:0",
+    )
+)
+CHAT_LATENCY_BUDGET_SECONDS = float(os.getenv("CHAT_LATENCY_BUDGET_SECONDS", "20"))
+CHAT_EMBEDDING_TIMEOUT_SECONDS = float(os.getenv("CHAT_EMBEDDING_TIMEOUT_SECONDS", "5"))
+CHAT_HEDGE_ENABLED = os.getenv("CHAT_HEDGE_ENABLED", "true").lower() == "true"
+
+_io_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("CHAT_IO_WORKERS", "16")),
+    thread_name_prefix="chat-io",
+)
+
+# Shared by the async handlers of every request; it holds the connection
+# pool of each event loop
+async_bedrock = AsyncBedrockService(priority=INTERACTIVE)
+
+# A chat session never changes owner, so its organization can be cached.
+_session_org_ids = OrderedDict()
+_session_org_lock = threading.Lock()
+_SESSION_ORG_CACHE_SIZE = 10000
+
 
 class ChatbotService:
     def __init__(self):
-        self.bedrock = BedrockService()
+        self.bedrock = BedrockService(priority=INTERACTIVE)
         self.logger = get_logger()
 
     def validate_request(self, data):
@@ -24,15 +76,28 @@ class ChatbotService:
             return False, "Missing required fields: session_id, message"
         return True, None
 
-    def save_message(self, session_id, message, sender):
-        msg = ChatMessage(
-            message=message,
-            sender=sender,
-            session_id=session_id,
+    def save_message(self, session_id, message, sender, created_at=None):
+        row = message_buffer.add(session_id, message, sender, created_at)
+        history_cache.append(row["session_id"], sender, message, row["created_at"])
+        return ChatMessage(**row)
+
+    def save_turn(self, session_id, user_message, user_sent_at, response_text):
+        messages = [self.save_message(session_id, user_message, "User", user_sent_at)]
+        if isinstance(response_text, str) and response_text.strip():
+            messages.append(self.save_message(session_id, response_text, "Assistant"))
+        return messages
+
+    def message_version(self, session_id):
+        # Stored message version of the session plus the messages still
+        # waiting in this process's write buffer, as seen by history_cache
+        return message_buffer.version(session_id, self._stored_message_version)
+
+    def _stored_message_version(self, session_id):
+        return (
+            db.session.query(ChatSession.message_version)
+            .filter(ChatSession.id == session_id)
+            .scalar()
         )
-        db.session.add(msg)
-        db.session.commit()
-        return msg
 
     def get_chat_history(self, session_id, limit=10):
         history = (
@@ -41,12 +106,24 @@ class ChatbotService:
             .limit(limit)
             .all()
         )
-        return list(reversed(history))
+
+        # Messages still waiting in the write-behind buffer are newer than
+        # anything committed; a batch committed while we were querying may
+        # show up in both, so drop those duplicates.
+        seen = {(msg.sender, msg.message, msg.created_at) for msg in history}
+        pending = [
+            ChatMessage(**row)
+            for row in message_buffer.pending(session_id)
+            if (row["sender"], row["message"], row["created_at"]) not in seen
+        ]
+
+        merged = sorted(list(reversed(history)) + pending, key=lambda m: m.created_at)
+        return merged[-limit:]
 
     def detect_language(self, text: str) -> str:
         try:
             lang = detect(text)
-            print(f"Detected language: {lang}")
+            self.logger.debug(f"[detect_language] Detected language: {lang}")
         except:
             lang = "en"
 
@@ -58,19 +135,72 @@ class ChatbotService:
             return "en"
 
     def get_user_org_id_from_session(self, session_id: int):
-        return (
+        with _session_org_lock:
+            if session_id in _session_org_ids:
+                _session_org_ids.move_to_end(session_id)
+                return _session_org_ids[session_id]
+
+        org_id = (
             db.session.query(User.organization_id)
             .join(ChatSession, ChatSession.user_id == User.id)
             .filter(ChatSession.id == session_id)
             .scalar()
         )
 
-    def retrieve_similar_chunks(self, embedding, session_id, lang="en", top_k=10):
+        if org_id is not None:
+            with _session_org_lock:
+                _session_org_ids[session_id] = org_id
+                if len(_session_org_ids) > _SESSION_ORG_CACHE_SIZE:
+                    _session_org_ids.popitem(last=False)
+        return org_id
+
+    def retrieve_similar_chunks(
+        self, embedding, session_id, lang="en", top_k=10, query_text=None, mode=None
+    ):
+        mode = mode or RETRIEVAL_MODE
+        if mode not in ("vector", "hybrid"):
+            raise ValueError(f"Unsupported retrieval mode: {mode}")
+
         user_org_id = self.get_user_org_id_from_session(session_id)
-        print(f"User organization ID: {user_org_id}")
+        self.logger.debug(
+            f"[retrieve_similar_chunks] Organization of session {session_id}: {user_org_id}"
+        )
         if not user_org_id:
             return []
 
+        if mode == "hybrid" and query_text:
+            chunk_ids = hybrid_retriever.retrieve(
+                user_org_id,
+                lang,
+                query_text,
+                lambda limit: self._vector_search_ids(
+                    user_org_id, lang, embedding, limit
+                ),
+                top_k=top_k,
+            )
+            return self._load_chunks_in_order(chunk_ids)
+
+        if hot_vector_index_enabled():
+            matches = hot_vector_index.search(user_org_id, lang, embedding, top_k)
+            if matches is not None:
+                return self._load_chunks_in_order([chunk_id for chunk_id, _ in matches])
+
+        return self._pgvector_query(user_org_id, lang, embedding, top_k).all()
+
+    def _vector_search_ids(self, user_org_id, lang, embedding, top_k):
+        if hot_vector_index_enabled():
+            matches = hot_vector_index.search(user_org_id, lang, embedding, top_k)
+            if matches is not None:
+                return [chunk_id for chunk_id, _ in matches]
+
+        rows = (
+            self._pgvector_query(user_org_id, lang, embedding, top_k)
+            .with_entities(DocumentChunks.id)
+            .all()
+        )
+        return [row.id for row in rows]
+
+    def _pgvector_query(self, user_org_id, lang, embedding, top_k):
         embedding_column = {
             "en": DocumentChunks.embeddings_en,
             "fr": DocumentChunks.embeddings_fr,
@@ -84,58 +214,155 @@ class ChatbotService:
             .filter(Courses.organizationId == user_org_id)
             .order_by(embedding_column.op("<=>")(embedding))
             .limit(top_k)
-            .all()
         )
 
-    def generate_response(self, message, history, retrieved_chunks):
-        context_text = "\n".join(chunk.text_en for chunk in retrieved_chunks)
-        history_text = "\n".join(f"{msg.sender}: {msg.message}" for msg in history)
+    def _load_chunks_in_order(self, chunk_ids):
+        if not chunk_ids:
+            return []
+        chunks = DocumentChunks.query.filter(DocumentChunks.id.in_(chunk_ids)).all()
+        by_id = {chunk.id: chunk for chunk in chunks}
+        return [by_id[chunk_id] for chunk_id in chunk_ids if chunk_id in by_id]
 
-        prompt = CHATBOT_RESPONSE_PROMPT.format(
-            context=context_text, history=history_text, message=message
+    def build_prompt(self, message, history, context_text):
+        return CHATBOT_RESPONSE_PROMPT.format(
+            context=context_text,
+            history=history_cache.render(history),
+            message=message,
         )
 
-        print("Generated prompt:", prompt)
+    def generate_response(self, message, history, context_text):
+        prompt = self.build_prompt(message, history, context_text)
+        return self.bedrock.invoke_model_with_texttt(
+            prompt,
+            model_id=CHAT_MODEL_CHAIN,
+            timeout=CHAT_LATENCY_BUDGET_SECONDS,
+            hedge=CHAT_HEDGE_ENABLED,
+        )
 
-        return self.bedrock.invoke_model_with_texttt(prompt)
+    def embed_message(self, message):
+        return self.bedrock.generate_embedding(
+            message,
+            timeout=CHAT_EMBEDDING_TIMEOUT_SECONDS,
+            hedge=CHAT_HEDGE_ENABLED,
+        )
 
-    def handle_message(self, session_id, message):
-        self.save_message(session_id, message, "User")
-        lang = self.detect_language(message)
-        embedding = self.bedrock.generate_embedding(message)
-        history = self.get_chat_history(session_id)
-        retrieved_chunks = self.retrieve_similar_chunks(
-            embedding, session_id, lang=lang
-        )
-        response_text = self.generate_response(message, history, retrieved_chunks)
-        self.save_message(session_id, response_text, "Assistant")
-        return response_text
+    def _prepare_turn(self, session_id, message, timer):
+        # Embedding, history and organization lookups are independent I/O, so
+        # they run concurrently while language detection runs here.
+        embedding_future = _io_executor.submit(
+            timer.timed("embedding", self.embed_message), message
+        )
+        history_future = submit_with_app_context(
+            _io_executor,
+            timer.timed("history", history_cache.get),
+            session_id,
+            self.get_chat_history,
+            self.message_version,
+        )
+        org_future = submit_with_app_context(
+            _io_executor,
+            timer.timed("org_lookup", self.get_user_org_id_from_session),
+            session_id,
+        )
 
-    def handle_message_stream(self, session_id, message):
-        self.save_message(session_id, message, "User")
+        with timer.stage("detect_language"):
+            lang = self.detect_language(message)
 
-        lang = self.detect_language(message)
-        embedding = self.bedrock.generate_embedding(message)
+        embedding = embedding_future.result()
+        history = history_future.result()
+        user_org_id = org_future.result()
 
-        history = self.get_chat_history(session_id)
-        retrieved_chunks = self.retrieve_similar_chunks(
-            embedding, session_id, lang=lang
+        context_text, chunk_ids = self._retrieve_context(
+            embedding, session_id, lang, message, timer
         )
+        return lang, embedding, history, user_org_id, context_text, chunk_ids
 
-        context_text = "\n".join(chunk.text_en for chunk in retrieved_chunks)
-        history_text = "\n".join(f"{msg.sender}: {msg.message}" for msg in history)
-        prompt = CHATBOT_RESPONSE_PROMPT.format(
-            context=context_text, history=history_text, message=message
-        )
-        self.logger.info(f"Generated prompt: {prompt}")
+    def _retrieve_context(self, embedding, session_id, lang, message, timer):
+        with timer.stage("retrieval"):
+            retrieved_chunks = self.retrieve_similar_chunks(
+                embedding,
+                session_id,
+                lang=lang,
+                top_k=RETRIEVAL_CANDIDATES,
+                query_text=message,
+            )
+
+        with timer.stage("context_packing"):
+            context_text, packed_chunks = context_packer.pack(
+                embedding, retrieved_chunks, lang
+            )
+        return context_text, [chunk.id for chunk in packed_chunks]
+
+    def handle_message(self, session_id, message):
+        timer = StageTimer()
+        user_sent_at = datetime.utcnow()
+        response_text = None
+        try:
+            lang, embedding, history, user_org_id, context_text, chunk_ids = (
+                self._prepare_turn(session_id, message, timer)
+            )
 
-        response_chunks = list(self.bedrock.invoke_model_with_stream(prompt))
-        full_response = "".join(response_chunks)
+            with timer.stage("answer_cache"):
+                response_text = answer_cache.lookup(
+                    user_org_id, lang, embedding, chunk_ids
+                )
+            if response_text is None:
+                with timer.stage("generation"):
+                    response_text = self.generate_response(
+                        message, history, context_text
+                    )
+                if response_text:
+                    answer_cache.store(
+                        user_org_id, lang, embedding, chunk_ids, response_text
+                    )
+        finally:
+            with timer.stage("persist"):
+                self.save_turn(session_id, message, user_sent_at, response_text)
+            self.logger.info(
+                f"[handle_message] Session {session_id} latency: {timer.summary()}"
+            )
 
-        self.logger.info(f"[Full Assistant Response] {full_response}")
+        return response_text
+
+    def handle_message_stream(self, session_id, message):
+        timer = StageTimer()
+        user_sent_at = datetime.utcnow()
+        full_response = ""
+        try:
+            lang, embedding, history, user_org_id, context_text, chunk_ids = (
+                self._prepare_turn(session_id, message, timer)
+            )
+
+            with timer.stage("answer_cache"):
+                cached_response = answer_cache.lookup(
+                    user_org_id, lang, embedding, chunk_ids
+                )
+            if cached_response is not None:
+                response_chunks = [cached_response]
+            else:
+                prompt = self.build_prompt(message, history, context_text)
+                self.logger.info(f"Generated prompt: {prompt}")
 
-        if full_response.strip():
-            self.save_message(session_id, full_response, "Assistant")
+                with timer.stage("generation"):
+                    response_chunks = list(
+                        self.bedrock.invoke_model_with_stream(
+                            prompt, model_id=CHAT_STREAM_MODEL_CHAIN
+                        )
+                    )
+            full_response = "".join(response_chunks)
+
+            self.logger.info(f"[Full Assistant Response] {full_response}")
+
+            if cached_response is None and full_response.strip():
+                answer_cache.store(
+                    user_org_id, lang, embedding, chunk_ids, full_response
+                )
+        finally:
+            with timer.stage("persist"):
+                self.save_turn(session_id, message, user_sent_at, full_response)
+            self.logger.info(
+                f"[handle_message_stream] Session {session_id} latency: {timer.summary()}"
+            )
 
         def generate():
             for chunk in response_chunks:
@@ -143,3 +370,167 @@ class ChatbotService:
             yield "data: [END]\n\n"
 
         return generate()
+
+    # Async handlers, for event-loop serving (see async_app.py). Bedrock calls
+    # are awaited on the loop; database work runs on the I/O executor in an
+    # application context of `app`.
+
+    async def _prepare_turn_async(self, app, session_id, message, timer):
+        async def embed():
+            with timer.stage("embedding"):
+                return await async_bedrock.generate_embedding(
+                    message,
+                    timeout=CHAT_EMBEDDING_TIMEOUT_SECONDS,
+                    hedge=CHAT_HEDGE_ENABLED,
+                )
+
+        embedding_task = asyncio.ensure_future(embed())
+        history_future = run_in_app_context(
+            app,
+            _io_executor,
+            timer.timed("history", history_cache.get),
+            session_id,
+            self.get_chat_history,
+            self.message_version,
+        )
+        org_future = run_in_app_context(
+            app,
+            _io_executor,
+            timer.timed("org_lookup", self.get_user_org_id_from_session),
+            session_id,
+        )
+
+        with timer.stage("detect_language"):
+            lang = self.detect_language(message)
+
+        embedding, history, user_org_id = await asyncio.gather(
+            embedding_task, history_future, org_future
+        )
+
+        context_text, chunk_ids = await run_in_app_context(
+            app,
+            _io_executor,
+            self._retrieve_context,
+            embedding,
+            session_id,
+            lang,
+            message,
+            timer,
+        )
+        return lang, embedding, history, user_org_id, context_text, chunk_ids
+
+    async def handle_message_async(self, app, session_id, message):
+        timer = StageTimer()
+        user_sent_at = datetime.utcnow()
+        response_text = None
+        try:
+            lang, embedding, history, user_org_id, context_text, chunk_ids = (
+                await self._prepare_turn_async(app, session_id, message, timer)
+            )
+
+            response_text = await run_in_app_context(
+                app,
+                _io_executor,
+                timer.timed("answer_cache", answer_cache.lookup),
+                user_org_id,
+                lang,
+                embedding,
+                chunk_ids,
+            )
+            if response_text is None:
+                prompt = self.build_prompt(message, history, context_text)
+                with timer.stage("generation"):
+                    response_text = await async_bedrock.invoke_model_with_texttt(
+                        prompt,
+                        model_id=CHAT_MODEL_CHAIN,
+                        timeout=CHAT_LATENCY_BUDGET_SECONDS,
+                        hedge=CHAT_HEDGE_ENABLED,
+                    )
+                if response_text:
+                    await run_in_app_context(
+                        app,
+                        _io_executor,
+                        answer_cache.store,
+                        user_org_id,
+                        lang,
+                        embedding,
+                        chunk_ids,
+                        response_text,
+                    )
+        finally:
+            await run_in_app_context(
+                app,
+                _io_executor,
+                timer.timed("persist", self.save_turn),
+                session_id,
+                message,
+                user_sent_at,
+                response_text,
+            )
+            self.logger.info(
+                f"[handle_message_async] Session {session_id} latency: {timer.summary()}"
+            )
+
+        return response_text
+
+    async def handle_message_stream_async(self, app, session_id, message):
+        """
+        Async generator of the SSE events of a turn. Unlike
+        handle_message_stream, the answer is sent as it is generated.
+        """
+        timer = StageTimer()
+        user_sent_at = datetime.utcnow()
+        response_chunks = []
+        try:
+            lang, embedding, history, user_org_id, context_text, chunk_ids = (
+                await self._prepare_turn_async(app, session_id, message, timer)
+            )
+
+            cached_response = await run_in_app_context(
+                app,
+                _io_executor,
+                timer.timed("answer_cache", answer_cache.lookup),
+                user_org_id,
+                lang,
+                embedding,
+                chunk_ids,
+            )
+            if cached_response is not None:
+                response_chunks.append(cached_response)
+                yield f"data: {cached_response}\n\n"
+            else:
+                prompt = self.build_prompt(message, history, context_text)
+                with timer.stage("generation"):
+                    async for chunk in async_bedrock.stream_text(
+                        prompt, model_id=CHAT_STREAM_MODEL_CHAIN, max_tokens=1024
+                    ):
+                        response_chunks.append(chunk)
+                        yield f"data: {chunk}\n\n"
+
+                full_response = "".join(response_chunks)
+                if full_response.strip():
+                    await run_in_app_context(
+                        app,
+                        _io_executor,
+                        answer_cache.store,
+                        user_org_id,
+                        lang,
+                        embedding,
+                        chunk_ids,
+                        full_response,
+                    )
+            yield "data: [END]\n\n"
+        finally:
+            # Also runs when the client disconnects; the partial answer is kept
+            await run_in_app_context(
+                app,
+                _io_executor,
+                timer.timed("persist", self.save_turn),
+                session_id,
+                message,
+                user_sent_at,
+                "".join(response_chunks),
+            )
+            self.logger.info(
+                f"[handle_message_stream_async] Session {session_id} latency: {timer.summary()}"
+            )
@@ -0,0 +1,197 @@
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from extensions import db, get_logger
+from modules.document.entity import DocumentChunks, Documents, Courses
+from modules.shared.services.content_version import content_versions
+
+EMBEDDING_COLUMNS = {
+    "en": DocumentChunks.embeddings_en,
+    "fr": DocumentChunks.embeddings_fr,
+    "ar": DocumentChunks.embeddings_ar,
+}
+
+
+class OrganizationVectorIndex:
+    """Normalized float32 embeddings of one organization's chunks in one language."""
+
+    def __init__(self, ids, matrix, version):
+        self.ids = ids
+        self.matrix = matrix
+        self.version = version
+
+    @property
+    def nbytes(self):
+        return self.ids.nbytes + self.matrix.nbytes
+
+    def search(self, embedding, top_k):
+        if len(self.ids) == 0:
+            return []
+
+        query = np.array(embedding, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        if norm == 0:
+            return []
+        query /= norm
+
+        scores = self.matrix @ query
+        if top_k < len(scores):
+            candidates = np.argpartition(-scores, top_k - 1)[:top_k]
+        else:
+            candidates = np.arange(len(scores))
+        order = candidates[np.argsort(-scores[candidates], kind="stable")]
+
+        return [(int(self.ids[i]), float(scores[i])) for i in order]
+
+
+class HotVectorIndexCache:
+    """
+    Lazily loaded in-memory k-NN indexes keyed by organization and language.
+
+    An index is rebuilt when the organization's content version moves, and
+    whole organizations are evicted least-recently-used first once the total
+    size goes over `max_bytes`. An index that alone is over `max_bytes` is
+    not loaded again until the content version moves; searches in it return
+    None so the caller falls back to pgvector.
+    """
+
+    def __init__(self, max_bytes, versions=content_versions):
+        self.max_bytes = max_bytes
+        self.versions = versions
+        self.logger = get_logger("[HotVectorIndexCache]")
+        self._lock = threading.Lock()
+        self._load_locks = {}
+        self._organizations = OrderedDict()
+        # (organization_id, lang) -> content version whose index was too large
+        self._too_large = {}
+
+    def search(self, organization_id, lang, embedding, top_k=10):
+        index = self.get_index(organization_id, lang)
+        if index is None:
+            return None
+        return index.search(embedding, top_k)
+
+    def get_index(self, organization_id, lang):
+        version = self.versions.get(organization_id)
+
+        index = self._lookup(organization_id, lang, version)
+        if index is not None or self._is_too_large(organization_id, lang, version):
+            return index
+
+        with self._load_lock(organization_id, lang):
+            index = self._lookup(organization_id, lang, version)
+            if index is not None or self._is_too_large(organization_id, lang, version):
+                return index
+
+            index = self._load(organization_id, lang, version)
+            if index is None:
+                self.logger.warning(
+                    f"[get_index] Index for organization {organization_id} ({lang}) is "
+                    f"over the {self.max_bytes} byte cap; not caching version {version}"
+                )
+                with self._lock:
+                    self._too_large[(organization_id, lang)] = version
+                return None
+
+            self._store(organization_id, lang, index)
+            return index
+
+    def invalidate(self, organization_id=None):
+        with self._lock:
+            if organization_id is None:
+                self._organizations.clear()
+                self._too_large.clear()
+            else:
+                self._organizations.pop(organization_id, None)
+                for key in [
+                    key for key in self._too_large if key[0] == organization_id
+                ]:
+                    del self._too_large[key]
+
+    def _is_too_large(self, organization_id, lang, version):
+        with self._lock:
+            return self._too_large.get((organization_id, lang)) == version
+
+    def _lookup(self, organization_id, lang, version):
+        with self._lock:
+            indexes = self._organizations.get(organization_id)
+            if not indexes:
+                return None
+            index = indexes.get(lang)
+            if index is None or index.version != version:
+                return None
+            self._organizations.move_to_end(organization_id)
+            return index
+
+    def _store(self, organization_id, lang, index):
+        with self._lock:
+            indexes = self._organizations.setdefault(organization_id, {})
+            indexes[lang] = index
+            self._organizations.move_to_end(organization_id)
+
+            while self._total_bytes() > self.max_bytes and len(self._organizations) > 1:
+                evicted_id, _ = self._organizations.popitem(last=False)
+                self.logger.info(f"[_store] Evicted organization {evicted_id}")
+
+    def _total_bytes(self):
+        return sum(
+            index.nbytes
+            for indexes in self._organizations.values()
+            for index in indexes.values()
+        )
+
+    def _load_lock(self, organization_id, lang):
+        with self._lock:
+            return self._load_locks.setdefault(
+                (organization_id, lang), threading.Lock()
+            )
+
+    def _load(self, organization_id, lang, version):
+        # None once the vectors read so far are over max_bytes
+        embedding_column = EMBEDDING_COLUMNS[lang]
+        query = (
+            db.session.query(DocumentChunks.id, embedding_column)
+            .join(Documents, DocumentChunks.document_id == Documents.id)
+            .join(Courses, Documents.course_id == Courses.id)
+            .filter(Courses.organizationId == organization_id)
+            .filter(embedding_column.isnot(None))
+            .yield_per(2000)
+        )
+        rows = iter(query)
+
+        ids = []
+        vectors = []
+        nbytes = 0
+        for chunk_id, vector in rows:
+            ids.append(chunk_id)
+            vectors.append(vector)
+            nbytes += 8 + 4 * len(vector)
+            if nbytes > self.max_bytes:
+                rows.close()
+                return None
+
+        if vectors:
+            matrix = np.ascontiguousarray(np.vstack(vectors), dtype=np.float32)
+            norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+            norms[norms == 0] = 1.0
+            matrix /= norms
+        else:
+            matrix = np.empty((0, 0), dtype=np.float32)
+
+        self.logger.info(
+            f"[_load] Loaded {len(ids)} vectors for organization {organization_id} "
+            f"({lang}) at version {version}"
+        )
+        return OrganizationVectorIndex(np.asarray(ids, dtype=np.int64), matrix, version)
+
+
+hot_vector_index = HotVectorIndexCache(
+    max_bytes=int(os.getenv("CHAT_VECTOR_INDEX_MAX_MB", "512")) * 1024 * 1024
+)
+
+
+def hot_vector_index_enabled():
+    return os.getenv("CHAT_VECTOR_INDEX_ENABLED", "false").lower() in ("1", "true")
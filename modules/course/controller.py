@@ -1,11 +1,23 @@
-from flask import request, jsonify
-from modules.course.services import CourseGenerationService
+import json
+
+from flask import request, jsonify, Response
+from modules.course.pipeline import CourseGenerationPipeline
+from modules.course.services import CourseContentService, CourseGenerationService
+from modules.shared.services.response_cache import CachedResponse, response_cache
+from modules.shared.services.single_flight import coalesced_response
+from modules.shared.services.task_graph import FAILED, RUNNING, job_registry
 from modules.flashcard.service import FlashcardService
 from modules.question.service import QuestionService
 
 course_service = CourseGenerationService()
+course_content_service = CourseContentService()
 flashcard_service = FlashcardService()
 question_service = QuestionService()
+# Comment lines sent while a job has nothing new, so proxies keep the stream
+JOB_EVENTS_KEEPALIVE_SECONDS = 15
+generation_pipeline = CourseGenerationPipeline(
+    course_service, flashcard_service, question_service
+)
 
 
 def course_content_controller():
@@ -14,13 +26,138 @@ def course_content_controller():
     if not data or "course_id" not in data:
         return jsonify({"error": "Missing course_id"}), 400
 
-    course_id = data["course_id"]
+    try:
+        course_id = int(data["course_id"])
+    except (TypeError, ValueError):
+        return jsonify({"error": "course_id must be an integer"}), 400
+    # Only generate flashcards and questions from content added since the last run
+    incremental = bool(data.get("incremental", False))
+
+    def generate():
+        try:
+            job = generation_pipeline.start(course_id, incremental=incremental)
+            job.wait()
+        except Exception as e:
+            return {"error": str(e)}, 500
+
+        if job.status == FAILED:
+            # Failed stages can be retried through the job endpoints
+            return {"error": "Content generation failed", "job": job.as_dict()}, 500
+
+        return {
+            "status": "success",
+            "course_id": course_id,
+            "details": job.result("structure"),
+            "job": job.as_dict(),
+        }, 200
+
+    # A repeated click or client retry gets the response of the run in flight
+    return coalesced_response(
+        "generate_content",
+        {"course_id": course_id, "incremental": incremental},
+        generate,
+    )
+
+
+def generation_job_create_controller():
+    data = request.get_json()
+
+    if not data or "course_id" not in data:
+        return jsonify({"error": "Missing course_id"}), 400
 
     try:
-        result = course_service.generate_course_structure(course_id)
-        flashcard_service.generate_flashcard(course_id)
-        question_service.generate_question(course_id)
+        course_id = int(data["course_id"])
+    except (TypeError, ValueError):
+        return jsonify({"error": "course_id must be an integer"}), 400
 
-        return jsonify({"status": "success", "course_id": course_id, "details": result})
+    try:
+        job = generation_pipeline.start(
+            course_id, incremental=bool(data.get("incremental", False))
+        )
     except Exception as e:
         return jsonify({"error": str(e)}), 500
+
+    response = jsonify(job.as_dict())
+    response.status_code = 202
+    response.headers["Location"] = f"/generate_content/jobs/{job.id}"
+    return response
+
+
+def generation_job_status_controller(job_id):
+    job = job_registry.get(job_id)
+    if job is None:
+        return jsonify({"error": f"Job {job_id} not found"}), 404
+    return jsonify(job.as_dict(include_results=True))
+
+
+def generation_job_retry_controller(job_id, stage):
+    job = job_registry.get(job_id)
+    if job is None:
+        return jsonify({"error": f"Job {job_id} not found"}), 404
+
+    try:
+        job.retry(stage)
+    except KeyError:
+        return jsonify({"error": f"Stage {stage} not found in job {job_id}"}), 404
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 409
+
+    return jsonify(job.as_dict()), 202
+
+
+def course_content_read_controller(course_id):
+    lang = request.args.get("lang", "en")
+    if lang not in ("en", "fr", "ar"):
+        return jsonify({"error": "lang must be one of en, fr, ar"}), 400
+
+    scope = ("course_content", course_id)
+    cached = response_cache.get(scope, lang)
+    if cached is None:
+        generation = response_cache.generation(scope)
+        try:
+            content = course_content_service.get_course_content(course_id, lang)
+        except Exception as e:
+            return jsonify({"error": str(e)}), 500
+        if content is None:
+            return jsonify({"error": f"Course {course_id} not found"}), 404
+
+        cached = CachedResponse(json.dumps(content).encode("utf-8"))
+        response_cache.set(scope, lang, cached, generation=generation)
+
+    return cached.to_response(request)
+
+
+def generation_job_events_controller(job_id):
+    """
+    Server-sent events of a job, read-only: starting a job is a POST to
+    /generate_content/jobs. A reconnecting EventSource sends Last-Event-ID
+    and gets the events it missed; once it has seen the job finish it gets
+    204, which stops it from reconnecting.
+    """
+    job = job_registry.get(job_id)
+    if job is None:
+        return jsonify({"error": f"Job {job_id} not found"}), 404
+
+    after = request.headers.get("Last-Event-ID", 0, type=int)
+    seen = job.events(after, timeout=0)
+    if not seen and job.status != RUNNING:
+        return "", 204
+
+    def events():
+        last = after
+        while True:
+            batch = job.events(last, timeout=JOB_EVENTS_KEEPALIVE_SECONDS)
+            if not batch:
+                yield ": keepalive\n\n"
+                continue
+            for event_id, event, data in batch:
+                yield f"id: {event_id}\nevent: {event}\ndata: {json.dumps(data)}\n\n"
+            last = batch[-1][0]
+            if batch[-1][1] == "done":
+                return
+
+    return Response(
+        events(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
@@ -0,0 +1,181 @@
+import threading
+
+from extensions import get_logger
+from modules.document.entity import Modules
+from modules.shared.services.task_graph import Job, job_registry
+from modules.shared.services.watermarks import (
+    FLASHCARDS,
+    QUESTIONS,
+    latest_source_id,
+    set_watermark,
+)
+
+# What the stages of a job build once and share
+SHARED = ["chunks", "flashcard_deduplicator", "question_deduplicator"]
+
+
+class CourseGenerationPipeline:
+    """
+    Runs /generate_content as a job of stages instead of three sequential
+    steps: the flashcards and questions of a module start as soon as that
+    module is saved, while the model is still writing the next ones. Each
+    module is also emitted as a "module" event of the job once it is saved.
+
+    Stages:
+        structure             streams and saves the modules
+        flashcards:<module>   flashcards of one module
+        questions:<module>    questions from the sections of one module
+        flashcards:existing   flashcards of the modules saved by earlier runs
+        watermarks            once every other stage succeeded, records the
+                              chunks and paragraphs the run covered
+
+    The per-module stages leave the watermarks alone, so an incremental run
+    that fails part way is read again in full by the next one. They share
+    one load of the course chunks and one deduplicator per kind, built by
+    the first stage that needs it.
+    """
+
+    def __init__(self, course_service, flashcard_service, question_service):
+        self.logger = get_logger("[CourseGenerationPipeline]")
+        self.course_service = course_service
+        self.flashcard_service = flashcard_service
+        self.question_service = question_service
+        self._start_lock = threading.Lock()
+
+    def start(self, course_id, incremental=False):
+        """New job for the course, or the one already running for it."""
+        # Also the key of the course's cached responses, see response_cache
+        course_id = int(course_id)
+        params = {"course_id": course_id, "incremental": incremental}
+        with self._start_lock:
+            job = job_registry.find_running("generate_content", params)
+            if job is not None:
+                self.logger.info(
+                    f"[start] Course {course_id} joins running job {job.id}"
+                )
+                return job
+
+            job = Job("generate_content", params)
+            job_registry.add(job)
+            run = {
+                "modules": [],
+                "stages": [],
+                "locks": {name: threading.Lock() for name in SHARED},
+            }
+            job.add_stage(
+                "structure",
+                lambda job: self._structure(job, course_id, incremental, run),
+            )
+        self.logger.info(f"[start] Started job {job.id} for course {course_id}")
+        return job
+
+    def _structure(self, job, course_id, incremental, run):
+        # `run` outlives a failed attempt: a retry asks the model for the
+        # modules that follow the ones the earlier attempts saved
+        if "existing_module_ids" not in run:
+            run["existing_module_ids"] = [
+                module_id
+                for (module_id,) in Modules.query.with_entities(Modules.id)
+                .filter_by(course_id=course_id)
+                .all()
+            ]
+
+        for module in self.course_service.generate_course_structure_stream(
+            course_id, saved_titles=[module["module"] for module in run["modules"]]
+        ):
+            run["modules"].append(module)
+            job.emit("module", module)
+            module_id = module["module_id"]
+            section_ids = [section["section_id"] for section in module["sections"]]
+
+            self._add_stage(
+                job,
+                run,
+                f"flashcards:{module_id}",
+                lambda job, module_id=module_id: self._flashcards(
+                    course_id, [module_id], incremental, run
+                ),
+            )
+            if section_ids:
+                self._add_stage(
+                    job,
+                    run,
+                    f"questions:{module_id}",
+                    lambda job, section_ids=section_ids: self._questions(
+                        course_id, section_ids, incremental, run
+                    ),
+                )
+
+        # New chunks may belong to modules of earlier runs too
+        if run["existing_module_ids"]:
+            self._add_stage(
+                job,
+                run,
+                "flashcards:existing",
+                lambda job: self._flashcards(
+                    course_id, run["existing_module_ids"], incremental, run
+                ),
+            )
+        run[QUESTIONS] = latest_source_id(course_id, QUESTIONS)
+        job.add_stage(
+            "watermarks",
+            lambda job: self._watermarks(course_id, run),
+            deps=["structure"] + run["stages"],
+        )
+        return list(run["modules"])
+
+    def _add_stage(self, job, run, name, fn):
+        job.add_stage(name, fn)
+        run["stages"].append(name)
+
+    def _shared(self, run, name, create):
+        with run["locks"][name]:
+            if name not in run:
+                run[name] = create()
+        return run[name]
+
+    def _flashcards(self, course_id, module_ids, incremental, run):
+        service = self.flashcard_service
+        flashcards = service.generate_flashcard(
+            course_id,
+            incremental=incremental,
+            module_ids=module_ids,
+            chunks=self._shared(
+                run, "chunks", lambda: service.load_chunks(course_id, "en", incremental)
+            ),
+            deduplicator=self._shared(
+                run,
+                "flashcard_deduplicator",
+                lambda: service.flashcard_deduplicator(course_id),
+            ),
+        )
+        return {"flashcards": sum(len(cards) for cards in flashcards.values())}
+
+    def _questions(self, course_id, section_ids, incremental, run):
+        service = self.question_service
+        questions = service.generate_question(
+            course_id,
+            incremental=incremental,
+            section_ids=section_ids,
+            deduplicator=self._shared(
+                run,
+                "question_deduplicator",
+                lambda: service.question_deduplicator(course_id),
+            ),
+        )
+        return {"questions": len(questions)}
+
+    def _watermarks(self, course_id, run):
+        # The flashcard watermark stays below the shared chunks that matched
+        # no module of the course, like that of a run over the whole course
+        if "chunks" in run:
+            run[FLASHCARDS] = self.flashcard_service.course_watermark(
+                course_id, run["chunks"]
+            )
+        watermarks = {}
+        for kind in (FLASHCARDS, QUESTIONS):
+            if run.get(kind) is not None:
+                set_watermark(course_id, kind, run[kind])
+                watermarks[kind] = run[kind]
+        run.pop("chunks", None)
+        return watermarks
@@ -1,4 +1,9 @@
-GENERATE_MODULES_PROMPT = """
+from modules.shared.services.prompt_cache import CACHE_BREAK
+
+# Course settings and format first, then the retrieved content, then the
+# request, so a retried or repeated run of the course reuses the cached prefix
+_MODULES_PROMPT = (
+    """
 The course is titled '{title}' and has the following description: {description}.
 The intended difficulty level is '{level}', and the expected duration is '{duration}'.
 Based on the content below, split it into exactly {nb_of_modules} high-level modules.
@@ -19,9 +24,6 @@ Requirements:
 9. Avoid redundancy between sections or modules.
 10. Respond only in valid JSON. Do not include text outside the JSON array.
 
-Content:
-{content}
-
 Example JSON format:
 [
   {{
@@ -40,4 +42,24 @@ Example JSON format:
     ]
   }}
 ]
+"""
+    + CACHE_BREAK
+    + """
+Content:
+{content}
+"""
+    + CACHE_BREAK
+)
+
+GENERATE_MODULES_PROMPT = _MODULES_PROMPT + """
+Split the content above into the modules described, as a JSON array only.
+"""
+
+# A retry of a run that failed after saving some modules: the model only
+# writes the modules that follow them
+RESUME_MODULES_PROMPT = _MODULES_PROMPT + """
+The first {nb_of_saved} modules were already written, with these titles:
+{saved_titles}
+
+Write only the modules that follow them, as a JSON array only.
 """
@@ -8,3 +8,28 @@ def register_course_routes(app):
         view_func=controller.course_content_controller,
         methods=["POST"],
     )
+    app.add_url_rule(
+        "/generate_content/jobs",
+        view_func=controller.generation_job_create_controller,
+        methods=["POST"],
+    )
+    app.add_url_rule(
+        "/generate_content/jobs/<job_id>",
+        view_func=controller.generation_job_status_controller,
+        methods=["GET"],
+    )
+    app.add_url_rule(
+        "/generate_content/jobs/<job_id>/stages/<stage>/retry",
+        view_func=controller.generation_job_retry_controller,
+        methods=["POST"],
+    )
+    app.add_url_rule(
+        "/generate_content/jobs/<job_id>/events",
+        view_func=controller.generation_job_events_controller,
+        methods=["GET"],  # GET works with EventSource
+    )
+    app.add_url_rule(
+        "/courses/<int:course_id>/content",
+        view_func=controller.course_content_read_controller,
+        methods=["GET"],
+    )
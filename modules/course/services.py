@@ -1,6 +1,10 @@
-import json
+import os
+import queue
+import threading
+from sqlalchemy import insert
+from sqlalchemy.orm import load_only, selectinload
 from extensions import db, get_logger
-from modules.shared.services.bedrock import BedrockService
+from modules.shared.services.bedrock import BedrockService, model_chain
 from modules.shared.services.translation import TranslationService
 from modules.document.entity import (
     Documents,
@@ -9,8 +13,30 @@ from modules.document.entity import (
     Courses,
     Paragraphs,
     DocumentChunks,
+    FlashCards,
+    Questions,
 )
-from modules.course.prompts import GENERATE_MODULES_PROMPT
+from modules.course.prompts import GENERATE_MODULES_PROMPT, RESUME_MODULES_PROMPT
+from modules.shared.services.prompt_budget import PromptBudget
+from modules.shared.services.response_cache import response_cache
+from modules.shared.services.json_stream import iter_json_array
+
+COURSE_MODEL_ID = "anthropic.claude-3-sonnet-20240229-v1:0"
+COURSE_MAX_OUTPUT_TOKENS = 10000
+# Tried in order when COURSE_MODEL_ID fails before it starts answering
+COURSE_MODEL_CHAIN = [COURSE_MODEL_ID] + model_chain(
+    os.getenv("COURSE_FALLBACK_MODELS", "")
+)
+COURSE_CANDIDATE_CHUNKS = int(os.getenv("COURSE_CANDIDATE_CHUNKS", "1000"))
+# Largest structure prompt, retrieved content included. Well below the
+# model's window: the modules only need the gist of the course material, and
+# latency and cost grow with the input
+COURSE_CONTEXT_TOKENS = int(os.getenv("COURSE_CONTEXT_TOKENS", "30000"))
+
+
+def title_key(title):
+    """A module title compared without case or spacing differences."""
+    return " ".join(str(title).split()).casefold()
 
 
 class CourseGenerationService:
@@ -18,12 +44,11 @@ class CourseGenerationService:
         self.bedrock = BedrockService()
         self.logger = get_logger()
         self.translation_service = TranslationService()
-
-    def _translate_and_assign(self, text):
-        if not text:
-            return {"en": None, "fr": None, "ar": None}
-        en, fr, ar = self.translation_service.translate_to_all_languages(text)
-        return {"en": en, "fr": fr, "ar": ar}
+        self.prompt_budget = PromptBudget(
+            COURSE_MODEL_ID,
+            max_output_tokens=COURSE_MAX_OUTPUT_TOKENS,
+            max_input_tokens=COURSE_CONTEXT_TOKENS,
+        )
 
     # Course Retrieval
     def _get_course_details(self, course_id):
@@ -58,6 +83,7 @@ class CourseGenerationService:
     def _get_course_documents(self, course_id, embedding, top_k=10):
         chunks = (
             db.session.query(DocumentChunks)
+            .options(load_only(DocumentChunks.id, DocumentChunks.text_en))
             .join(Documents, DocumentChunks.document_id == Documents.id)
             .join(Courses, Documents.course_id == Courses.id)
             .filter(Courses.id == course_id)
@@ -71,8 +97,20 @@ class CourseGenerationService:
         # )
         return chunks
 
-    def _combine_course_content(self, documents):
-        combined_text = "\n".join(doc.text_en for doc in documents if doc.text_en)
+    def _combine_course_content(self, documents, course_info, saved_titles=()):
+        # Chunks arrive most similar first; keep as many as fit next to the
+        # rest of the prompt.
+        fixed_prompt = self._modules_prompt(course_info, "", saved_titles)
+        budget = self.prompt_budget.available(fixed_prompt)
+        selected = self.prompt_budget.pack(
+            [doc for doc in documents if doc.text_en],
+            text=lambda doc: doc.text_en,
+            budget=budget,
+        )
+        self.logger.info(
+            f"[_combine_course_content] Using {len(selected)}/{len(documents)} chunks within {budget} tokens"
+        )
+        combined_text = "\n".join(doc.text_en for doc in selected)
         # self.logger.info(
         #     f"[_combine_course_content] Combined course content: {combined_text[:500]}"
         # )
@@ -84,24 +122,9 @@ class CourseGenerationService:
         embedding = self.bedrock.generate_embedding(text_to_embed)
         return embedding
 
-    # Bedrock Call Wrapper
-    def bedrock_generate(self, prompt, max_tokens=10000, temperature=0.5):
-        # self.logger.info(f"Calling Bedrock with prompt: {prompt}")
-        try:
-            response = self.bedrock.invoke_model_streaming(
-                prompt,
-                model_id="anthropic.claude-3-sonnet-20240229-v1:0",
-                temperature=temperature,
-                max_tokens=max_tokens,
-            )
-            return json.loads(response)
-        except json.JSONDecodeError:
-            self.logger.error(f"Failed to decode JSON response: {response}")
-            return {}
-
     # Generators
-    def _call_bedrock_for_modules(self, course_info, course_text):
-        prompt = GENERATE_MODULES_PROMPT.format(
+    def _modules_prompt(self, course_info, course_text, saved_titles=()):
+        fields = dict(
             title=course_info["title"],
             description=course_info["description"],
             level=course_info["level"],
@@ -110,88 +133,319 @@ class CourseGenerationService:
             nb_of_sections=course_info["nb_of_sections"],
             content=course_text,
         )
+        if not saved_titles:
+            return GENERATE_MODULES_PROMPT.format(**fields)
+        return RESUME_MODULES_PROMPT.format(
+            **fields,
+            nb_of_saved=len(saved_titles),
+            saved_titles="\n".join(f"- {title}" for title in saved_titles),
+        )
 
-        # self.logger.info(f"Generated prompt for modules: {prompt}")
-        modules_data = self.bedrock_generate(prompt)
+    def _stream_modules(self, prompt):
+        # The model call and JSON parsing run on a producer thread, so the
+        # caller can translate and save a module while the next ones are
+        # still being generated.
+        modules = queue.Queue()
+        stop = threading.Event()
 
-        if not isinstance(modules_data, list) or len(modules_data) == 0:
-            self.logger.error("Bedrock did not return valid modules")
-            return []
-        return modules_data
+        def produce():
+            try:
+                stream = self.bedrock.stream_text(
+                    prompt,
+                    model_id=COURSE_MODEL_CHAIN,
+                    temperature=0.5,
+                    max_tokens=COURSE_MAX_OUTPUT_TOKENS,
+                )
+                for module_data in iter_json_array(stream):
+                    if stop.is_set():
+                        return
+                    modules.put(("module", module_data))
+                modules.put(("done", None))
+            except Exception as e:
+                modules.put(("error", e))
 
-    # Course Structure Generation
+        threading.Thread(target=produce, name="course-modules", daemon=True).start()
+        try:
+            while True:
+                kind, value = modules.get()
+                if kind == "error":
+                    raise value
+                if kind == "done":
+                    return
+                yield value
+        finally:
+            stop.set()
 
     # Course Structure Generation
     def generate_course_structure(self, course_id):
+        return list(self.generate_course_structure_stream(course_id))
 
+    def generate_course_structure_stream(self, course_id, saved_titles=()):
+        """
+        Generate the course's modules, yielding each one once it is saved.
+        `saved_titles` are the modules an interrupted run already saved: the
+        model is asked for the ones that follow, and a module it writes again
+        under the same title is not saved twice.
+        """
         course_info = self._get_course_details(course_id)
         embeddings = self._embed_course_info(course_info)
-        chunks = self._get_course_documents(course_id, embeddings, top_k=10)
-        course_text = self._combine_course_content(chunks)
+        chunks = self._get_course_documents(
+            course_id, embeddings, top_k=COURSE_CANDIDATE_CHUNKS
+        )
+        course_text = self._combine_course_content(chunks, course_info, saved_titles)
 
         # Step 1: Generate modules + sections + paragraphs
-        modules_data = self._call_bedrock_for_modules(course_info, course_text)
-        self.logger.info(
-            f"[generate_course_structure] Generated modules data: {modules_data}"
-        )
+        prompt = self._modules_prompt(course_info, course_text, saved_titles)
+
+        # Step 2: Save modules, sections, paragraphs as they arrive
+        skip = {title_key(title) for title in saved_titles}
+        saved = skipped = 0
+        for module_data in self._stream_modules(prompt):
+            if not isinstance(module_data, dict) or "title" not in module_data:
+                self.logger.warning(
+                    f"[generate_course_structure] Skipping invalid module: {module_data}"
+                )
+                continue
 
-        results = []
+            if title_key(module_data["title"]) in skip:
+                skipped += 1
+                self.logger.info(
+                    f"[generate_course_structure] Skipping module already saved: {module_data['title']}"
+                )
+                continue
 
-        # Step 2: Save modules, sections, paragraphs
-        for module_data in modules_data:
-            titles = self._translate_and_assign(module_data["title"])
-            module_entity = Modules(
-                title_en=titles["en"],
-                title_fr=titles["fr"],
-                title_ar=titles["ar"],
-                course_id=course_id,
+            self.logger.info(
+                f"[generate_course_structure] Generated module: {module_data['title']}"
             )
-            db.session.add(module_entity)
-            db.session.flush()
+            result = self._save_module(course_id, module_data)
+            saved += 1
+            yield result
+
+        if not saved and not skipped:
+            self.logger.error("Bedrock did not return valid modules")
 
-            sections_list = []
-            for section in module_data.get("sections", []):
-                titles = self._translate_and_assign(section["title"])
-                section_entity = Sections(
+    def _save_module(self, course_id, module_data):
+        # Every string of the module is translated in one concurrent pass,
+        # then each level is inserted with a single statement that returns the
+        # ids the next level needs, all in one transaction.
+        sections = module_data.get("sections", [])
+        strings = [module_data["title"]]
+        for section in sections:
+            strings.append(section["title"])
+            for para in section.get("paragraphs", []):
+                strings.extend([para["content_title"], para["content_body"]])
+        translations = self.translation_service.translate_many(strings)
+        empty = {"en": None, "fr": None, "ar": None}
+
+        def translated(text):
+            return translations.get(text, empty) if text else empty
+
+        try:
+            titles = translated(module_data["title"])
+            module_id = db.session.execute(
+                insert(Modules)
+                .values(
                     title_en=titles["en"],
                     title_fr=titles["fr"],
                     title_ar=titles["ar"],
-                    module_id=module_entity.id,
+                    course_id=course_id,
                 )
-                db.session.add(section_entity)
-                db.session.flush()
+                .returning(Modules.id)
+            ).scalar_one()
 
-                paragraphs_list = []
+            section_ids = []
+            if sections:
+                section_ids = (
+                    db.session.execute(
+                        insert(Sections).returning(
+                            Sections.id, sort_by_parameter_order=True
+                        ),
+                        [
+                            {
+                                "title_en": translated(section["title"])["en"],
+                                "title_fr": translated(section["title"])["fr"],
+                                "title_ar": translated(section["title"])["ar"],
+                                "module_id": module_id,
+                            }
+                            for section in sections
+                        ],
+                    )
+                    .scalars()
+                    .all()
+                )
+
+            paragraph_rows = []
+            for section_id, section in zip(section_ids, sections):
                 for para in section.get("paragraphs", []):
-                    content_titles = self._translate_and_assign(para["content_title"])
-                    content_bodyy = self._translate_and_assign(para["content_body"])
-                    paragraph_entity = Paragraphs(
-                        content_title_en=content_titles["en"],
-                        content_body_en=content_bodyy["en"],
-                        content_title_fr=content_titles["fr"],
-                        content_body_fr=content_bodyy["fr"],
-                        content_title_ar=content_titles["ar"],
-                        content_body_ar=content_bodyy["ar"],
-                        section_id=section_entity.id,
+                    content_titles = translated(para["content_title"])
+                    content_bodyy = translated(para["content_body"])
+                    paragraph_rows.append(
+                        {
+                            "content_title_en": content_titles["en"],
+                            "content_body_en": content_bodyy["en"],
+                            "content_title_fr": content_titles["fr"],
+                            "content_body_fr": content_bodyy["fr"],
+                            "content_title_ar": content_titles["ar"],
+                            "content_body_ar": content_bodyy["ar"],
+                            "section_id": section_id,
+                        }
                     )
-                    db.session.add(paragraph_entity)
-                    db.session.flush()
+            if paragraph_rows:
+                db.session.execute(insert(Paragraphs), paragraph_rows)
+
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
 
-                    paragraphs_list.append(
+        response_cache.invalidate(("course_content", int(course_id)))
+        self.logger.info(
+            f"[_save_module] Saved module {module_id} with {len(section_ids)} sections, "
+            f"{len(paragraph_rows)} paragraphs ({len(translations)} distinct strings translated)"
+        )
+        return {
+            "module_id": module_id,
+            "module": module_data["title"],
+            "sections": [
+                {
+                    "section_id": section_id,
+                    "title": section["title"],
+                    "paragraphs": [
                         {
                             "content_title": para["content_title"],
                             "content_body": para["content_body"],
                         }
-                    )
+                        for para in section.get("paragraphs", [])
+                    ],
+                }
+                for section_id, section in zip(section_ids, sections)
+            ],
+        }
+
+
+class CourseContentService:
+    def __init__(self):
+        self.logger = get_logger("[CourseContentService]")
+
+    def get_course_content(self, course_id, lang="en"):
+        """
+        The course tree (modules, sections, paragraphs, flashcards) and its
+        questions in one language, or None if the course does not exist.
+        Each level is fetched with one selectin query, loading only the
+        requested language's columns.
+        """
 
-                sections_list.append(
-                    {
-                        "title": section["title"],
-                        "paragraphs": paragraphs_list,
-                    }
+        def localized(model, *names):
+            return [getattr(model, f"{name}_{lang}") for name in names]
+
+        modules = selectinload(Courses.modules).load_only(
+            Modules.id, Modules.course_id, *localized(Modules, "title")
+        )
+        course = (
+            Courses.query.options(
+                load_only(
+                    Courses.id,
+                    Courses.title,
+                    Courses.description,
+                    Courses.level,
+                    Courses.duration,
+                ),
+                modules.selectinload(Modules.sections)
+                .load_only(
+                    Sections.id, Sections.module_id, *localized(Sections, "title")
                 )
+                .selectinload(Sections.paragraphs)
+                .load_only(
+                    Paragraphs.id,
+                    Paragraphs.section_id,
+                    *localized(Paragraphs, "content_title", "content_body"),
+                ),
+                modules.selectinload(Modules.flashcards).load_only(
+                    FlashCards.id,
+                    FlashCards.module_id,
+                    FlashCards.difficulty,
+                    *localized(FlashCards, "question", "answer"),
+                ),
+                selectinload(Courses.questions).load_only(
+                    Questions.id,
+                    Questions.course_id,
+                    *localized(
+                        Questions,
+                        "question_text",
+                        "option1",
+                        "option2",
+                        "option3",
+                        "correct_answer",
+                        "explanation",
+                    ),
+                ),
+            )
+            .filter_by(id=course_id)
+            .first()
+        )
+        if course is None:
+            return None
+
+        def by_id(rows):
+            return sorted(rows, key=lambda row: row.id)
 
-            results.append({"module": module_data["title"], "sections": sections_list})
+        def text(row, name):
+            return getattr(row, f"{name}_{lang}")
 
-        db.session.commit()
-        return results
+        content = {
+            "id": course.id,
+            "lang": lang,
+            "title": course.title,
+            "description": course.description,
+            "level": course.level,
+            "duration": course.duration,
+            "modules": [
+                {
+                    "id": module.id,
+                    "title": text(module, "title"),
+                    "sections": [
+                        {
+                            "id": section.id,
+                            "title": text(section, "title"),
+                            "paragraphs": [
+                                {
+                                    "id": paragraph.id,
+                                    "title": text(paragraph, "content_title"),
+                                    "body": text(paragraph, "content_body"),
+                                }
+                                for paragraph in by_id(section.paragraphs)
+                            ],
+                        }
+                        for section in by_id(module.sections)
+                    ],
+                    "flashcards": [
+                        {
+                            "id": card.id,
+                            "difficulty": card.difficulty,
+                            "question": text(card, "question"),
+                            "answer": text(card, "answer"),
+                        }
+                        for card in by_id(module.flashcards)
+                    ],
+                }
+                for module in by_id(course.modules)
+            ],
+            "questions": [
+                {
+                    "id": question.id,
+                    "question": text(question, "question_text"),
+                    "options": [
+                        text(question, "option1"),
+                        text(question, "option2"),
+                        text(question, "option3"),
+                    ],
+                    "correct_answer": text(question, "correct_answer"),
+                    "explanation": text(question, "explanation"),
+                }
+                for question in by_id(course.questions)
+            ],
+        }
+        self.logger.info(
+            f"[get_course_content] Course {course_id} ({lang}): {len(content['modules'])} modules, {len(content['questions'])} questions"
+        )
+        return content
@@ -2,6 +2,7 @@ from flask import request, jsonify
 from modules.document.services import DocumentProcessingService
 from modules.shared.services.transcrible import TranscribeService
 from modules.document.schema import validate_request
+from modules.shared.services.single_flight import coalesced_response
 from extensions import get_logger
 
 
@@ -11,16 +12,23 @@ transcribe_service = TranscribeService()
 
 
 def document_processing_controller():
-    try:
-        data = request.get_json()
+    data = request.get_json(silent=True)
 
-        valid, error = validate_request(data)
-        if not valid:
-            return jsonify({"success": False, "message": "Invalid request data"}), 400
+    valid, error = validate_request(data)
+    if not valid:
+        return jsonify({"success": False, "message": "Invalid request data"}), 400
 
-        results = document_service.process_documents_for_course(data["s3_keys"])
+    s3_keys = data["s3_keys"]
 
-        return jsonify({"success": bool(results)}), 200
-    except Exception as e:
-        logger.error(f"Error processing documents: {str(e)}")
-        return jsonify({"success": False, "message": "Internal Server Error"}), 500
+    def process():
+        try:
+            results = document_service.process_documents_for_course(s3_keys)
+            return {"success": bool(results)}, 200
+        except Exception as e:
+            logger.error(f"Error processing documents: {str(e)}")
+            return {"success": False, "message": "Internal Server Error"}, 500
+
+    # The same set of files sent twice is only ingested once
+    return coalesced_response(
+        "process_documents", {"s3_keys": sorted(set(s3_keys))}, process
+    )
@@ -1,13 +1,16 @@
 from extensions import db
 from datetime import datetime
 from pgvector.sqlalchemy import Vector
-from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.dialects.postgresql import ARRAY, TSVECTOR
 
 
 class Organization(db.Model):
     __tablename__ = "Organization"
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     name = db.Column(db.String, nullable=False)
+    content_version = db.Column(
+        db.Integer, nullable=False, default=0, server_default="0"
+    )
 
     users = db.relationship("User", back_populates="organization")
     courses = db.relationship("Courses", back_populates="organization")
@@ -119,6 +122,8 @@ class Questions(db.Model):
     explanation_en = db.Column(db.String)
     explanation_fr = db.Column(db.String)
     explanation_ar = db.Column(db.String)
+    # Embedding of question_text_en, used to skip near-duplicate questions
+    question_embedding = db.Column(Vector(1024))
     course_id = db.Column(db.Integer, db.ForeignKey("Courses.id"), nullable=False)
     # section_id = db.Column(db.Integer, db.ForeignKey("Sections.id"), nullable=True)
 
@@ -136,11 +141,38 @@ class FlashCards(db.Model):
     answer_en = db.Column(db.String)
     answer_fr = db.Column(db.String)
     answer_ar = db.Column(db.String)
+    # Embedding of question_en, used to skip near-duplicate flashcards
+    question_embedding = db.Column(Vector(1024))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
     module_id = db.Column(db.Integer, db.ForeignKey("Modules.id"), nullable=False)
 
     module = db.relationship("Modules", back_populates="flashcards")
 
 
+# Highest source row id (chunk or paragraph) already used for one kind of
+# generated content of a course
+class GenerationWatermarks(db.Model):
+    __tablename__ = "GenerationWatermarks"
+    course_id = db.Column(db.Integer, db.ForeignKey("Courses.id"), primary_key=True)
+    kind = db.Column(db.String, primary_key=True)
+    last_source_id = db.Column(db.Integer, nullable=False)
+    updated_at = db.Column(
+        db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow
+    )
+
+
+# Stored responses of expensive POST endpoints, replayed for requests with the
+# same Idempotency-Key (or, briefly, the same payload) until expires_at
+class IdempotencyRecords(db.Model):
+    __tablename__ = "IdempotencyRecords"
+    key = db.Column(db.String, primary_key=True)
+    request_hash = db.Column(db.String, nullable=False)
+    status_code = db.Column(db.Integer, nullable=False)
+    body = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+
 class Documents(db.Model):
     __tablename__ = "Documents"
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
@@ -163,10 +195,33 @@ class DocumentChunks(db.Model):
     embeddings_ar = db.Column(Vector(1024))
     embeddings_fr = db.Column(Vector(1024))
     embeddings_en = db.Column(Vector(1024))
+    tsv_en = db.Column(
+        TSVECTOR,
+        db.Computed("to_tsvector('english', coalesce(text_en, ''))", persisted=True),
+    )
+    tsv_fr = db.Column(
+        TSVECTOR,
+        db.Computed("to_tsvector('french', coalesce(text_fr, ''))", persisted=True),
+    )
+    tsv_ar = db.Column(
+        TSVECTOR,
+        db.Computed("to_tsvector('arabic', coalesce(text_ar, ''))", persisted=True),
+    )
+    # Flashcard suitability features of text_en, NULL until computed
+    term_hits = db.Column(db.Integer)
+    definition_hits = db.Column(db.Integer)
+    comparison_hits = db.Column(db.Integer)
+    list_hits = db.Column(db.Integer)
     document_id = db.Column(db.Integer, db.ForeignKey("Documents.id"), nullable=False)
 
     document = db.relationship("Documents", back_populates="chunks")
 
+    __table_args__ = (
+        db.Index("ix_DocumentChunks_tsv_en", "tsv_en", postgresql_using="gin"),
+        db.Index("ix_DocumentChunks_tsv_fr", "tsv_fr", postgresql_using="gin"),
+        db.Index("ix_DocumentChunks_tsv_ar", "tsv_ar", postgresql_using="gin"),
+    )
+
 
 class ChatSession(db.Model):
     __tablename__ = "ChatSession"
@@ -175,6 +230,11 @@ class ChatSession(db.Model):
     session_started_at = db.Column(db.DateTime)
     session_ended_at = db.Column(db.DateTime)
     user_id = db.Column(db.Integer, db.ForeignKey("User.id"), nullable=False)
+    # Bumped by every insert of a message of the session, so the history
+    # cache of each process can tell when another one wrote to it
+    message_version = db.Column(
+        db.Integer, nullable=False, default=0, server_default="0"
+    )
 
     user = db.relationship("User", back_populates="chat_sessions")
     messages = db.relationship("ChatMessage", back_populates="session")
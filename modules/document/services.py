@@ -2,8 +2,15 @@ import os
 import json
 from modules.shared.services.s3 import S3Service
 from modules.shared.services.bedrock import BedrockService
+from modules.shared.services.bedrock_scheduler import INGESTION
 from modules.shared.services.transcrible import TranscribeService
 from modules.shared.services.translation import TranslationService
+from modules.shared.services.content_version import content_versions
+from modules.shared.services.chunk_features import (
+    chunk_features,
+    feature_matcher,
+    refresh_course_features,
+)
 from modules.document.prompts import TEXT_PROMPT, IMAGE_PROMPT
 from modules.document.entity import Courses, Documents, DocumentChunks
 
@@ -14,12 +21,10 @@ from extensions import db, get_logger
 class DocumentProcessingService:
     def __init__(self):
         self.s3_service = S3Service()
-        self.bedrock_service = BedrockService()
+        self.bedrock_service = BedrockService(priority=INGESTION)
         self.translate_service = TranslationService()
         self.transcribe_service = TranscribeService()
         self.logger = get_logger("[DocumentProcessingService]")
-        self.chunk_size = 2048
-        self.context_window = 160000
 
         self.IMAGE_TYPES = {
             "image/jpeg",
@@ -146,6 +151,14 @@ class DocumentProcessingService:
                 course.terms = all_terms
                 db.session.commit()
 
+                # Term hits of the chunks already stored counted the old list
+                self.logger.info(
+                    f"[process_file] Refreshing chunk features for {len(new_terms)} new terms"
+                )
+                refresh_course_features(course_id, all_terms)
+
+            matcher = feature_matcher(course.terms)
+
             self.logger.info("[process_file] Saving in Documents table")
             document = self._save_document(
                 course_id, s3_uri, parsed_text.get("extracted_text", ""), content_type
@@ -173,7 +186,11 @@ class DocumentProcessingService:
                     embedding_fr=embedding_fr,
                     embedding_ar=embedding_ar,
                     tokens=chunk["tokens"],
+                    features=chunk_features(text_en, matcher=matcher),
                 )
+
+            if chunks:
+                content_versions.bump(course.organizationId)
             self.logger.info("\n===== PROCESSING COMPLETE =====\n\n")
 
             return True
@@ -217,8 +234,10 @@ class DocumentProcessingService:
         embedding_fr,
         embedding_ar,
         tokens,
+        features=None,
     ):
         chunk_entity = DocumentChunks(
+            **(features or {}),
             tokens=tokens,
             document_id=document_id,
             text_ar=text_ar,
@@ -0,0 +1,145 @@
+import copy
+
+import numpy as np
+
+from extensions import db, get_logger
+from modules.document.entity import DocumentChunks, Documents
+from modules.shared.services.chunk_features import FEATURE_COLUMNS
+
+EMBEDDING_DIMENSION = 1024
+LOAD_BATCH_SIZE = 1000
+
+TEXT_COLUMNS = {
+    "en": DocumentChunks.text_en,
+    "fr": DocumentChunks.text_fr,
+    "ar": DocumentChunks.text_ar,
+}
+EMBEDDING_COLUMNS = {
+    "en": DocumentChunks.embeddings_en,
+    "fr": DocumentChunks.embeddings_fr,
+    "ar": DocumentChunks.embeddings_ar,
+}
+
+
+class CourseChunks:
+    """
+    Chunks of one course as parallel arrays, row i describing one chunk.
+
+    Embeddings are a float32 matrix with a zero row where a chunk has no
+    embedding (`has_embedding` tells them apart). `features` holds the stored
+    flashcard features, one int32 column per entry of FEATURE_COLUMNS, with
+    -1 for chunks ingested before they existed. Per-chunk results computed
+    later, such as scores or module assignments, are arrays of the same
+    length, and selections are arrays of row indices.
+    """
+
+    def __init__(
+        self, ids, tokens, document_ids, texts, embeddings, has_embedding, features
+    ):
+        self.ids = ids
+        self.tokens = tokens
+        self.document_ids = document_ids
+        self.texts = texts
+        self.embeddings = embeddings
+        self.has_embedding = has_embedding
+        self.features = features
+        self.module_ids = []
+        self.module_mask = np.zeros((len(ids), 0), dtype=bool)
+        self.scores = np.zeros(len(ids), dtype=np.float32)
+        self.prompt_tokens = np.full(len(ids), -1, dtype=np.int32)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def view(self):
+        """The same chunks with their own module mapping and scores, e.g. for one stage of a job."""
+        view = copy.copy(self)
+        view.module_ids = []
+        view.module_mask = np.zeros((len(self.ids), 0), dtype=bool)
+        view.scores = np.zeros(len(self.ids), dtype=np.float32)
+        return view
+
+    def normalized_embeddings(self):
+        norms = np.linalg.norm(self.embeddings, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return self.embeddings / norms
+
+    @property
+    def nbytes(self):
+        return (
+            self.ids.nbytes
+            + self.tokens.nbytes
+            + self.document_ids.nbytes
+            + self.embeddings.nbytes
+            + self.has_embedding.nbytes
+            + self.features.nbytes
+            + sum(len(text) for text in self.texts)
+        )
+
+
+def load_course_chunks(course_id, lang="en", after_id=None, batch_size=LOAD_BATCH_SIZE):
+    """
+    Load the chunks of a course in one query, streamed in batches. With
+    `after_id`, only chunks with a higher id (ingested since) are loaded.
+    """
+    logger = get_logger("[CourseChunks]")
+    query = (
+        db.session.query(
+            DocumentChunks.id,
+            DocumentChunks.tokens,
+            DocumentChunks.document_id,
+            TEXT_COLUMNS[lang],
+            EMBEDDING_COLUMNS[lang],
+            *(getattr(DocumentChunks, column) for column in FEATURE_COLUMNS.values()),
+        )
+        .join(Documents, DocumentChunks.document_id == Documents.id)
+        .filter(Documents.course_id == course_id)
+        .order_by(DocumentChunks.document_id, DocumentChunks.id)
+    )
+    if after_id is not None:
+        query = query.filter(DocumentChunks.id > after_id)
+    rows = query.yield_per(batch_size)
+
+    ids = []
+    tokens = []
+    document_ids = []
+    texts = []
+    blocks = []
+    block = np.zeros((batch_size, EMBEDDING_DIMENSION), dtype=np.float32)
+    has_embedding = []
+    features = []
+
+    for chunk_id, token_count, document_id, text, embedding, *counts in rows:
+        row = len(ids) % batch_size
+        if row == 0 and ids:
+            blocks.append(block)
+            block = np.zeros((batch_size, EMBEDDING_DIMENSION), dtype=np.float32)
+
+        ids.append(chunk_id)
+        tokens.append(token_count or 0)
+        document_ids.append(document_id)
+        texts.append(text or "")
+        present = embedding is not None and len(embedding) == EMBEDDING_DIMENSION
+        if present:
+            block[row] = embedding
+        has_embedding.append(present)
+        features.append([-1 if count is None else count for count in counts])
+
+    used = len(ids) - len(blocks) * batch_size
+    blocks.append(block[:used])
+    embeddings = np.concatenate(blocks) if len(blocks) > 1 else blocks[0].copy()
+
+    chunks = CourseChunks(
+        ids=np.asarray(ids, dtype=np.int32),
+        tokens=np.asarray(tokens, dtype=np.int32),
+        document_ids=np.asarray(document_ids, dtype=np.int32),
+        texts=texts,
+        embeddings=embeddings,
+        has_embedding=np.asarray(has_embedding, dtype=bool),
+        features=np.asarray(features, dtype=np.int32).reshape(-1, len(FEATURE_COLUMNS)),
+    )
+    logger.info(
+        f"[load_course_chunks] Loaded {len(chunks)} chunks for course {course_id} "
+        f"({lang}), {chunks.nbytes / 1024 / 1024:.1f} MB"
+    )
+    return chunks
@@ -0,0 +1,66 @@
+import json
+
+from flask import request, jsonify
+from modules.flashcard.service import FlashcardService
+from modules.shared.services.response_cache import CachedResponse, response_cache
+from extensions import get_logger
+
+
+logger = get_logger("[FlashcardController]")
+flashcard_service = FlashcardService()
+
+LANGUAGES = ("en", "fr", "ar")
+MAX_PER_PAGE = 200
+
+
+def list_flashcards_controller(course_id):
+    lang = request.args.get("lang", "en")
+    if lang not in LANGUAGES:
+        return jsonify({"error": f"lang must be one of {', '.join(LANGUAGES)}"}), 400
+
+    try:
+        module_id = request.args.get("module_id", type=int)
+        page = max(1, int(request.args.get("page", 1)))
+        per_page = min(MAX_PER_PAGE, max(1, int(request.args.get("per_page", 50))))
+    except ValueError:
+        return jsonify({"error": "page and per_page must be integers"}), 400
+    difficulty = request.args.get("difficulty")
+
+    scope = ("flashcards", course_id)
+    key = (lang, module_id, difficulty, page, per_page)
+    cached = response_cache.get(scope, key)
+    if cached is None:
+        generation = response_cache.generation(scope)
+        try:
+            payload, last_modified = flashcard_service.list_flashcards(
+                course_id,
+                lang=lang,
+                module_id=module_id,
+                difficulty=difficulty,
+                page=page,
+                per_page=per_page,
+            )
+        except Exception as e:
+            logger.error(f"Error retrieving flashcards for course {course_id}: {e}")
+            return jsonify({"error": "Internal Server Error"}), 500
+
+        cached = CachedResponse(json.dumps(payload).encode("utf-8"), last_modified)
+        response_cache.set(scope, key, cached, generation=generation)
+
+    return cached.to_response(request)
+
+
+def generate_flashcards_controller(course_id):
+    data = request.get_json(silent=True) or {}
+    lang = data.get("lang", "en")
+    if lang not in LANGUAGES:
+        return jsonify({"error": f"lang must be one of {', '.join(LANGUAGES)}"}), 400
+
+    try:
+        flashcards = flashcard_service.generate_flashcard(
+            course_id, lang, incremental=bool(data.get("incremental", False))
+        )
+        return jsonify({"course_id": course_id, "flashcards": flashcards}), 201
+    except Exception as e:
+        logger.error(f"Error generating flashcards for course {course_id}: {e}")
+        return jsonify({"error": "Internal Server Error"}), 500
@@ -1,4 +1,9 @@
-FLASHCARD_PROMPT = """
+from modules.shared.services.prompt_cache import CACHE_BREAK
+
+# Stable instructions first, then the module context, then the request, so
+# retries and later calls for the same course reuse the cached prefix
+FLASHCARD_PROMPT = (
+    """
 <instructions>
 You are creating flashcards from {topic} educational content. Generate a structured JSON object with module IDs as keys and arrays of flashcards as values.
 
@@ -34,10 +39,6 @@ Important notes:
 Your response must be valid JSON that can be parsed directly.
 </instructions>
 
-<context>
-{context}
-</context>
-
 <output_format>
 {{
   "m1": [
@@ -61,4 +62,15 @@ Your response must be valid JSON that can be parsed directly.
   ]
 }}
 </output_format>
-"""
\ No newline at end of file
+"""
+    + CACHE_BREAK
+    + """
+<context>
+{context}
+</context>
+"""
+    + CACHE_BREAK
+    + """
+Generate the flashcards for the modules in the context above.
+"""
+)
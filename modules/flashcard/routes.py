@@ -0,0 +1,14 @@
+from modules.flashcard import controller
+
+
+def register_flashcard_routes(app):
+    app.add_url_rule(
+        "/courses/<int:course_id>/flashcards",
+        view_func=controller.list_flashcards_controller,
+        methods=["GET"],
+    )
+    app.add_url_rule(
+        "/courses/<int:course_id>/flashcards",
+        view_func=controller.generate_flashcards_controller,
+        methods=["POST"],
+    )
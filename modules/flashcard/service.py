@@ -1,41 +1,111 @@
+import os
 import json
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from extensions import get_logger
-from modules.document.entity import Courses, DocumentChunks, Documents, FlashCards, Modules
-from modules.document.services import DocumentProcessingService
+from modules.document.entity import Courses, FlashCards, Modules
+from modules.flashcard.chunk_store import load_course_chunks
 from modules.flashcard.prompts import FLASHCARD_PROMPT
-from modules.shared.services.bedrock import BedrockService
+from modules.shared.services.bedrock import BedrockService, model_chain
 from extensions import db
 import numpy as np
 
 from modules.shared.services.translation import TranslationService
+from modules.shared.services.prompt_budget import PromptBudget
+from modules.shared.services.chunk_features import FEATURE_COLUMNS, refresh_course_features
+from modules.shared.services.dedupe import EmbeddingDeduplicator, embed_text
+from modules.shared.services.watermarks import FLASHCARDS, get_watermark, set_watermark
+from modules.shared.services.response_cache import response_cache
+from sqlalchemy import func
+from sqlalchemy.orm import load_only
+
+FLASHCARD_MODEL_ID = "anthropic.claude-3-5-sonnet-20240620-v1:0"
+FLASHCARD_MAX_OUTPUT_TOKENS = 4608
+# Models tried after FLASHCARD_MODEL_ID fails, within FLASHCARD_TIMEOUT_SECONDS per attempt
+FLASHCARD_FALLBACK_MODELS = model_chain(os.getenv("FLASHCARD_FALLBACK_MODELS", ""))
+FLASHCARD_TIMEOUT_SECONDS = float(os.getenv("FLASHCARD_TIMEOUT_SECONDS", "300"))
+FLASHCARD_SHARD_ATTEMPTS = int(os.getenv("FLASHCARD_SHARD_ATTEMPTS", "3"))
+FLASHCARD_SHARD_RETRY_SECONDS = float(os.getenv("FLASHCARD_SHARD_RETRY_SECONDS", "2"))
+FLASHCARD_DEDUPE_THRESHOLD = float(os.getenv("FLASHCARD_DEDUPE_THRESHOLD", "0.9"))
+
+# Shared by all requests, so it also bounds concurrent flashcard model calls
+_shard_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("FLASHCARD_SHARD_WORKERS", "4")),
+    thread_name_prefix="flashcard-shard",
+)
+
+def leader_clusters(embeddings, threshold, max_block_bytes=256 * 1024 * 1024):
+    """
+    Greedy leader clustering: the first unassigned row leads a new group and
+    takes every later unassigned row whose cosine similarity to it is at least
+    `threshold`. Returns groups of row indices, leaders in row order and
+    members in row order.
+
+    Similarities are computed block by block as matrix products over the
+    normalized rows, only against rows after the block since earlier ones are
+    already assigned. Values within float32 rounding of the threshold are
+    recomputed in float64 so the result does not depend on block layout.
+    """
+    n = embeddings.shape[0]
+    norms = np.linalg.norm(embeddings, axis=1)
+    safe_norms = np.where(norms == 0, 1.0, norms).astype(np.float32)
+    normalized = embeddings / safe_norms[:, None]
+
+    assigned = np.full(n, -1, dtype=np.int64)
+    groups = []
+    block_size = max(1, min(n, max_block_bytes // (4 * n)))
+    borderline = 1e-4
+
+    for start in range(0, n, block_size):
+        stop = min(start + block_size, n)
+        rows = np.flatnonzero(assigned[start:stop] < 0) + start
+        if len(rows) == 0:
+            continue
+
+        similarities = normalized[rows] @ normalized[start:].T
+
+        for row_position, leader in enumerate(rows):
+            if assigned[leader] >= 0:
+                continue
+
+            group_id = len(groups)
+            assigned[leader] = group_id
+            if norms[leader] == 0:
+                groups.append([int(leader)])
+                continue
+
+            leader_similarities = similarities[row_position, leader - start + 1 :]
+            candidates = np.flatnonzero(leader_similarities >= threshold - borderline) + leader + 1
+            candidates = candidates[(assigned[candidates] < 0) & (norms[candidates] != 0)]
+
+            close = np.abs(leader_similarities[candidates - leader - 1] - threshold) < borderline
+            if close.any():
+                exact = (
+                    embeddings[candidates[close]].astype(np.float64) @ embeddings[leader].astype(np.float64)
+                ) / (norms[candidates[close]].astype(np.float64) * float(norms[leader]))
+                keep = ~close
+                keep[np.flatnonzero(close)] = exact >= threshold
+                candidates = candidates[keep]
+
+            assigned[candidates] = group_id
+            groups.append([int(leader)] + candidates.tolist())
+
+    return groups
 
-def cosine_similarity(vec1, vec2):          
-    if vec1 is None or vec2 is None:
-        return 0.0
-    
-    if not isinstance(vec1, np.ndarray):
-        vec1 = np.array(vec1)
-    if not isinstance(vec2, np.ndarray):
-        vec2 = np.array(vec2)
-        
-    dot_product = np.dot(vec1, vec2)
-    norm_a = np.linalg.norm(vec1)
-    norm_b = np.linalg.norm(vec2)
-    
-    if norm_a == 0 or norm_b == 0:
-        return 0
-    
-    return dot_product / (norm_a * norm_b)
 
 class FlashcardService:
     def __init__(self):
         self.logger = get_logger('[FlashcardService]')
         self.bedrock_service = BedrockService()
-        self.document_service = DocumentProcessingService()
+        self.prompt_budget = PromptBudget(FLASHCARD_MODEL_ID, max_output_tokens=FLASHCARD_MAX_OUTPUT_TOKENS)
         self.translation_service = TranslationService()
 
-    def generate_flashcard(self, course_id, lang="en"):
-        self.logger.info("[generate_flashcard] Generating Flashcard...")
+    def generate_flashcard(self, course_id, lang="en", incremental=False, module_ids=None, chunks=None, deduplicator=None):
+        # With `module_ids`, only those modules get cards, e.g. one module as
+        # soon as it is generated; they get their share of the course budget.
+        # The calls of one job can share `chunks` (see load_chunks) and a
+        # `deduplicator` (see flashcard_deduplicator) instead of each making its own
+        self.logger.info(f"[generate_flashcard] Generating Flashcard (incremental={incremental}, modules={module_ids})...")
 
         # Get course info to determine the topic
         course = Courses.query.get(course_id)
@@ -43,262 +113,407 @@ class FlashcardService:
             topic = course.title if course.title else " "
             self.logger.debug(f"[generate_flashcard] Using topic: {topic}")
 
-        self.logger.debug(f"[generate_flashcard] Retrieving relevant chunks...")
-        course_chunks = self._retrieve_course_chunks(course_id=course_id, lang=lang)
+        # Incremental runs only read chunks ingested after the last run
+        watermark = get_watermark(course_id, FLASHCARDS) if incremental else None
+
+        self.logger.debug(f"[generate_flashcard] Retrieving relevant chunks after {watermark}...")
+        course_chunks = self._retrieve_course_chunks(course_id=course_id, lang=lang, after_id=watermark, module_ids=module_ids, chunks=chunks)
 
         self.logger.debug(f"[generate_flashcard] Retrieved Chunks:\n{len(course_chunks)}")
-        self.logger.debug(f"[generate_flashcard] Retrieved Chunks:\n{course_chunks[:2]}")
+        if not len(course_chunks):
+            self.logger.info(f"[generate_flashcard] No new chunks for course {course_id}")
+            return {}
 
-        analyzed_chunks = self._analyze_retrieved_chunks(course_chunks, course_id)
-        self.logger.debug(f"[generate_flashcard] Number of analyzed chunks ready for flashcard generation: {len(analyzed_chunks)}")
+        budget_share = 1.0
+        if module_ids is not None:
+            course_modules = max((course.nb_of_modules if course else 0) or 0, Modules.query.filter_by(course_id=course_id).count(), len(module_ids))
+            budget_share = len(module_ids) / course_modules
+
+        analyzed_chunks = self._analyze_retrieved_chunks(course_chunks, course_id, budget_share=budget_share)
+        self.logger.debug(f"[generate_flashcard] Number of analyzed chunks ready for flashcard generation: {sum(len(rows) for rows in analyzed_chunks.values())}")
 
         self.logger.info(f"[generate_flashcard] Calling BedrockService for flashcard generation on topic: {topic}")
-        bedrock_response = self._call_bedrock(analyzed_chunks, topic=topic)
+        bedrock_response, failed = self._generate_by_module(
+            {module_id: [course_chunks.texts[i] for i in rows] for module_id, rows in analyzed_chunks.items()},
+            topic=topic,
+            course_id=course_id,
+            deduplicator=deduplicator
+        )
         # self.logger.debug(f"\nBedrock responses:\n{bedrock_response}")
 
-        self.save_flashcards_in_db(bedrock_response, course_id)
+        # Only move past these chunks once every module got its cards, so the
+        # next run retries failed modules (already saved cards are deduplicated).
+        # Runs over some of the modules leave the watermark alone.
+        if not failed and module_ids is None:
+            set_watermark(course_id, FLASHCARDS, self.chunk_watermark(course_chunks))
+        elif failed and module_ids is not None:
+            raise RuntimeError(f"Flashcard generation failed for modules {failed}")
         self.logger.debug("\nFlashcards saved successfully.")
 
         return bedrock_response
 
-    def _retrieve_course_chunks(self, course_id, lang):
+    def load_chunks(self, course_id, lang="en", incremental=False):
+        # The chunks generate_flashcard would read, loaded once for every call of a job
+        watermark = get_watermark(course_id, FLASHCARDS) if incremental else None
+        return load_course_chunks(course_id, lang, after_id=watermark)
+
+    def course_watermark(self, course_id, chunks, lang="en"):
+        # Watermark after a job's calls over `chunks` (see load_chunks), each
+        # for some of the modules, all succeeded: the chunks are mapped
+        # against every module of the course, as a run over the whole course would
+        if not len(chunks):
+            return None
+        return self.chunk_watermark(self._retrieve_course_chunks(course_id=course_id, lang=lang, chunks=chunks))
+
+    def chunk_watermark(self, chunks):
+        # Chunks that matched no module were not sent to any shard (e.g. they
+        # were ingested before their module existed): stay below the first of
+        # them so a later run reads it again
+        unclassified = chunks.ids[~chunks.module_mask.any(axis=1)]
+        if len(unclassified):
+            return int(unclassified.min()) - 1
+        return int(chunks.ids.max())
+
+    def list_flashcards(self, course_id, lang="en", module_id=None, difficulty=None, page=1, per_page=50):
+        # One query for the page, its total and the newest card of the whole
+        # filtered set (window functions are evaluated before LIMIT)
+        query = (
+            db.session.query(
+                FlashCards.id,
+                FlashCards.module_id,
+                FlashCards.difficulty,
+                getattr(FlashCards, f"question_{lang}").label("question"),
+                getattr(FlashCards, f"answer_{lang}").label("answer"),
+                func.count().over().label("total"),
+                func.max(FlashCards.created_at).over().label("last_modified"),
+            )
+            .join(Modules, Modules.id == FlashCards.module_id)
+            .filter(Modules.course_id == course_id)
+        )
+        if module_id is not None:
+            query = query.filter(FlashCards.module_id == module_id)
+        if difficulty:
+            query = query.filter(FlashCards.difficulty == difficulty)
+
+        rows = query.order_by(FlashCards.module_id, FlashCards.id).limit(per_page).offset((page - 1) * per_page).all()
+
+        if rows:
+            total, last_modified = rows[0].total, rows[0].last_modified
+        else:
+            # Past the last page the window has no row to ride on
+            total, last_modified = query.with_entities(func.count(), func.max(FlashCards.created_at)).order_by(None).one()
+
+        self.logger.info(f"[list_flashcards] Course {course_id} page {page}: {len(rows)}/{total} flashcards")
+        return {
+            "course_id": course_id,
+            "lang": lang,
+            "page": page,
+            "per_page": per_page,
+            "total": total,
+            "flashcards": [
+                {
+                    "id": row.id,
+                    "module_id": row.module_id,
+                    "difficulty": row.difficulty,
+                    "question": row.question,
+                    "answer": row.answer,
+                }
+                for row in rows
+            ],
+        }, last_modified
+
+    def _generate_by_module(self, module_texts, topic, course_id, deduplicator=None):
+        # One model call per module, run on the shared pool. Each shard's cards
+        # are translated and embedded in its worker and saved here as soon as
+        # it finishes, so a failed module only loses its own cards. Cards too
+        # close to an existing or already saved one are dropped.
+        if "unclassified" in module_texts:
+            # The prompt has the model discard unclassified content, and cards
+            # need a module, so there is nothing to generate from it
+            self.logger.info("[_generate_by_module] Skipping the unclassified shard")
+            module_texts = {module_id: texts for module_id, texts in module_texts.items() if module_id != "unclassified"}
+
+        if deduplicator is None:
+            deduplicator = self.flashcard_deduplicator(course_id)
+        futures = {
+            _shard_executor.submit(self._generate_module_flashcards, module_id, texts, topic): module_id
+            for module_id, texts in module_texts.items()
+            if texts
+        }
+
+        module_flashcards = {}
+        failed = []
+        for future in as_completed(futures):
+            module_id = futures[future]
+            try:
+                cards, translations, embeddings = future.result()
+            except Exception as e:
+                self.logger.error(f"[_generate_by_module] Module {module_id} failed after {FLASHCARD_SHARD_ATTEMPTS} attempts: {e}")
+                failed.append(module_id)
+                continue
+
+            new = [i for i, embedding in enumerate(embeddings) if deduplicator.keep(embedding)]
+            if len(new) < len(cards):
+                self.logger.info(f"[_generate_by_module] Module {module_id}: dropped {len(cards) - len(new)} duplicate flashcards")
+            cards = [cards[i] for i in new]
+            self._save_module_flashcards(module_id, cards, [translations[i] for i in new], [embeddings[i] for i in new])
+            response_cache.invalidate(("flashcards", int(course_id)))
+            response_cache.invalidate(("course_content", int(course_id)))
+            module_flashcards[str(module_id)] = cards
+
+        self.logger.info(f"[_generate_by_module] Saved flashcards for {len(module_flashcards)}/{len(futures)} modules of course {course_id}, failed: {failed}")
+        return module_flashcards, failed
+
+    def flashcard_deduplicator(self, course_id):
+        deduplicator = EmbeddingDeduplicator(self.bedrock_service, FLASHCARD_DEDUPE_THRESHOLD)
+
+        existing = (
+            FlashCards.query.join(Modules, Modules.id == FlashCards.module_id)
+            .filter(Modules.course_id == course_id)
+            .options(load_only(FlashCards.id, FlashCards.question_en, FlashCards.question_embedding))
+            .all()
+        )
+
+        # Cards saved before embeddings were stored get one now
+        missing = [card for card in existing if card.question_embedding is None]
+        for card in missing:
+            card.question_embedding = deduplicator.embed(card.question_en)
+        if missing:
+            db.session.commit()
+            self.logger.info(f"[flashcard_deduplicator] Embedded {len(missing)} existing flashcards of course {course_id}")
+
+        deduplicator.add_existing(card.question_embedding for card in existing)
+        return deduplicator
+
+    def _generate_module_flashcards(self, module_id, texts, topic):
+        for attempt in range(1, FLASHCARD_SHARD_ATTEMPTS + 1):
+            try:
+                response = self._call_bedrock({module_id: texts}, topic=topic)
+                break
+            except Exception as e:
+                if attempt == FLASHCARD_SHARD_ATTEMPTS:
+                    raise
+                delay = FLASHCARD_SHARD_RETRY_SECONDS * 2 ** (attempt - 1)
+                self.logger.warning(f"[_generate_module_flashcards] Module {module_id} attempt {attempt} failed, retrying in {delay}s: {e}")
+                time.sleep(delay)
+
+        # The model keys its answer by the module heading; take the cards under
+        # any key since the shard only covers this module
+        cards = response.get(str(module_id))
+        if not isinstance(cards, list):
+            cards = [card for value in response.values() if isinstance(value, list) for card in value]
+        cards = [card for card in cards if isinstance(card, dict)]
+
+        translations = [
+            (
+                self.translation_service._translate_and_assign(card.get("question")),
+                self.translation_service._translate_and_assign(card.get("answer")),
+            )
+            for card in cards
+        ]
+        embeddings = [embed_text(self.bedrock_service, question.get("en")) for question, _ in translations]
+        return cards, translations, embeddings
+
+    def _retrieve_course_chunks(self, course_id, lang, after_id=None, module_ids=None, chunks=None):
         self.logger.info(f"[_retrieve_course_chunks] Retrieving relevant chunks for course_id: {course_id}")
 
-        self.logger.info(f"[_retrieve_course_chunks] Fetching documents for course_id: {course_id}")
-        documents = Documents.query.filter_by(course_id=course_id).all()
-        
-        modules = Modules.query.filter_by(course_id=course_id).all()
+        # Chunks shared with other calls are mapped on a view of their own
+        chunks = load_course_chunks(course_id, lang, after_id=after_id) if chunks is None else chunks.view()
+
+        modules = Modules.query.filter_by(course_id=course_id)
+        if module_ids is not None:
+            modules = modules.filter(Modules.id.in_(module_ids))
+        modules = modules.all()
         module_titles = {module.id: module.title_en for module in modules}
+        chunks.module_ids, chunks.module_mask = self._map_chunks_to_modules(chunks, module_titles)
+
+        self.logger.info(f"[_retrieve_course_chunks] Retrieved {len(chunks)} chunks mapped against {len(module_titles)} modules")
+        return chunks
+
+
+    def _map_chunks_to_modules(self, chunks, module_titles):
+        # One embedding per module title, then every chunk against every title
+        # in a single matrix product. Returns the module ids and a boolean
+        # (chunks x modules) matrix of the mapping.
+        module_ids = list(module_titles)
+        title_embeddings = np.zeros((len(module_ids), chunks.embeddings.shape[1]), dtype=np.float32)
+
+        for row, module_id in enumerate(module_ids):
+            title = module_titles[module_id]
+            embedding = embed_text(self.bedrock_service, title)
+            if embedding is None or len(embedding) != title_embeddings.shape[1]:
+                self.logger.warning(f"[_map_chunks_to_modules] No embedding for module {module_id} title, it will not be mapped")
+                continue
+            title_embeddings[row] = embedding
+
+        norms = np.linalg.norm(title_embeddings, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        similarities = chunks.normalized_embeddings() @ (title_embeddings / norms).T
+
+        return module_ids, similarities > 0.5
         
-        enhanced_chunks = []
-        self.logger.info(f"[_retrieve_course_chunks] Aggregating chunks for documents with metadata")
-
-        for doc in documents:
-            chunks = DocumentChunks.query.filter_by(document_id=doc.id).all()
-
-            for chunk in chunks:
-                text = {
-                    "en": chunk.text_en,
-                    "ar": chunk.text_ar,
-                    "fr": chunk.text_fr
-                }[lang]
-                
-                embeddings = {
-                    "en": chunk.embeddings_en,
-                    "ar": chunk.embeddings_ar,
-                    "fr": chunk.embeddings_fr
-                }[lang]
-                
-                enhanced_chunk = {
-                    "id": chunk.id,
-                    "tokens": chunk.tokens,
-                    "text": text,
-                    "embedding": embeddings,
-                    "document_id": doc.id,
-                    "module_mapping": self._map_chunk_to_module(text, embeddings, module_titles)
-                }
-                
-                enhanced_chunks.append(enhanced_chunk)
-
-        self.logger.info(f"[_retrieve_course_chunks] Retrieved {len(enhanced_chunks)} enhanced chunks with metadata")
-        return enhanced_chunks
-
-
-    def _map_chunk_to_module(self, chunk_text, chunk_embedding, module_titles):
-        self.logger.debug(f"Chunk text: {chunk_text}")
-        self.logger.debug(f"Chunk Embedding: {chunk_embedding}")
-        title_embeddings = {}
-        for module_id, title in module_titles.items():
-            title_embeddings[module_id] = self.bedrock_service.generate_embedding(title)
-
-        relevant_modules = []
-        for module_id, title in module_titles.items():
-            title_embedding = title_embeddings[module_id]
-            similartiy_score = cosine_similarity(title_embedding, chunk_embedding)
-            if similartiy_score > 0.5:
-                relevant_modules.append(module_id)
-        
-        return relevant_modules
-        
-    def _analyze_retrieved_chunks(self, chunks, course_id):
+    def _analyze_retrieved_chunks(self, chunks, course_id, budget_share=1.0):
         self.logger.info(f"[_analyze_retrieved_chunks] Analyzing {len(chunks)} retrieved chunks for flashcard generation...")
         
-        if not chunks:
+        if not len(chunks):
             self.logger.warning("[_analyze_retrieved_chunks] No chunks to analyze")
-            return []
+            return {}
 
         terms = Courses.query.filter_by(id=course_id).first().terms or []
         self.logger.info(f"[_analyze_retrieved_chunks] Key terms for course_id {course_id}: {terms}")
 
         self.logger.info(f"[_analyze_retrieved_chunks] Scoring chunks for flashcard suitability...")
-        scored_chunks = self._score_chunks_for_flashcards(chunks, terms)
+        order = self._score_chunks_for_flashcards(chunks, terms, course_id)
 
         self.logger.info(f"[_analyze_retrieved_chunks] Grouping semantically similar chunks using vector embeddings...")
-        semantic_groups = self._group_similar_chunks(scored_chunks)
-        self.logger.info(f"[_analyze_retrieved_chunks] Groups ========================={semantic_groups} =========================")
+        semantic_groups = self._group_similar_chunks(chunks, order)
+        self.logger.info(f"[_analyze_retrieved_chunks] Group sizes: {[len(group) for group in semantic_groups]}")
 
         self.logger.info(f"[_analyze_retrieved_chunks] Selecting representative chunks from each semantic group...")
-        selected_chunks = self._select_representative_chunks(semantic_groups)
+        selected_chunks = self._select_representative_chunks(chunks, semantic_groups)
 
         self.logger.info(f"[_analyze_retrieved_chunks] Balancing module coverage in selected chunks...")
-        balanced_chunks = self._balance_module_coverage(selected_chunks)
-        self.logger.info(f"[_analyze_retrieved_chunks] Analysis complete. Selected {len(balanced_chunks)} high-quality chunks for flashcards")
-        self.logger.debug(f"[_analyze_retrieved_chunks] =========================\n{balanced_chunks}\n=========================")
+        balanced_chunks = self._balance_module_coverage(chunks, selected_chunks, budget_share)
+        self.logger.info(f"[_analyze_retrieved_chunks] Analysis complete. Selected {sum(len(rows) for rows in balanced_chunks.values())} high-quality chunks for flashcards")
+        self.logger.debug(f"[_analyze_retrieved_chunks] =========================\n{ {module_id: chunks.ids[rows].tolist() for module_id, rows in balanced_chunks.items()} }\n=========================")
 
         return balanced_chunks
         
-    def _score_chunks_for_flashcards(self, chunks, terms):
-        terms = terms
-        
-        definition_patterns = [
-            "is a", "refers to", "is defined as", "is the", "means", "represents", 
-            "consists of", "comprises", "allows", "enables"
-        ]
-        
-        comparison_patterns = [
-            "versus", "compared to", "difference between", "advantages of", 
-            "benefits of", "in contrast to", "unlike"
-        ]
-        
-        list_patterns = [":", "• ", "- ", "1.", "2.", "first", "second", "key", "important"]
-        
-        scored_chunks = []
-        
-        for chunk in chunks:
-            score = 0
-            text = chunk["text"].lower()
-            
-            token_count = chunk.get("tokens", 0)
-            if 50 <= token_count <= 150:
-                score += 1
-                
-            term_count = sum(1 for term in terms if term in text)
-            score += min(term_count * 0.5, 3)
-            
-            def_count = sum(1 for pattern in definition_patterns if pattern in text)
-            score += min(def_count * 1.0, 3) 
-            
-            comp_count = sum(1 for pattern in comparison_patterns if pattern in text)
-            score += min(comp_count * 1.5, 3)
-
-            list_count = sum(1 for pattern in list_patterns if pattern in text)
-            score += min(list_count * 0.5, 2)
-            
-            if chunk.get("module_mapping"):
-                score += min(len(chunk.get("module_mapping")) * 0.5, 1.5)
-
-            chunk["flashcard_score"] = round(score, 2)
-            scored_chunks.append(chunk)
+    def _score_chunks_for_flashcards(self, chunks, terms, course_id):
+        # Stores the scores on `chunks` and returns the row indices ordered by
+        # descending score (ties keep their original order)
+        missing = np.flatnonzero((chunks.features < 0).any(axis=1))
+        if len(missing):
+            self.logger.info(f"[_score_chunks_for_flashcards] Computing features for {len(missing)} chunks ingested without them")
+            stored = refresh_course_features(course_id, terms, only_missing=True)
+            for row in missing:
+                row_features = stored.get(int(chunks.ids[row]))
+                if row_features:
+                    chunks.features[row] = [row_features[column] for column in FEATURE_COLUMNS.values()]
         
-        # Sort by score in descending order
-        scored_chunks.sort(key=lambda x: x.get("flashcard_score", 0), reverse=True)
+        counts = np.maximum(chunks.features, 0).astype(np.float32)
+        term_hits, definition_hits, comparison_hits, list_hits = counts.T
+
+        scores = ((chunks.tokens >= 50) & (chunks.tokens <= 150)).astype(np.float32)
+        scores += np.minimum(term_hits * 0.5, 3)
+        scores += np.minimum(definition_hits * 1.0, 3)
+        scores += np.minimum(comparison_hits * 1.5, 3)
+        scores += np.minimum(list_hits * 0.5, 2)
+        scores += np.minimum(chunks.module_mask.sum(axis=1) * 0.5, 1.5)
+
+        chunks.scores = np.round(scores, 2)
+        order = np.argsort(-chunks.scores, kind="stable")
         self.logger.info("[_score_chunks_for_flashcards] Chunk scoring complete")
-        return scored_chunks
+        return order
         
-    def _group_similar_chunks(self, chunks):
-        if not chunks:
+    def _group_similar_chunks(self, chunks, order):
+        if not len(order):
             return []
 
         similarity_threshold = 0.8
-        groups = []
-        ungrouped = [c for c in chunks if c.get("embedding") is not None] 
+        ungrouped = order[chunks.has_embedding[order]]
 
-        if not ungrouped:
+        if not len(ungrouped):
             self.logger.warning("[_group_similar_chunks] No embeddings available, returning chunks as singleton groups")
-            return [[c] for c in chunks]
-            
-        while ungrouped:
-            current = ungrouped.pop(0)
-            current_group = [current]
-            
-            i = 0
-            while i < len(ungrouped):
-                chunk = ungrouped[i]
-                
-                similarity = cosine_similarity(current["embedding"], chunk["embedding"])
-                
-                if similarity >= similarity_threshold:
-                    current_group.append(chunk)
-                    ungrouped.pop(i)
-                else:
-                    i += 1
-            
-            groups.append(current_group)
+            return [order[i:i + 1] for i in range(len(order))]
+
+        groups = [
+            ungrouped[group]
+            for group in leader_clusters(chunks.embeddings[ungrouped], similarity_threshold)
+        ]
 
-        self.logger.info(f"[_group_similar_chunks] Created {len(groups)} semantic groups from {len(chunks)} chunks using vector similarity")
+        self.logger.info(f"[_group_similar_chunks] Created {len(groups)} semantic groups from {len(order)} chunks using vector similarity")
         return groups
         
-    def _select_representative_chunks(self, chunk_groups):
+    def _select_representative_chunks(self, chunks, chunk_groups):
         representatives = []
         
         for group in chunk_groups:
-            if not group:
+            if not len(group):
                 continue
             
-            sorted_chunks = sorted(group, key=lambda x: x.get("flashcard_score", 0), reverse=True)
-            top_chunks = sorted_chunks[:min(3, len(sorted_chunks))]
-            representatives.extend(top_chunks)
+            sorted_rows = group[np.argsort(-chunks.scores[group], kind="stable")]
+            representatives.append(sorted_rows[:3])
             
-        return representatives
+        return np.concatenate(representatives) if representatives else np.empty(0, dtype=np.int64)
     
-    def _balance_module_coverage(self, chunks):
+    def _balance_module_coverage(self, chunks, rows, budget_share=1.0):
         module_chunks = {}
+
+        # Everything in the prompt except the chunk texts and module headings
+        fixed_prompt = FLASHCARD_PROMPT.format(context="", topic="")
+        budget = int(self.prompt_budget.available(fixed_prompt) * budget_share)
+        self.logger.info(f"[_balance_module_coverage] Token budget for chunk context: {budget}")
         
-        max_chunks = self.document_service.context_window // self.document_service.chunk_size
-        self.logger.info(f"[_balance_module_coverage] Max chunks for context window: {max_chunks}")
-        
-        # Group chunks by their module IDs
-        for chunk in chunks:
-            module_ids = chunk.get("module_mapping", [])
-            if not module_ids:
-                module_chunks.setdefault("unclassified", []).append(chunk)
-                continue
-                
-            for module_id in module_ids:
-                module_chunks.setdefault(module_id, []).append(chunk)
+        # Group chunk rows by their module IDs
+        mask = chunks.module_mask[rows]
+        for column, module_id in enumerate(chunks.module_ids):
+            module_rows = rows[mask[:, column]]
+            if len(module_rows):
+                module_chunks[module_id] = module_rows
+
+        unclassified = rows[~mask.any(axis=1)]
         
+        # The prompt tells the model to discard unclassified content, so it only
+        # gets budget when no chunk maps to a module
+        if not module_chunks and len(unclassified):
+            module_chunks["unclassified"] = unclassified
+
         num_modules = len(module_chunks)
         if num_modules == 0:
-            return {"unclassified": chunks[:max_chunks]}
+            return {}
         
-        # Calculate how many chunks to take from each module
-        chunks_per_module = max(1, max_chunks // num_modules)
-        self.logger.info(f"[_balance_module_coverage] Selecting exactly {chunks_per_module} chunks per module from {num_modules} modules")
-
-        # Create a structured output preserving module relationships
+        # Split the budget evenly, starting with the modules that need the least
+        # so whatever they leave unused goes to the remaining ones
+        needed = {
+            module_id: int(self._chunk_prompt_tokens(chunks, module_rows).sum())
+            for module_id, module_rows in module_chunks.items()
+        }
+        remaining = budget
         balanced_selection_by_module = {}
-        
-        # One simple loop: just take top N chunks from each module
-        for module_id, module_chunk_list in module_chunks.items():
-            if not module_chunk_list:
-                continue
-                
-            # Sort chunks within this module by score
-            sorted_chunks = sorted(module_chunk_list, key=lambda x: x.get("flashcard_score", 0), reverse=True)
-            
-            # Select top chunks_per_module chunks from this module
-            selected_chunks = sorted_chunks[:chunks_per_module]
-            balanced_selection_by_module[module_id] = selected_chunks
-        
-        self.logger.info(f"[_balance_module_coverage] Selected chunks across {len(balanced_selection_by_module)} modules")
+
+        for position, module_id in enumerate(sorted(module_chunks, key=needed.get)):
+            module_rows = module_chunks[module_id]
+
+            heading_tokens = self.prompt_budget.count(f"\n--- MODULE ID: {module_id} ---\n\n")
+            share = remaining // (num_modules - position) - heading_tokens
+
+            selected_rows = self._pack_chunks(chunks, module_rows, share)
+            balanced_selection_by_module[module_id] = selected_rows
+            remaining -= heading_tokens + int(self._chunk_prompt_tokens(chunks, selected_rows).sum())
+            self.logger.info(f"[_balance_module_coverage] Module {module_id}: {len(selected_rows)}/{len(module_rows)} chunks within {share} tokens")
+
+        self.logger.info(f"[_balance_module_coverage] Selected chunks across {len(balanced_selection_by_module)} modules, {budget - remaining}/{budget} tokens used")
         
         return balanced_selection_by_module
 
+    def _pack_chunks(self, chunks, rows, budget):
+        # Highest scores first, returned in their original order
+        sorted_rows = rows[np.argsort(-chunks.scores[rows], kind="stable")]
+        selected = self.prompt_budget.pack(sorted_rows.tolist(), text=lambda row: chunks.texts[row], budget=budget, separator="\n\n")
+        return np.asarray(selected, dtype=np.int64)
+
+    def _chunk_prompt_tokens(self, chunks, rows):
+        separator_tokens = self.prompt_budget.count("\n\n")
+        for row in rows[chunks.prompt_tokens[rows] < 0]:
+            chunks.prompt_tokens[row] = self.prompt_budget.count(chunks.texts[row]) + separator_tokens
+        return chunks.prompt_tokens[rows]
+
 
     def _call_bedrock(self, module_chunks, topic):
         # Format context with module structure preserved
         context_parts = []
         
         # Format context by module ID
-        for module_id, chunks in module_chunks.items():
-            if not chunks:
+        for module_id, texts in module_chunks.items():
+            if not texts:
                 continue
             
             # Add module ID heading (this will be used to structure the response)
             module_section = f"\n--- MODULE ID: {module_id} ---\n\n"
             
             # Add all chunk texts for this module
-            module_section += "\n\n".join(chunk["text"] for chunk in chunks)
+            module_section += "\n\n".join(texts)
             context_parts.append(module_section)
         
         # Join all module contexts
@@ -308,40 +523,35 @@ class FlashcardService:
         prompt = FLASHCARD_PROMPT.format(context=formatted_context, topic=topic)
         
         # Call Bedrock with the structured context
-        response = self.bedrock_service.invoke_model_with_text(prompt, temperature=0.5, max_tokens=4608)
-        return json.loads(response)
-
-    def save_flashcards_in_db(self, module_flashcards, course_id):
-        total_saved = 0
-        
-        for module_id_str, flashcards in module_flashcards.items():
-            if not isinstance(flashcards, list):
-                self.logger.warning(f"Expected list of flashcards for module {module_id_str}, got {type(flashcards)}")
-                continue
-                
-            self.logger.info(f"Processing {len(flashcards)} flashcards for module {module_id_str}")
+        response = self.bedrock_service.invoke_model_with_text(
+            prompt,
+            model_id=[FLASHCARD_MODEL_ID] + FLASHCARD_FALLBACK_MODELS,
+            temperature=0.5,
+            max_tokens=FLASHCARD_MAX_OUTPUT_TOKENS,
+            timeout=FLASHCARD_TIMEOUT_SECONDS,
+        )
+
+        result = json.loads(response)
+        if not isinstance(result, dict):
+            raise ValueError(f"Expected a JSON object of flashcards by module, got {type(result).__name__}")
+        return result
+
+    def _save_module_flashcards(self, module_id, cards, translations, embeddings):
+        for card, (translated_question, translated_answer), embedding in zip(cards, translations, embeddings):
+            new_flashcard = FlashCards(
+                difficulty=card.get("difficulty"),
+                question_en=translated_question.get("en"),
+                question_ar=translated_question.get("ar"),
+                question_fr=translated_question.get("fr"),
+                answer_en=translated_answer.get("en"),
+                answer_ar=translated_answer.get("ar"),
+                answer_fr=translated_answer.get("fr"),
+                question_embedding=embedding,
+                module_id=module_id
+            )
             
-            for card in flashcards:
-                translated_question = self.translation_service._translate_and_assign(card.get("question"))
-                translated_answer = self.translation_service._translate_and_assign(card.get("answer"))
-                
-                
-                new_flashcard = FlashCards(
-                    difficulty=card.get("difficulty"),
-                    question_en=translated_question.get("en"),
-                    question_ar=translated_question.get("ar"),
-                    question_fr=translated_question.get("fr"),
-                    answer_en=translated_answer.get("en"),
-                    answer_ar=translated_answer.get("ar"),
-                    answer_fr=translated_answer.get("fr"),
-                    module_id=module_id_str if module_id_str != "unclassified" else None
-                )
-                
-                db.session.add(new_flashcard)
-                total_saved += 1
+            db.session.add(new_flashcard)
             
         db.session.commit()
-        self.logger.info(f"Saved {total_saved} flashcards to database for course {course_id}")
-        
-        
-
+        self.logger.info(f"Saved {len(cards)} flashcards for module {module_id}")
+        return len(cards)
@@ -1,5 +1,10 @@
-GENERATE_QUESTIONS_PROMPT = """
-Create exactly 10 multiple-choice questions (MCQs) from the following module: {module_summary}
+from modules.shared.services.prompt_cache import CACHE_BREAK
+
+# Stable instructions, then the module content, then the request: the
+# content stays cacheable whatever the question count
+GENERATE_QUESTIONS_PROMPT = (
+    """
+You create multiple-choice questions (MCQs) from course modules.
 
 Each question must have exactly 3 options, 1 correct answer, and an explanation.
 
@@ -25,3 +30,13 @@ Respond only in valid JSON format:
   }}
 ]
 """
+    + CACHE_BREAK
+    + """
+Module:
+{module_summary}
+"""
+    + CACHE_BREAK
+    + """
+Create exactly {question_count} multiple-choice questions (MCQs) from the module above.
+"""
+)
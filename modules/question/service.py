@@ -1,9 +1,36 @@
+import os
 import json
+from concurrent.futures import ThreadPoolExecutor
 from extensions import db, get_logger
-from modules.shared.services.bedrock import BedrockService
+from modules.shared.services.bedrock import BedrockService, model_chain
 from modules.shared.services.translation import TranslationService
 from modules.document.entity import Modules, Sections, Paragraphs, Questions
 from modules.question.prompts import GENERATE_QUESTIONS_PROMPT
+from sqlalchemy import insert
+from sqlalchemy.orm import load_only
+from modules.shared.services.prompt_budget import PromptBudget
+from modules.shared.services.dedupe import EmbeddingDeduplicator, embed_text
+from modules.shared.services.response_cache import response_cache
+from modules.shared.services.watermarks import QUESTIONS, get_watermark, set_watermark
+
+QUESTION_MODEL_ID = "anthropic.claude-3-sonnet-20240229-v1:0"
+QUESTION_MAX_OUTPUT_TOKENS = 10000
+# Tried in order when QUESTION_MODEL_ID fails before it starts answering
+QUESTION_MODEL_CHAIN = [QUESTION_MODEL_ID] + model_chain(
+    os.getenv("QUESTION_FALLBACK_MODELS", "")
+)
+QUESTION_DEDUPE_THRESHOLD = float(os.getenv("QUESTION_DEDUPE_THRESHOLD", "0.9"))
+# Course content is split into prompts of at most this many tokens, each
+# asked for one question per QUESTION_TOKENS_PER_QUESTION, up to
+# QUESTIONS_PER_SHARD
+QUESTION_SHARD_TOKENS = int(os.getenv("QUESTION_SHARD_TOKENS", "6000"))
+QUESTION_TOKENS_PER_QUESTION = int(os.getenv("QUESTION_TOKENS_PER_QUESTION", "400"))
+QUESTIONS_PER_SHARD = int(os.getenv("QUESTIONS_PER_SHARD", "10"))
+
+_question_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("QUESTION_SHARD_WORKERS", "4")),
+    thread_name_prefix="question-shard",
+)
 
 
 class QuestionService:
@@ -11,39 +38,169 @@ class QuestionService:
         self.bedrock = BedrockService()
         self.translation_service = TranslationService()
         self.logger = get_logger()
+        self.prompt_budget = PromptBudget(
+            QUESTION_MODEL_ID, max_output_tokens=QUESTION_MAX_OUTPUT_TOKENS
+        )
 
-    def _translate_and_assign(self, text):
-        if not text:
-            return {"en": None, "fr": None, "ar": None}
-        en, fr, ar = self.translation_service.translate_to_all_languages(text)
-        return {"en": en, "fr": fr, "ar": ar}
-
-    def _get_course_paragraphs(self, course_id):
-        paragraphs = (
-            Paragraphs.query.join(Sections, Sections.id == Paragraphs.section_id)
+    def _get_course_paragraphs(self, course_id, after_id=None, section_ids=None):
+        # Returns (module_id, section_id, text) of every paragraph in course
+        # order and the id of the last paragraph read
+        query = (
+            db.session.query(
+                Paragraphs.id,
+                Sections.module_id,
+                Paragraphs.section_id,
+                Paragraphs.content_body_en,
+            )
+            .join(Sections, Sections.id == Paragraphs.section_id)
             .join(Modules, Modules.id == Sections.module_id)
             .filter(Modules.course_id == course_id)
-            .all()
+            .order_by(Sections.module_id, Paragraphs.section_id, Paragraphs.id)
         )
+        if after_id is not None:
+            query = query.filter(Paragraphs.id > after_id)
+        if section_ids is not None:
+            query = query.filter(Paragraphs.section_id.in_(section_ids))
+        rows = query.all()
 
-        self.logger.info(f"Fetched {len(paragraphs)} paragraphs for course {course_id}")
+        self.logger.info(
+            f"Fetched {len(rows)} paragraphs for course {course_id} after {after_id}"
+        )
 
-        if not paragraphs:
+        if not rows:
             self.logger.warning(f"No paragraphs found for course {course_id}")
-            return ""
+            return [], None
+
+        paragraphs = [
+            (module_id, section_id, text)
+            for _, module_id, section_id, text in rows
+            if text
+        ]
+        return paragraphs, max(row.id for row in rows)
+
+    def _build_shards(self, paragraphs):
+        """
+        Split the paragraphs into prompts of at most QUESTION_SHARD_TOKENS.
+        Whole sections of a module are grouped while they fit, a longer
+        section is split between paragraphs, and a shard never mixes modules.
+        """
+        fixed_prompt = GENERATE_QUESTIONS_PROMPT.format(
+            module_summary="", question_count=QUESTIONS_PER_SHARD
+        )
+        budget = min(QUESTION_SHARD_TOKENS, self.prompt_budget.available(fixed_prompt))
+        separator_tokens = self.prompt_budget.count("\n")
+
+        shards = []
+        current = None
+        for module_id, section_id, text in paragraphs:
+            tokens = self.prompt_budget.count(text) + separator_tokens
+            if (
+                current is None
+                or current["module_id"] != module_id
+                or current["tokens"] + tokens > budget
+            ):
+                current = {
+                    "module_id": module_id,
+                    "section_ids": [],
+                    "texts": [],
+                    "tokens": 0,
+                }
+                shards.append(current)
+            if section_id not in current["section_ids"]:
+                current["section_ids"].append(section_id)
+            current["texts"].append(text)
+            current["tokens"] += tokens
+
+        for shard in shards:
+            # Bigger shards get more questions, so the total follows the
+            # size of the course
+            shard["question_count"] = max(
+                1,
+                min(
+                    QUESTIONS_PER_SHARD,
+                    round(shard["tokens"] / QUESTION_TOKENS_PER_QUESTION),
+                ),
+            )
+
+        self.logger.info(
+            f"Split {len(paragraphs)} paragraphs into {len(shards)} shards of at most "
+            f"{budget} tokens"
+        )
+        return shards
+
+    def _generate_by_shard(self, shards):
+        # Shards run concurrently; results are merged in shard order so the
+        # questions keep the course order. A failed shard is logged and
+        # skipped, its questions come from a later run.
+        futures = [
+            _question_executor.submit(self._generate_shard_questions, shard)
+            for shard in shards
+        ]
+        merged = []
+        failed = []
+        for shard, future in zip(shards, futures):
+            try:
+                merged.extend(future.result())
+            except Exception as e:
+                self.logger.error(
+                    f"Question shard for sections {shard['section_ids']} failed: {e}"
+                )
+                failed.append(shard["section_ids"])
+
+        self.logger.info(
+            f"Generated {len(merged)} questions from {len(shards) - len(failed)}/"
+            f"{len(shards)} shards"
+        )
+        return merged, failed
 
-        combined_text = "\n".join(
-            [p.content_body_en for p in paragraphs if p.content_body_en]
+    def _generate_shard_questions(self, shard):
+        questions_data = self._call_bedrock_for_questions(
+            "\n".join(shard["texts"]), shard["question_count"]
         )
-        return combined_text
+        # Embedded here so embedding calls overlap with the other shards
+        return [
+            (q, embed_text(self.bedrock, q.get("question")))
+            for q in questions_data
+            if isinstance(q, dict) and q.get("question")
+        ]
+
+    def question_deduplicator(self, course_id):
+        deduplicator = EmbeddingDeduplicator(self.bedrock, QUESTION_DEDUPE_THRESHOLD)
+
+        existing = (
+            Questions.query.filter_by(course_id=course_id)
+            .options(
+                load_only(
+                    Questions.id,
+                    Questions.question_text_en,
+                    Questions.question_embedding,
+                )
+            )
+            .all()
+        )
+
+        # Questions saved before embeddings were stored get one now
+        missing = [q for q in existing if q.question_embedding is None]
+        for q in missing:
+            q.question_embedding = deduplicator.embed(q.question_text_en)
+        if missing:
+            db.session.commit()
+            self.logger.info(
+                f"Embedded {len(missing)} existing questions of course {course_id}"
+            )
+
+        deduplicator.add_existing(q.question_embedding for q in existing)
+        return deduplicator
 
     # Bedrock Call Wrapper
-    def _bedrock_generate(self, prompt, max_tokens=10000, temperature=0.5):
+    def _bedrock_generate(
+        self, prompt, max_tokens=QUESTION_MAX_OUTPUT_TOKENS, temperature=0.5
+    ):
         self.logger.info(f"Calling Bedrock with prompt: {prompt}")
         try:
             response = self.bedrock.invoke_model_streaming(
                 prompt,
-                model_id="anthropic.claude-3-sonnet-20240229-v1:0",
+                model_id=QUESTION_MODEL_CHAIN,
                 temperature=temperature,
                 max_tokens=max_tokens,
             )
@@ -53,99 +210,126 @@ class QuestionService:
             return {}
 
     # Generator
-    def _call_bedrock_for_questions(self, content):
-        prompt = GENERATE_QUESTIONS_PROMPT.format(module_summary=content)
+    def _call_bedrock_for_questions(self, content, question_count=QUESTIONS_PER_SHARD):
+        prompt = GENERATE_QUESTIONS_PROMPT.format(
+            module_summary=content, question_count=question_count
+        )
         questions_data = self._bedrock_generate(prompt)
         if not isinstance(questions_data, list) or len(questions_data) == 0:
-            self.logger.error("Bedrock did not return valid questions")
-            return []
+            raise ValueError("Bedrock did not return valid questions")
         return questions_data
 
+    def _deduplicate(self, course_id, questions, deduplicator=None):
+        # Against the course's saved questions and the other shards
+        if deduplicator is None:
+            deduplicator = self.question_deduplicator(course_id)
+        kept = []
+        for q, embedding in questions:
+            if deduplicator.keep(embedding):
+                kept.append((q, embedding))
+            else:
+                self.logger.info(f"Skipping duplicate question: {q.get('question')}")
+        return kept
+
     # Saving Questions to DB
-    def _save_questions_to_db(self, course_id, questions_data):
-        self.logger.info(
-            f"Saving {len(questions_data)} questions for course id {course_id}"
-        )
-        saved_questions = []
+    def _save_questions_to_db(self, course_id, questions):
+        """
+        Translate every string of the questions in one batch and insert them
+        with a single statement. `questions` are (question, embedding) pairs.
+        """
+        self.logger.info(f"Saving {len(questions)} questions for course id {course_id}")
+        if not questions:
+            return []
 
-        lang_dettected = False
-        lang = ""
+        def options_of(q):
+            options = list(q.get("options") or [])[:3]
+            return options + [None] * (3 - len(options))
 
-        for q in questions_data:
-            try:
-                # Translate question, explanation, options, and correct answer
-                # if not lang_detected
-                #   question_texts = self._translate_and_assign(q.get("question"))
-                #   explanation_texts = self._translate_and_assign(q.get("explanation"))
-                #   lang
-                #
-                question_texts = self._translate_and_assign(q.get("question"))
-                explanation_texts = self._translate_and_assign(q.get("explanation"))
-                options = q.get("options", [None, None, None])
-                option1_texts = self._translate_and_assign(options[0])
-                option2_texts = self._translate_and_assign(options[1])
-                option3_texts = self._translate_and_assign(options[2])
-                correct_answer_texts = self._translate_and_assign(
-                    q.get("correct_answer")
-                )
+        translations = self.translation_service.translate_many(
+            text
+            for q, _ in questions
+            for text in [
+                q.get("question"),
+                q.get("explanation"),
+                q.get("correct_answer"),
+                *options_of(q),
+            ]
+        )
+        empty = {"en": None, "fr": None, "ar": None}
 
-                question_entity = Questions(
-                    course_id=course_id,
-                    question_text_en=question_texts["en"],
-                    question_text_fr=question_texts["fr"],
-                    question_text_ar=question_texts["ar"],
-                    option1_en=option1_texts["en"],
-                    option1_fr=option1_texts["fr"],
-                    option1_ar=option1_texts["ar"],
-                    option2_en=option2_texts["en"],
-                    option2_fr=option2_texts["fr"],
-                    option2_ar=option2_texts["ar"],
-                    option3_en=option3_texts["en"],
-                    option3_fr=option3_texts["fr"],
-                    option3_ar=option3_texts["ar"],
-                    correct_answer_en=correct_answer_texts["en"],
-                    correct_answer_fr=correct_answer_texts["fr"],
-                    correct_answer_ar=correct_answer_texts["ar"],
-                    explanation_en=explanation_texts["en"],
-                    explanation_fr=explanation_texts["fr"],
-                    explanation_ar=explanation_texts["ar"],
-                )
+        def translated(text):
+            return translations.get(text, empty) if text else empty
 
-                db.session.add(question_entity)
-                db.session.flush()
-
-                saved_questions.append(
-                    {
-                        "id": question_entity.id,
-                        "question": question_texts,
-                        "options": {
-                            "en": [
-                                option1_texts["en"],
-                                option2_texts["en"],
-                                option3_texts["en"],
-                            ],
-                        },
-                        "correct_answer": correct_answer_texts,
-                        "explanation": explanation_texts,
-                    }
+        rows = []
+        for q, embedding in questions:
+            row = {"course_id": course_id, "question_embedding": embedding}
+            for column, text in [
+                ("question_text", q.get("question")),
+                ("option1", options_of(q)[0]),
+                ("option2", options_of(q)[1]),
+                ("option3", options_of(q)[2]),
+                ("correct_answer", q.get("correct_answer")),
+                ("explanation", q.get("explanation")),
+            ]:
+                for lang, value in translated(text).items():
+                    row[f"{column}_{lang}"] = value
+            rows.append(row)
+
+        try:
+            question_ids = (
+                db.session.execute(
+                    insert(Questions).returning(
+                        Questions.id, sort_by_parameter_order=True
+                    ),
+                    rows,
                 )
-            except Exception as e:
-                self.logger.error(f"Error saving question for section {course_id}: {e}")
+                .scalars()
+                .all()
+            )
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
 
-        db.session.commit()
-        return saved_questions
+        response_cache.invalidate(("course_content", int(course_id)))
+        return [
+            {
+                "id": question_id,
+                "question": translated(q.get("question")),
+                "options": {"en": [translated(o)["en"] for o in options_of(q)]},
+                "correct_answer": translated(q.get("correct_answer")),
+                "explanation": translated(q.get("explanation")),
+            }
+            for question_id, (q, _) in zip(question_ids, questions)
+        ]
 
     # Main Quiz Generation
-    def generate_question(self, course_id):
-        # Combine content
-        combined_text = self._get_course_paragraphs(course_id)
-        if not combined_text:
-            return []
+    def generate_question(
+        self, course_id, incremental=False, section_ids=None, deduplicator=None
+    ):
+        # Incremental runs only read paragraphs added after the last run.
+        # With `section_ids`, only those sections are read, e.g. the sections
+        # of a module as soon as it is saved. The calls of one job can share
+        # a `deduplicator` (see question_deduplicator).
+        watermark = get_watermark(course_id, QUESTIONS) if incremental else None
 
-        # Generate questions via Bedrock
-        questions_data = self._call_bedrock_for_questions(combined_text)
-        if not questions_data:
+        paragraphs, last_paragraph_id = self._get_course_paragraphs(
+            course_id, after_id=watermark, section_ids=section_ids
+        )
+        if not paragraphs:
             return []
 
+        # Generate questions per shard via Bedrock, then drop near-duplicates
+        shards = self._build_shards(paragraphs)
+        questions, failed = self._generate_by_shard(shards)
+        questions = self._deduplicate(course_id, questions, deduplicator)
+
         # Save and return
-        return self._save_questions_to_db(course_id, questions_data)
+        saved_questions = self._save_questions_to_db(course_id, questions)
+
+        # Only move past these paragraphs once every shard got its questions
+        if not failed and section_ids is None:
+            set_watermark(course_id, QUESTIONS, last_paragraph_id)
+        elif failed and section_ids is not None:
+            raise RuntimeError(f"Question generation failed for sections {failed}")
+        return saved_questions
@@ -1,50 +1,300 @@
+import os
 import json
+import time
 import base64
+import threading
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
 import boto3
+import numpy as np
 from extensions import get_logger
+from modules.shared.services.bedrock_errors import (
+    BedrockError,
+    BedrockModelError,
+    BedrockTimeout,
+    to_bedrock_error,
+)
+from modules.shared.services.bedrock_scheduler import (
+    GENERATION,
+    bedrock_scheduler,
+    estimate_tokens,
+)
+from modules.shared.services.prompt_cache import (
+    anthropic_content,
+    converse_content,
+    prompt_cache_stats,
+    prompt_text,
+)
+
+BEDROCK_REGION = os.getenv("BEDROCK_REGION", "us-east-1")
+# Points the clients at another implementation of the Bedrock runtime API,
+# like the stub in benchmarks/bedrock_stub.py
+BEDROCK_ENDPOINT_URL = os.getenv("BEDROCK_ENDPOINT_URL") or None
+
+# A hedged call starts a second attempt once the first one has been running
+# for the model's p95 latency, known after HEDGE_MIN_SAMPLES successful calls
+HEDGE_MIN_SAMPLES = int(os.getenv("BEDROCK_HEDGE_MIN_SAMPLES", "20"))
+HEDGE_MIN_SECONDS = float(os.getenv("BEDROCK_HEDGE_MIN_SECONDS", "0.2"))
+LATENCY_SAMPLES = 200
+
+# Attempts run here so that the caller can stop waiting at its latency budget
+# or race a hedged attempt. An abandoned attempt that has not started is
+# cancelled; one waiting for its slot or about to send its request gives up
+_attempt_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("BEDROCK_ATTEMPT_WORKERS", "32")),
+    thread_name_prefix="bedrock-attempt",
+)
+
+
+def model_chain(models):
+    """A model id, a comma separated list of them or a list, as a fallback chain."""
+    if isinstance(models, str):
+        return [model.strip() for model in models.split(",") if model.strip()]
+    return list(models)
+
+
+class _LatencyTracker:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._samples = {}
+
+    def record(self, model_id, seconds):
+        with self._lock:
+            samples = self._samples.setdefault(model_id, deque(maxlen=LATENCY_SAMPLES))
+            samples.append(seconds)
+
+    def p95(self, model_id):
+        with self._lock:
+            samples = list(self._samples.get(model_id, ()))
+        if len(samples) < HEDGE_MIN_SAMPLES:
+            return None
+        return max(HEDGE_MIN_SECONDS, float(np.percentile(samples, 95)))
+
+
+model_latency = _LatencyTracker()
+
+
+class _AttemptBudget:
+    """The deadline of a call's attempts, and whether the caller gave up on them."""
+
+    def __init__(self, deadline):
+        self.deadline = deadline
+        self.abandoned = threading.Event()
+
+    def remaining(self):
+        if self.deadline is None:
+            return None
+        return self.deadline - time.monotonic()
+
+    def check(self, model_id):
+        if self.abandoned.is_set():
+            raise BedrockTimeout(
+                f"{model_id}: attempt abandoned by the caller", model_id
+            )
+        remaining = self.remaining()
+        if remaining is not None and remaining <= 0:
+            raise BedrockTimeout(
+                f"{model_id}: budget spent before the request", model_id
+            )
+
+
+# The budget of the attempt running on the current thread, read by _slot
+_attempt_local = threading.local()
+
+
+def anthropic_usage(model_id, usage):
+    # Tokens used by the call; the input is split into uncached and cached parts
+    if not usage or "input_tokens" not in usage:
+        return None
+    prompt_cache_stats.record_anthropic(model_id, usage)
+    return (
+        usage["input_tokens"]
+        + usage.get("cache_read_input_tokens", 0)
+        + usage.get("cache_creation_input_tokens", 0)
+        + usage.get("output_tokens", 0)
+    )
 
 
 class BedrockService:
+    """
+    Bedrock calls of one caller. Every call waits for a slot of the shared
+    scheduler at this instance's `priority` (interactive, generation or
+    ingestion).
+
+    Text prompts may contain CACHE_BREAK markers (see prompt_cache); the part
+    before each one is sent as a cacheable prefix to models that support it.
+
+    A failed call raises a BedrockError subclass. `model_id` may be a
+    fallback chain (see model_chain), tried in order until a model answers;
+    `timeout` is the latency budget of the whole call, fallbacks included,
+    and `hedge` races a second attempt against one slower than the model's
+    p95.
+    """
 
     def __init__(
         self,
         model_id="anthropic.claude-3-5-sonnet-20240620-v1:0",
+        priority=GENERATION,
     ):
         self.model_id = model_id
-        self.client = boto3.client("bedrock-runtime", region_name="us-east-1")
+        self.priority = priority
+        self.client = boto3.client(
+            "bedrock-runtime",
+            region_name=BEDROCK_REGION,
+            endpoint_url=BEDROCK_ENDPOINT_URL,
+        )
         self.logger = get_logger("[BedrockService]")
 
+    @contextmanager
+    def _slot(self, model_id, tokens):
+        # Inside an attempt, the slot wait is bounded by what is left of the
+        # budget and nothing is sent once the caller has given up
+        budget = getattr(_attempt_local, "budget", None)
+        if budget is None:
+            with bedrock_scheduler.slot(model_id, self.priority, tokens) as slot:
+                yield slot
+            return
+
+        budget.check(model_id)
+        with bedrock_scheduler.slot(
+            model_id, self.priority, tokens, timeout=budget.remaining()
+        ) as slot:
+            budget.check(model_id)
+            yield slot
+
+    def _call(self, operation, model_id, attempt, timeout=None, hedge=False):
+        models = model_chain(model_id)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        error = None
+        for position, model in enumerate(models):
+            budget = None
+            if deadline is not None:
+                # Leave every fallback an equal share of what is left
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                budget = remaining / (len(models) - position)
+            try:
+                return self._call_model(model, attempt, budget, hedge)
+            except BedrockError as e:
+                error = e
+                if position + 1 < len(models):
+                    self.logger.warning(
+                        f"[{operation}] {type(e).__name__} from {model}, "
+                        f"falling back to {models[position + 1]}: {e}"
+                    )
+
+        if error is None:
+            error = BedrockTimeout(
+                f"No response within the {timeout}s budget", models[-1]
+            )
+        self.logger.error(f"[{operation}] {type(error).__name__}: {error}")
+        raise error
+
+    def _call_model(self, model_id, attempt, timeout, hedge):
+        started = time.monotonic()
+        deadline = None if timeout is None else started + timeout
+        hedge_after = model_latency.p95(model_id) if hedge else None
+        hedge_at = None if hedge_after is None else started + hedge_after
+
+        budget = _AttemptBudget(deadline)
+        pending = {
+            _attempt_executor.submit(self._timed_attempt, model_id, attempt, budget)
+        }
+        error = None
+        try:
+            while pending:
+                wake_at = min(
+                    (t for t in (deadline, hedge_at) if t is not None), default=None
+                )
+                done, pending = wait(
+                    pending,
+                    timeout=(
+                        None if wake_at is None else max(0, wake_at - time.monotonic())
+                    ),
+                    return_when=FIRST_COMPLETED,
+                )
+                for future in done:
+                    try:
+                        return future.result()
+                    except BedrockError as e:
+                        error = e
+
+                if not pending:
+                    break
+                now = time.monotonic()
+                if deadline is not None and now >= deadline:
+                    raise BedrockTimeout(
+                        f"{model_id} did not answer within {timeout:.1f}s", model_id
+                    )
+                if hedge_at is not None and now >= hedge_at:
+                    self.logger.info(
+                        f"[_call_model] {model_id} slower than its p95 "
+                        f"({hedge_after:.2f}s), sending a hedged request"
+                    )
+                    pending.add(
+                        _attempt_executor.submit(
+                            self._timed_attempt, model_id, attempt, budget
+                        )
+                    )
+                    hedge_at = None
+            raise error
+        finally:
+            # The losers: unstarted ones never run, started ones send nothing more
+            budget.abandoned.set()
+            for future in pending:
+                future.cancel()
+
+    def _timed_attempt(self, model_id, attempt, budget=None):
+        started = time.monotonic()
+        _attempt_local.budget = budget
+        try:
+            result = attempt(model_id)
+        except Exception as e:
+            raise to_bedrock_error(e, model_id) from e
+        finally:
+            _attempt_local.budget = None
+        model_latency.record(model_id, time.monotonic() - started)
+        return result
+
     def invoke_model_with_text(
         self,
         prompt,
         model_id="anthropic.claude-3-5-sonnet-20240620-v1:0",
         temperature=0.5,
         max_tokens=2048,
+        timeout=None,
+        hedge=False,
     ):
-        payload = {
-            "anthropic_version": "bedrock-2023-05-31",
-            "temperature": temperature,
-            "max_tokens": max_tokens,
-            "messages": [
-                {
-                    "role": "user",
-                    "content": [{"type": "text", "text": prompt}],
-                }
-            ],
-        }
+        tokens = estimate_tokens(prompt_text(prompt), max_tokens)
 
-        try:
-            response = self.client.invoke_model(
-                modelId=model_id,
-                contentType="application/json",
-                body=json.dumps(payload),
-            )
-        except Exception as e:
-            self.logger.error(f"Error invoking model: {e}")
-            return {"error": str(e)}
+        def attempt(model):
+            payload = {
+                "anthropic_version": "bedrock-2023-05-31",
+                "temperature": temperature,
+                "max_tokens": max_tokens,
+                "messages": [
+                    {
+                        "role": "user",
+                        "content": anthropic_content(prompt, model),
+                    }
+                ],
+            }
+            with self._slot(model, tokens) as slot:
+                response = self.client.invoke_model(
+                    modelId=model,
+                    contentType="application/json",
+                    body=json.dumps(payload),
+                )
+                result = json.loads(response["body"].read())
+                slot.tokens = anthropic_usage(model, result.get("usage"))
+            return result.get("content", [{}])[0].get("text", "")
 
-        result = json.loads(response["body"].read())
-        return result.get("content", [{}])[0].get("text", "")
+        return self._call(
+            "invoke_model_with_text", model_id, attempt, timeout=timeout, hedge=hedge
+        )
 
     def invoke_image(
         self,
@@ -53,6 +303,7 @@ class BedrockService:
         image_prompt,
         model_id="anthropic.claude-3-haiku-20240307-v1:0",
         max_tokens=1000,
+        timeout=None,
     ):
         if not isinstance(file_bytes, (bytes, bytearray)):
             raise TypeError("file_bytes must be bytes-like object")
@@ -83,20 +334,31 @@ class BedrockService:
             "anthropic_version": "bedrock-2023-05-31",
         }
 
-        try:
-            response = self.client.invoke_model(
-                modelId=model_id,
-                contentType="application/json",
-                body=json.dumps(payload),
-            )
-        except Exception as e:
-            self.logger.error(f"Error invoking image model: {e}")
-            return {"error": str(e)}
+        # An image costs at most about 1600 input tokens
+        tokens = estimate_tokens(image_prompt, max_tokens) + 1600
+
+        def attempt(model):
+            with self._slot(model, tokens) as slot:
+                response = self.client.invoke_model(
+                    modelId=model,
+                    contentType="application/json",
+                    body=json.dumps(payload),
+                )
+                result = json.loads(response["body"].read())
+                slot.tokens = anthropic_usage(model, result.get("usage"))
+            return result.get("content", [{}])[0].get("text", "")
 
-        result = json.loads(response["body"].read())
-        return result.get("content", [{}])[0].get("text", "")
+        return self._call("invoke_image", model_id, attempt, timeout=timeout)
 
-    def invoke_document(self, doc_bytes, file_name, file_extension, prompt):
+    def invoke_document(
+        self,
+        doc_bytes,
+        file_name,
+        file_extension,
+        prompt,
+        model_id="anthropic.claude-3-sonnet-20240229-v1:0",
+        timeout=None,
+    ):
         if not file_name or not isinstance(file_name, str) or len(file_name) < 1:
             raise ValueError("file_name must be a non-empty string")
 
@@ -114,110 +376,159 @@ class BedrockService:
             ],
         }
 
-        try:
-            response = self.client.converse(
-                modelId="anthropic.claude-3-sonnet-20240229-v1:0",
-                messages=[doc_message],
-                inferenceConfig={
-                    "maxTokens": 2000,
-                    "temperature": 0,
-                },
-            )
-        except Exception as e:
-            self.logger.error(f"Error invoking document model: {e}")
-            return {"error": str(e)}
+        # The extracted text is about the size of the document's text layer,
+        # which is unknown here; the file size is an upper bound
+        tokens = estimate_tokens(prompt, 2000) + len(doc_bytes) // 4
+
+        def attempt(model):
+            with self._slot(model, tokens) as slot:
+                response = self.client.converse(
+                    modelId=model,
+                    messages=[doc_message],
+                    inferenceConfig={
+                        "maxTokens": 2000,
+                        "temperature": 0,
+                    },
+                )
+                prompt_cache_stats.record_converse(model, response.get("usage"))
+                slot.tokens = response.get("usage", {}).get("totalTokens")
+            return response["output"]["message"]["content"][0]["text"]
 
-        return response["output"]["message"]["content"][0]["text"]
+        return self._call("invoke_document", model_id, attempt, timeout=timeout)
 
-    def generate_embedding(self, text, model_id="amazon.titan-embed-text-v2:0"):
+    def generate_embedding(
+        self, text, model_id="amazon.titan-embed-text-v2:0", timeout=None, hedge=False
+    ):
         if not text or not isinstance(text, str) or len(text) < 1:
             raise ValueError("text must be a non-empty string")
 
         payload = {"inputText": text}
-        try:
-            response = self.client.invoke_model(
-                modelId=model_id,
-                contentType="application/json",
-                accept="application/json",
-                body=json.dumps(payload),
-            )
-        except Exception as e:
-            self.logger.error(f"Error generating embedding: {e}")
-            return {"error": str(e)}
 
-        result = json.loads(response["body"].read())
-        return result.get("embedding", [])
+        def attempt(model):
+            with self._slot(model, estimate_tokens(text)) as slot:
+                response = self.client.invoke_model(
+                    modelId=model,
+                    contentType="application/json",
+                    accept="application/json",
+                    body=json.dumps(payload),
+                )
+                result = json.loads(response["body"].read())
+                slot.tokens = result.get("inputTextTokenCount")
+            if not result.get("embedding"):
+                raise BedrockModelError(f"{model} returned no embedding", model)
+            return result["embedding"]
+
+        return self._call(
+            "generate_embedding", model_id, attempt, timeout=timeout, hedge=hedge
+        )
+
+    def invoke_model_with_stream(
+        self, prompt, temperature=0.5, max_tokens=1024, model_id=None
+    ):
+        yield from self._stream(
+            prompt, model_id or self.model_id, temperature, max_tokens
+        )
+
+    def stream_text(self, prompt, model_id, temperature=0.5, max_tokens=10000):
+        """Yield the response text as it is generated. Errors are raised."""
+        yield from self._stream(prompt, model_id, temperature, max_tokens)
+
+    def _stream(self, prompt, model_id, temperature, max_tokens):
+        # Streams are not hedged; a model that fails before its first chunk
+        # is replaced by the next one of the chain, a failure after it is raised
+        models = model_chain(model_id)
+        for position, model in enumerate(models):
+            started = False
+            try:
+                for text in self._stream_model(prompt, model, temperature, max_tokens):
+                    started = True
+                    yield text
+                return
+            except Exception as e:
+                error = to_bedrock_error(e, model)
+                if started or position + 1 == len(models):
+                    self.logger.error(
+                        f"[_stream] {type(error).__name__} from {model}: {error}"
+                    )
+                    raise error from e
+                self.logger.warning(
+                    f"[_stream] {type(error).__name__} from {model}, "
+                    f"falling back to {models[position + 1]}: {error}"
+                )
 
-    def invoke_model_with_stream(self, prompt, temperature=0.5, max_tokens=1024):
+    def _stream_model(self, prompt, model_id, temperature, max_tokens):
         body = {
             "anthropic_version": "bedrock-2023-05-31",
             "max_tokens": max_tokens,
             "temperature": temperature,
             "messages": [
-                {"role": "user", "content": [{"type": "text", "text": prompt}]}
+                {"role": "user", "content": anthropic_content(prompt, model_id)}
             ],
         }
 
-        try:
+        # The slot is held until the whole response has been read
+        tokens = estimate_tokens(prompt_text(prompt), max_tokens)
+        with self._slot(model_id, tokens) as slot:
             response = self.client.invoke_model_with_response_stream(
-                modelId=self.model_id,
+                modelId=model_id,
                 body=json.dumps(body),
             )
-        except Exception as e:
-            self.logger.error(f"Error invoking model with stream: {e}")
-            return []
 
-        for event in response["body"]:
-            if "chunk" in event and "bytes" in event["chunk"]:
-                chunk_data = json.loads(event["chunk"]["bytes"])
-                if chunk_data.get("type") == "content_block_delta":
-                    yield chunk_data["delta"].get("text", "")
+            for event in response["body"]:
+                if "chunk" in event and "bytes" in event["chunk"]:
+                    chunk_data = json.loads(event["chunk"]["bytes"])
+                    if chunk_data.get("type") == "message_start":
+                        # Input usage, including cache reads and writes
+                        anthropic_usage(
+                            model_id, chunk_data.get("message", {}).get("usage")
+                        )
+                    metrics = chunk_data.get("amazon-bedrock-invocationMetrics")
+                    if metrics:
+                        slot.tokens = metrics.get("inputTokenCount", 0) + metrics.get(
+                            "outputTokenCount", 0
+                        )
+                    if chunk_data.get("type") == "content_block_delta":
+                        yield chunk_data["delta"].get("text", "")
 
     def invoke_model_streaming(
         self, prompt, model_id, temperature=0.5, max_tokens=10000
     ):
-        body = {
-            "anthropic_version": "bedrock-2023-05-31",
-            "max_tokens": max_tokens,
-            "temperature": temperature,
-            "messages": [
-                {"role": "user", "content": [{"type": "text", "text": prompt}]}
-            ],
-        }
-        try:
-            response = self.client.invoke_model_with_response_stream(
-                modelId=model_id,
-                body=json.dumps(body),
+        return "".join(
+            self.stream_text(
+                prompt,
+                model_id=model_id,
+                temperature=temperature,
+                max_tokens=max_tokens,
             )
-        except Exception as e:
-            self.logger.error(f"Error invoking model streaming: {e}")
-            return []
-
-        collected_text = []
-        for event in response["body"]:
-            if "chunk" in event and "bytes" in event["chunk"]:
-                chunk_data = json.loads(event["chunk"]["bytes"])
-                if chunk_data.get("type") == "content_block_delta":
-                    collected_text.append(chunk_data["delta"].get("text", ""))
+        )
 
-        return "".join(collected_text)
-
-    def invoke_model_with_texttt(self, prompt):
-        max_tokens = 10000
-        temperature = 0.5
-        model_id = "amazon.nova-pro-v1:0"
-        conversation = [{"role": "user", "content": [{"text": prompt}]}]
+    def invoke_model_with_texttt(
+        self,
+        prompt,
+        model_id="amazon.nova-pro-v1:0",
+        max_tokens=10000,
+        temperature=0.5,
+        timeout=None,
+        hedge=False,
+    ):
+        # Nova/Nova Lite models require converse and inferenceConfig
+        inference_config = {"maxTokens": max_tokens, "temperature": temperature}
+        tokens = estimate_tokens(prompt_text(prompt), max_tokens)
 
-        try:
-            # Nova/Nova Lite models require converse and inferenceConfig
-            inference_config = {"maxTokens": max_tokens, "temperature": temperature}
-            response = self.client.converse(
-                modelId=model_id,
-                messages=conversation,
-                inferenceConfig=inference_config,
-            )
+        def attempt(model):
+            conversation = [
+                {"role": "user", "content": converse_content(prompt, model)}
+            ]
+            with self._slot(model, tokens) as slot:
+                response = self.client.converse(
+                    modelId=model,
+                    messages=conversation,
+                    inferenceConfig=inference_config,
+                )
+                prompt_cache_stats.record_converse(model, response.get("usage"))
+                slot.tokens = response.get("usage", {}).get("totalTokens")
             return response["output"]["message"]["content"][0]["text"]
 
-        except Exception as e:
-            self.logger.error(f"Error invoking model: {e}")
-            return {"error": str(e)}
+        return self._call(
+            "invoke_model_with_texttt", model_id, attempt, timeout=timeout, hedge=hedge
+        )
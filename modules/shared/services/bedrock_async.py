@@ -0,0 +1,404 @@
+import os
+import json
+import time
+import base64
+import asyncio
+from urllib.parse import quote
+
+import aiohttp
+import boto3
+from botocore.auth import SigV4Auth
+from botocore.awsrequest import AWSRequest
+from botocore.eventstream import EventStreamBuffer
+from yarl import URL
+
+from extensions import get_logger
+from modules.shared.services.bedrock import (
+    BEDROCK_ENDPOINT_URL,
+    BEDROCK_REGION,
+    anthropic_usage,
+    model_chain,
+    model_latency,
+)
+from modules.shared.services.bedrock_errors import (
+    BedrockError,
+    BedrockModelError,
+    BedrockThrottled,
+    BedrockTimeout,
+    error_for_code,
+    to_bedrock_error,
+)
+from modules.shared.services.bedrock_scheduler import (
+    GENERATION,
+    bedrock_scheduler,
+    estimate_tokens,
+)
+from modules.shared.services.prompt_cache import (
+    anthropic_content,
+    converse_content,
+    prompt_cache_stats,
+    prompt_text,
+)
+
+# Connections kept open to Bedrock per event loop, shared by all the calls of
+# the loop; each streamed answer holds one for its whole duration
+ASYNC_POOL_CONNECTIONS = int(os.getenv("BEDROCK_ASYNC_POOL_CONNECTIONS", "200"))
+ASYNC_CONNECT_TIMEOUT = float(os.getenv("BEDROCK_ASYNC_CONNECT_TIMEOUT_SECONDS", "10"))
+# Longest silence between two reads of a response, streamed ones included
+ASYNC_READ_TIMEOUT = float(os.getenv("BEDROCK_ASYNC_READ_TIMEOUT_SECONDS", "60"))
+
+
+class AsyncBedrockService:
+    """
+    BedrockService for asyncio: the same calls, fallback chains, latency
+    budgets, hedging and scheduler priorities, over aiohttp instead of boto3.
+    A waiting or streaming call holds no thread, so one event loop can serve
+    hundreds of concurrent answers.
+
+    Requests go to the Bedrock runtime REST API, signed with SigV4 using the
+    boto3 credential chain. A hedged or timed out attempt is cancelled, which
+    closes its connection and frees its scheduler slot.
+    """
+
+    def __init__(
+        self,
+        model_id="anthropic.claude-3-5-sonnet-20240620-v1:0",
+        priority=GENERATION,
+        endpoint_url=None,
+        region=BEDROCK_REGION,
+    ):
+        self.model_id = model_id
+        self.priority = priority
+        self.region = region
+        self.endpoint_url = (
+            endpoint_url
+            or BEDROCK_ENDPOINT_URL
+            or f"https://bedrock-runtime.{region}.amazonaws.com"
+        ).rstrip("/")
+        self.logger = get_logger("[AsyncBedrockService]")
+        self._credentials = None
+        self._sessions = {}
+
+    def _http(self):
+        loop = asyncio.get_running_loop()
+        session = self._sessions.get(loop)
+        if session is None or session.closed:
+            session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=ASYNC_POOL_CONNECTIONS),
+                timeout=aiohttp.ClientTimeout(
+                    connect=ASYNC_CONNECT_TIMEOUT, sock_read=ASYNC_READ_TIMEOUT
+                ),
+            )
+            self._sessions[loop] = session
+        return session
+
+    async def close(self):
+        session = self._sessions.pop(asyncio.get_running_loop(), None)
+        if session is not None:
+            await session.close()
+
+    def _signed_headers(self, url, body, accept):
+        if self._credentials is None:
+            self._credentials = boto3.Session().get_credentials()
+        if self._credentials is None:
+            raise BedrockModelError("No AWS credentials to sign Bedrock requests")
+
+        request = AWSRequest(
+            method="POST",
+            url=url,
+            data=body,
+            headers={"Content-Type": "application/json", "Accept": accept},
+        )
+        SigV4Auth(
+            self._credentials.get_frozen_credentials(), "bedrock", self.region
+        ).add_auth(request)
+        return dict(request.headers.items())
+
+    async def _post(self, model_id, action, payload, accept="application/json"):
+        # The model id is a path segment; it is sent exactly as it was signed
+        url = f"{self.endpoint_url}/model/{quote(model_id, safe='')}/{action}"
+        body = json.dumps(payload).encode("utf-8")
+        headers = self._signed_headers(url, body, accept)
+
+        response = await self._http().post(
+            URL(url, encoded=True), data=body, headers=headers
+        )
+        if response.status >= 400:
+            try:
+                message = (await response.json(content_type=None)).get("message")
+            except ValueError:
+                message = None
+            response.release()
+            code = response.headers.get("x-amzn-ErrorType", "").split(":")[0]
+            if not code and response.status in (429, 503):
+                code = "ThrottlingException"
+            raise error_for_code(
+                code, f"HTTP {response.status} {code}: {message}", model_id
+            )
+        return response
+
+    async def _call(self, operation, model_id, attempt, timeout=None, hedge=False):
+        models = model_chain(model_id)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        error = None
+        for position, model in enumerate(models):
+            budget = None
+            if deadline is not None:
+                # Leave every fallback an equal share of what is left
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                budget = remaining / (len(models) - position)
+            try:
+                return await self._call_model(model, attempt, budget, hedge)
+            except BedrockError as e:
+                error = e
+                if position + 1 < len(models):
+                    self.logger.warning(
+                        f"[{operation}] {type(e).__name__} from {model}, "
+                        f"falling back to {models[position + 1]}: {e}"
+                    )
+
+        if error is None:
+            error = BedrockTimeout(
+                f"No response within the {timeout}s budget", models[-1]
+            )
+        self.logger.error(f"[{operation}] {type(error).__name__}: {error}")
+        raise error
+
+    async def _call_model(self, model_id, attempt, timeout, hedge):
+        started = time.monotonic()
+        deadline = None if timeout is None else started + timeout
+        hedge_after = model_latency.p95(model_id) if hedge else None
+        hedge_at = None if hedge_after is None else started + hedge_after
+
+        pending = {asyncio.ensure_future(self._timed_attempt(model_id, attempt))}
+        error = None
+        try:
+            while pending:
+                wake_at = min(
+                    (t for t in (deadline, hedge_at) if t is not None), default=None
+                )
+                done, pending = await asyncio.wait(
+                    pending,
+                    timeout=(
+                        None if wake_at is None else max(0, wake_at - time.monotonic())
+                    ),
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                for task in done:
+                    try:
+                        return task.result()
+                    except BedrockError as e:
+                        error = e
+
+                if not pending:
+                    break
+                now = time.monotonic()
+                if deadline is not None and now >= deadline:
+                    raise BedrockTimeout(
+                        f"{model_id} did not answer within {timeout:.1f}s", model_id
+                    )
+                if hedge_at is not None and now >= hedge_at:
+                    self.logger.info(
+                        f"[_call_model] {model_id} slower than its p95 "
+                        f"({hedge_after:.2f}s), sending a hedged request"
+                    )
+                    pending.add(
+                        asyncio.ensure_future(self._timed_attempt(model_id, attempt))
+                    )
+                    hedge_at = None
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def _timed_attempt(self, model_id, attempt):
+        started = time.monotonic()
+        try:
+            result = await attempt(model_id)
+        except asyncio.TimeoutError as e:
+            raise BedrockTimeout(f"{model_id}: read timed out", model_id) from e
+        except aiohttp.ClientConnectionError as e:
+            raise BedrockThrottled(f"{model_id}: {e}", model_id) from e
+        except Exception as e:
+            raise to_bedrock_error(e, model_id) from e
+        model_latency.record(model_id, time.monotonic() - started)
+        return result
+
+    async def invoke_model_with_text(
+        self,
+        prompt,
+        model_id="anthropic.claude-3-5-sonnet-20240620-v1:0",
+        temperature=0.5,
+        max_tokens=2048,
+        timeout=None,
+        hedge=False,
+    ):
+        tokens = estimate_tokens(prompt_text(prompt), max_tokens)
+
+        async def attempt(model):
+            payload = {
+                "anthropic_version": "bedrock-2023-05-31",
+                "temperature": temperature,
+                "max_tokens": max_tokens,
+                "messages": [
+                    {"role": "user", "content": anthropic_content(prompt, model)}
+                ],
+            }
+            async with bedrock_scheduler.async_slot(
+                model, self.priority, tokens
+            ) as slot:
+                async with await self._post(model, "invoke", payload) as response:
+                    result = await response.json(content_type=None)
+                slot.tokens = anthropic_usage(model, result.get("usage"))
+            return result.get("content", [{}])[0].get("text", "")
+
+        return await self._call(
+            "invoke_model_with_text", model_id, attempt, timeout=timeout, hedge=hedge
+        )
+
+    async def invoke_model_with_texttt(
+        self,
+        prompt,
+        model_id="amazon.nova-pro-v1:0",
+        max_tokens=10000,
+        temperature=0.5,
+        timeout=None,
+        hedge=False,
+    ):
+        tokens = estimate_tokens(prompt_text(prompt), max_tokens)
+
+        async def attempt(model):
+            payload = {
+                "messages": [
+                    {"role": "user", "content": converse_content(prompt, model)}
+                ],
+                "inferenceConfig": {
+                    "maxTokens": max_tokens,
+                    "temperature": temperature,
+                },
+            }
+            async with bedrock_scheduler.async_slot(
+                model, self.priority, tokens
+            ) as slot:
+                async with await self._post(model, "converse", payload) as response:
+                    result = await response.json(content_type=None)
+                prompt_cache_stats.record_converse(model, result.get("usage"))
+                slot.tokens = result.get("usage", {}).get("totalTokens")
+            return result["output"]["message"]["content"][0]["text"]
+
+        return await self._call(
+            "invoke_model_with_texttt", model_id, attempt, timeout=timeout, hedge=hedge
+        )
+
+    async def generate_embedding(
+        self, text, model_id="amazon.titan-embed-text-v2:0", timeout=None, hedge=False
+    ):
+        if not text or not isinstance(text, str) or len(text) < 1:
+            raise ValueError("text must be a non-empty string")
+
+        async def attempt(model):
+            async with bedrock_scheduler.async_slot(
+                model, self.priority, estimate_tokens(text)
+            ) as slot:
+                async with await self._post(
+                    model, "invoke", {"inputText": text}
+                ) as response:
+                    result = await response.json(content_type=None)
+                slot.tokens = result.get("inputTextTokenCount")
+            if not result.get("embedding"):
+                raise BedrockModelError(f"{model} returned no embedding", model)
+            return result["embedding"]
+
+        return await self._call(
+            "generate_embedding", model_id, attempt, timeout=timeout, hedge=hedge
+        )
+
+    async def stream_text(
+        self, prompt, model_id=None, temperature=0.5, max_tokens=1024
+    ):
+        """Yield the response text as it is generated. Errors are raised."""
+        # Streams are not hedged; a model that fails before its first chunk
+        # is replaced by the next one of the chain, a failure after it is raised
+        models = model_chain(model_id or self.model_id)
+        for position, model in enumerate(models):
+            started = False
+            try:
+                async for text in self._stream_model(
+                    prompt, model, temperature, max_tokens
+                ):
+                    started = True
+                    yield text
+                return
+            except asyncio.TimeoutError as e:
+                error = BedrockTimeout(f"{model}: read timed out", model)
+                cause = e
+            except aiohttp.ClientConnectionError as e:
+                error = BedrockThrottled(f"{model}: {e}", model)
+                cause = e
+            except Exception as e:
+                error = to_bedrock_error(e, model)
+                cause = e
+            if started or position + 1 == len(models):
+                self.logger.error(
+                    f"[stream_text] {type(error).__name__} from {model}: {error}"
+                )
+                raise error from cause
+            self.logger.warning(
+                f"[stream_text] {type(error).__name__} from {model}, "
+                f"falling back to {models[position + 1]}: {error}"
+            )
+
+    async def _stream_model(self, prompt, model_id, temperature, max_tokens):
+        payload = {
+            "anthropic_version": "bedrock-2023-05-31",
+            "max_tokens": max_tokens,
+            "temperature": temperature,
+            "messages": [
+                {"role": "user", "content": anthropic_content(prompt, model_id)}
+            ],
+        }
+
+        # The slot is held until the whole response has been read
+        tokens = estimate_tokens(prompt_text(prompt), max_tokens)
+        async with bedrock_scheduler.async_slot(
+            model_id, self.priority, tokens
+        ) as slot:
+            async with await self._post(
+                model_id,
+                "invoke-with-response-stream",
+                payload,
+                accept="application/vnd.amazon.eventstream",
+            ) as response:
+                events = EventStreamBuffer()
+                async for data in response.content.iter_any():
+                    events.add_data(data)
+                    for event in events:
+                        chunk_data = self._chunk(model_id, event)
+                        if chunk_data is None:
+                            continue
+                        if chunk_data.get("type") == "message_start":
+                            # Input usage, including cache reads and writes
+                            anthropic_usage(
+                                model_id, chunk_data.get("message", {}).get("usage")
+                            )
+                        metrics = chunk_data.get("amazon-bedrock-invocationMetrics")
+                        if metrics:
+                            slot.tokens = metrics.get(
+                                "inputTokenCount", 0
+                            ) + metrics.get("outputTokenCount", 0)
+                        if chunk_data.get("type") == "content_block_delta":
+                            yield chunk_data["delta"].get("text", "")
+
+    def _chunk(self, model_id, event):
+        # The model's event of an eventstream message, or None for other events
+        headers = event.headers
+        if headers.get(":message-type") == "exception":
+            # Stream exceptions are named like throttlingException
+            code = headers.get(":exception-type", "")
+            message = json.loads(event.payload or b"{}").get("message")
+            raise error_for_code(code[:1].upper() + code[1:], message, model_id)
+        if headers.get(":event-type") != "chunk":
+            return None
+        return json.loads(base64.b64decode(json.loads(event.payload)["bytes"]))
@@ -0,0 +1,57 @@
+from botocore.exceptions import (
+    ClientError,
+    ConnectTimeoutError,
+    EndpointConnectionError,
+    ReadTimeoutError,
+)
+
+THROTTLING_CODES = {
+    "ThrottlingException",
+    "TooManyRequestsException",
+    "ServiceQuotaExceededException",
+    "ServiceUnavailableException",
+}
+TIMEOUT_CODES = {"ModelTimeoutException"}
+
+
+class BedrockError(Exception):
+    """A Bedrock call that produced no usable response."""
+
+    def __init__(self, message, model_id=None):
+        super().__init__(message)
+        self.model_id = model_id
+
+
+class BedrockTimeout(BedrockError):
+    """No response within the call's latency budget (or the model timed out)."""
+
+
+class BedrockThrottled(BedrockError):
+    """Bedrock rejected the call for quota or capacity reasons."""
+
+
+class BedrockModelError(BedrockError):
+    """Any other failure: invalid request, model error, malformed response."""
+
+
+def error_for_code(code, message, model_id):
+    """The typed error for a Bedrock error code like ThrottlingException."""
+    if code in THROTTLING_CODES:
+        return BedrockThrottled(f"{model_id}: {message}", model_id)
+    if code in TIMEOUT_CODES:
+        return BedrockTimeout(f"{model_id}: {message}", model_id)
+    return BedrockModelError(f"{model_id}: {message}", model_id)
+
+
+def to_bedrock_error(error, model_id):
+    """The typed error for an exception raised by a Bedrock call."""
+    if isinstance(error, BedrockError):
+        return error
+    if isinstance(error, ClientError):
+        code = error.response.get("Error", {}).get("Code", "")
+        return error_for_code(code, error, model_id)
+    if isinstance(error, (ReadTimeoutError, ConnectTimeoutError)):
+        return BedrockTimeout(f"{model_id}: {error}", model_id)
+    if isinstance(error, EndpointConnectionError):
+        return BedrockThrottled(f"{model_id}: {error}", model_id)
+    return BedrockModelError(f"{model_id}: {error}", model_id)
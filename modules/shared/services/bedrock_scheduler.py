@@ -0,0 +1,342 @@
+import os
+import json
+import heapq
+import asyncio
+import time
+import itertools
+import threading
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+
+import numpy as np
+
+from extensions import get_logger
+from modules.shared.services.bedrock_errors import BedrockTimeout
+
+# Priority classes, highest first
+INTERACTIVE = "interactive"
+GENERATION = "generation"
+INGESTION = "ingestion"
+PRIORITIES = [INTERACTIVE, GENERATION, INGESTION]
+
+# How long a call may wait for a slot before it fails
+DEADLINES = {
+    INTERACTIVE: float(os.getenv("BEDROCK_DEADLINE_INTERACTIVE_SECONDS", "30")),
+    GENERATION: float(os.getenv("BEDROCK_DEADLINE_GENERATION_SECONDS", "300")),
+    INGESTION: float(os.getenv("BEDROCK_DEADLINE_INGESTION_SECONDS", "900")),
+}
+
+# Limits of models without an entry in BEDROCK_MODEL_LIMITS, a JSON object
+# like {"amazon.titan-embed-text-v2:0": {"concurrency": 16, "tokens_per_minute": 300000}}.
+# 0 means unlimited: only the models given limits there, after their Bedrock
+# quotas, are throttled.
+DEFAULT_CONCURRENCY = int(os.getenv("BEDROCK_DEFAULT_CONCURRENCY", "0"))
+DEFAULT_TOKENS_PER_MINUTE = int(os.getenv("BEDROCK_DEFAULT_TOKENS_PER_MINUTE", "0"))
+MODEL_LIMITS = json.loads(os.getenv("BEDROCK_MODEL_LIMITS", "{}"))
+
+METRIC_SAMPLES = 1000
+# How often a coroutine waiting for a slot checks whether it was admitted
+ASYNC_POLL_SECONDS = 0.02
+
+
+class BedrockQueueTimeout(BedrockTimeout):
+    pass
+
+
+def estimate_tokens(text="", max_tokens=0):
+    """Rough reservation for a call: about 4 characters per input token plus the output cap."""
+    return len(text or "") // 4 + max_tokens
+
+
+class Reservation:
+    """Handed to the caller while it holds a slot; set `tokens` to the actual usage once known."""
+
+    def __init__(self, tokens):
+        self.reserved = tokens
+        self.tokens = None
+
+
+class _ModelLane:
+    """
+    Admission for one model: at most `concurrency` calls in flight and a
+    token bucket refilled at `tokens_per_minute`. Waiters are served strictly
+    by priority, then arrival; a waiter that needs more tokens than are left
+    holds back the ones behind it.
+    """
+
+    def __init__(self, model_id, concurrency, tokens_per_minute):
+        self.model_id = model_id
+        self.concurrency = concurrency
+        self.capacity = tokens_per_minute
+        self.tokens = float(tokens_per_minute)
+        self.refill_per_second = tokens_per_minute / 60.0
+        self.updated = time.monotonic()
+        self.in_flight = 0
+        self.waiters = []
+        self.condition = threading.Condition()
+        self._sequence = itertools.count()
+
+    def acquire(self, priority, tokens, deadline):
+        if self.capacity:
+            tokens = min(tokens, self.capacity)
+        with self.condition:
+            entry = self._enqueue(priority, tokens)
+            while True:
+                admitted, refill_wait = self._admit(entry)
+                if admitted:
+                    return tokens
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._give_up(entry, priority)
+
+                timeout = remaining
+                if refill_wait is not None:
+                    # Only the refill can admit it, no release will notify
+                    timeout = min(timeout, refill_wait)
+                self.condition.wait(max(timeout, 0.001))
+
+    async def acquire_async(self, priority, tokens, deadline):
+        # Same admission as acquire, without blocking the event loop: the
+        # coroutine waits in the same queue and polls for its turn
+        if self.capacity:
+            tokens = min(tokens, self.capacity)
+        with self.condition:
+            entry = self._enqueue(priority, tokens)
+        try:
+            while True:
+                with self.condition:
+                    admitted, refill_wait = self._admit(entry)
+                    if admitted:
+                        return tokens
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._give_up(entry, priority)
+                await asyncio.sleep(
+                    min(
+                        remaining, refill_wait or ASYNC_POLL_SECONDS, ASYNC_POLL_SECONDS
+                    )
+                )
+        except asyncio.CancelledError:
+            with self.condition:
+                if entry in self.waiters:
+                    self._remove(entry)
+            raise
+
+    def _enqueue(self, priority, tokens):
+        entry = (PRIORITIES.index(priority), next(self._sequence), tokens)
+        heapq.heappush(self.waiters, entry)
+        return entry
+
+    def _admit(self, entry):
+        # With the condition held. Returns whether `entry` got its slot and
+        # tokens, and how long only a refill can keep it waiting.
+        tokens = entry[2]
+        self._refill()
+        is_head = self.waiters[0] == entry
+        has_slot = not self.concurrency or self.in_flight < self.concurrency
+        has_tokens = not self.capacity or self.tokens >= tokens
+        if is_head and has_slot and has_tokens:
+            heapq.heappop(self.waiters)
+            self.in_flight += 1
+            if self.capacity:
+                self.tokens -= tokens
+            # The next waiter may fit as well
+            self.condition.notify_all()
+            return True, None
+        if is_head and has_slot:
+            return False, (tokens - self.tokens) / self.refill_per_second
+        return False, None
+
+    def _give_up(self, entry, priority):
+        self._remove(entry)
+        raise BedrockQueueTimeout(
+            f"No {priority} slot for {self.model_id} before the deadline"
+        )
+
+    def _remove(self, entry):
+        self.waiters.remove(entry)
+        heapq.heapify(self.waiters)
+        self.condition.notify_all()
+
+    def release(self, reserved, used=None):
+        with self.condition:
+            self.in_flight -= 1
+            if self.capacity and used is not None:
+                self._refill()
+                self.tokens = min(self.capacity, self.tokens + reserved - used)
+            self.condition.notify_all()
+
+    def state(self):
+        with self.condition:
+            self._refill()
+            queued = {priority: 0 for priority in PRIORITIES}
+            for rank, _, _ in self.waiters:
+                queued[PRIORITIES[rank]] += 1
+            return {
+                "concurrency": self.concurrency,
+                "in_flight": self.in_flight,
+                "queued": queued,
+                "tokens_per_minute": self.capacity,
+                "tokens_available": int(self.tokens) if self.capacity else None,
+            }
+
+    def _refill(self):
+        now = time.monotonic()
+        if self.capacity:
+            self.tokens = min(
+                self.capacity,
+                self.tokens + (now - self.updated) * self.refill_per_second,
+            )
+        self.updated = now
+
+
+class _CallStats:
+    def __init__(self):
+        self.calls = 0
+        self.timeouts = 0
+        self.queue_wait = deque(maxlen=METRIC_SAMPLES)
+        self.service_time = deque(maxlen=METRIC_SAMPLES)
+
+    def as_dict(self):
+        return {
+            "calls": self.calls,
+            "timeouts": self.timeouts,
+            "queue_wait_seconds": _summary(self.queue_wait),
+            "service_seconds": _summary(self.service_time),
+        }
+
+
+def _summary(samples):
+    if not samples:
+        return None
+    values = np.fromiter(samples, dtype=np.float64)
+    p50, p95 = np.percentile(values, [50, 95])
+    return {
+        "mean": round(float(values.mean()), 4),
+        "p50": round(float(p50), 4),
+        "p95": round(float(p95), 4),
+        "max": round(float(values.max()), 4),
+    }
+
+
+class BedrockScheduler:
+    """
+    Central admission for every Bedrock call of the process.
+
+    Each call takes a slot on its model's lane for as long as it runs
+    (including a streamed response) and reserves its estimated tokens from the
+    model's per-minute budget; the actual usage is settled on release. Chat
+    traffic is served before generation, and generation before ingestion, so
+    a large import cannot starve interactive latency. Queue wait and service
+    time are recorded per model and priority.
+    """
+
+    def __init__(
+        self,
+        default_concurrency=DEFAULT_CONCURRENCY,
+        default_tokens_per_minute=DEFAULT_TOKENS_PER_MINUTE,
+        model_limits=None,
+    ):
+        self.logger = get_logger("[BedrockScheduler]")
+        self.default_concurrency = default_concurrency
+        self.default_tokens_per_minute = default_tokens_per_minute
+        self.model_limits = model_limits or {}
+        self._lock = threading.Lock()
+        self._lanes = {}
+        self._stats = {}
+
+    @contextmanager
+    def slot(self, model_id, priority=GENERATION, tokens=0, timeout=None):
+        lane, stats, queued_at, deadline = self._queue(model_id, priority, timeout)
+        try:
+            reserved = lane.acquire(priority, tokens, deadline)
+        except BedrockQueueTimeout:
+            self._timed_out(model_id, priority, stats, queued_at)
+            raise
+
+        started_at = time.monotonic()
+        reservation = Reservation(reserved)
+        try:
+            yield reservation
+        finally:
+            self._release(lane, stats, reservation, queued_at, started_at)
+
+    @asynccontextmanager
+    async def async_slot(self, model_id, priority=GENERATION, tokens=0, timeout=None):
+        """slot() for coroutines; sync and async calls share the same lanes."""
+        lane, stats, queued_at, deadline = self._queue(model_id, priority, timeout)
+        try:
+            reserved = await lane.acquire_async(priority, tokens, deadline)
+        except BedrockQueueTimeout:
+            self._timed_out(model_id, priority, stats, queued_at)
+            raise
+
+        started_at = time.monotonic()
+        reservation = Reservation(reserved)
+        try:
+            yield reservation
+        finally:
+            self._release(lane, stats, reservation, queued_at, started_at)
+
+    def _queue(self, model_id, priority, timeout):
+        queued_at = time.monotonic()
+        deadline = queued_at + (timeout if timeout is not None else DEADLINES[priority])
+        return (
+            self._lane(model_id),
+            self._call_stats(model_id, priority),
+            queued_at,
+            deadline,
+        )
+
+    def _timed_out(self, model_id, priority, stats, queued_at):
+        with self._lock:
+            stats.timeouts += 1
+        self.logger.warning(
+            f"[slot] {priority} call to {model_id} timed out after "
+            f"{time.monotonic() - queued_at:.1f}s in queue"
+        )
+
+    def _release(self, lane, stats, reservation, queued_at, started_at):
+        lane.release(reservation.reserved, reservation.tokens)
+        with self._lock:
+            stats.calls += 1
+            stats.queue_wait.append(started_at - queued_at)
+            stats.service_time.append(time.monotonic() - started_at)
+
+    def metrics(self):
+        with self._lock:
+            lanes = dict(self._lanes)
+            stats = {key: value.as_dict() for key, value in self._stats.items()}
+
+        models = {}
+        for model_id, lane in lanes.items():
+            models[model_id] = {
+                **lane.state(),
+                "priorities": {
+                    priority: stats[(model_id, priority)]
+                    for priority in PRIORITIES
+                    if (model_id, priority) in stats
+                },
+            }
+        return {"models": models}
+
+    def _lane(self, model_id):
+        with self._lock:
+            lane = self._lanes.get(model_id)
+            if lane is None:
+                limits = self.model_limits.get(model_id, {})
+                lane = _ModelLane(
+                    model_id,
+                    limits.get("concurrency", self.default_concurrency),
+                    limits.get("tokens_per_minute", self.default_tokens_per_minute),
+                )
+                self._lanes[model_id] = lane
+            return lane
+
+    def _call_stats(self, model_id, priority):
+        with self._lock:
+            return self._stats.setdefault((model_id, priority), _CallStats())
+
+
+bedrock_scheduler = BedrockScheduler(model_limits=MODEL_LIMITS)
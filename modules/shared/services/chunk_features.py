@@ -0,0 +1,114 @@
+import threading
+from collections import OrderedDict
+
+from sqlalchemy import update
+
+from extensions import db, get_logger
+from modules.document.entity import DocumentChunks, Documents
+from modules.shared.services.pattern_matcher import PatternMatcher
+
+# Phrases that make a chunk good flashcard material
+DEFINITION_PATTERNS = [
+    "is a",
+    "refers to",
+    "is defined as",
+    "is the",
+    "means",
+    "represents",
+    "consists of",
+    "comprises",
+    "allows",
+    "enables",
+]
+COMPARISON_PATTERNS = [
+    "versus",
+    "compared to",
+    "difference between",
+    "advantages of",
+    "benefits of",
+    "in contrast to",
+    "unlike",
+]
+LIST_PATTERNS = [":", "• ", "- ", "1.", "2.", "first", "second", "key", "important"]
+
+# Column on DocumentChunks for each feature
+FEATURE_COLUMNS = {
+    "terms": "term_hits",
+    "definition": "definition_hits",
+    "comparison": "comparison_hits",
+    "list": "list_hits",
+}
+
+MAX_CACHED_MATCHERS = 64
+UPDATE_BATCH_SIZE = 1000
+
+_matchers = OrderedDict()
+_matchers_lock = threading.Lock()
+
+
+def feature_matcher(terms):
+    """Matcher for the course terms plus the fixed phrase lists, cached per term set."""
+    key = tuple(sorted({term.lower() for term in terms or [] if term}))
+    with _matchers_lock:
+        matcher = _matchers.get(key)
+        if matcher is not None:
+            _matchers.move_to_end(key)
+            return matcher
+
+    matcher = PatternMatcher(
+        {
+            "terms": key,
+            "definition": DEFINITION_PATTERNS,
+            "comparison": COMPARISON_PATTERNS,
+            "list": LIST_PATTERNS,
+        }
+    )
+    with _matchers_lock:
+        _matchers[key] = matcher
+        while len(_matchers) > MAX_CACHED_MATCHERS:
+            _matchers.popitem(last=False)
+    return matcher
+
+
+def chunk_features(text, terms=None, matcher=None):
+    """
+    Number of distinct course terms and definition/comparison/list phrases in
+    `text`, keyed by DocumentChunks column name. Matching is case-insensitive.
+    """
+    matcher = matcher or feature_matcher(terms)
+    counts = matcher.count((text or "").lower())
+    return {column: counts[group] for group, column in FEATURE_COLUMNS.items()}
+
+
+def refresh_course_features(course_id, terms, only_missing=False):
+    """
+    Recompute and store the features of a course's chunks, e.g. after its
+    term list changed. With `only_missing`, only chunks that were ingested
+    before features existed are filled in. Returns the stored features by
+    chunk id.
+    """
+    logger = get_logger("[ChunkFeatures]")
+    matcher = feature_matcher(terms)
+
+    query = (
+        db.session.query(DocumentChunks.id, DocumentChunks.text_en)
+        .join(Documents, DocumentChunks.document_id == Documents.id)
+        .filter(Documents.course_id == course_id)
+    )
+    if only_missing:
+        query = query.filter(DocumentChunks.term_hits.is_(None))
+
+    rows = [
+        {"id": chunk_id, **chunk_features(text, matcher=matcher)}
+        for chunk_id, text in query.yield_per(UPDATE_BATCH_SIZE)
+    ]
+    for start in range(0, len(rows), UPDATE_BATCH_SIZE):
+        db.session.execute(
+            update(DocumentChunks), rows[start : start + UPDATE_BATCH_SIZE]
+        )
+    db.session.commit()
+
+    logger.info(
+        f"[refresh_course_features] Updated features of {len(rows)} chunks for course {course_id}"
+    )
+    return {row["id"]: row for row in rows}
@@ -0,0 +1,33 @@
+import asyncio
+
+from flask import current_app
+
+
+def submit_with_app_context(executor, fn, *args, **kwargs):
+    """
+    Submit `fn` to `executor` inside a fresh application context.
+
+    Each worker thread then gets its own `db.session`, so database work can
+    run concurrently with the caller's session.
+    """
+    app = current_app._get_current_object()
+
+    def run():
+        with app.app_context():
+            return fn(*args, **kwargs)
+
+    return executor.submit(run)
+
+
+def run_in_app_context(app, executor, fn, *args, **kwargs):
+    """
+    Run `fn` on `executor` inside a fresh application context of `app` and
+    return an awaitable of its result, so coroutines can use the database
+    without blocking the event loop.
+    """
+
+    def run():
+        with app.app_context():
+            return fn(*args, **kwargs)
+
+    return asyncio.get_running_loop().run_in_executor(executor, run)
@@ -0,0 +1,63 @@
+import os
+import time
+import threading
+from sqlalchemy import update
+from extensions import db, get_logger
+from modules.document.entity import Organization
+
+
+class ContentVersionRegistry:
+    """
+    Per-organization content version, bumped every time new chunks are ingested.
+
+    The counter lives on the Organization row so every worker process sees the
+    same value; reads are served from a local copy that is refreshed from the
+    database at most every `refresh_seconds`.
+    """
+
+    def __init__(self, refresh_seconds=None):
+        self.refresh_seconds = (
+            refresh_seconds
+            if refresh_seconds is not None
+            else float(os.getenv("CONTENT_VERSION_REFRESH_SECONDS", "5"))
+        )
+        self.logger = get_logger("[ContentVersionRegistry]")
+        self._lock = threading.Lock()
+        self._versions = {}
+
+    def get(self, organization_id):
+        now = time.monotonic()
+        with self._lock:
+            cached = self._versions.get(organization_id)
+        if cached and now - cached[1] < self.refresh_seconds:
+            return cached[0]
+
+        version = (
+            db.session.query(Organization.content_version)
+            .filter(Organization.id == organization_id)
+            .scalar()
+        ) or 0
+
+        with self._lock:
+            self._versions[organization_id] = (version, now)
+        return version
+
+    def bump(self, organization_id):
+        version = db.session.execute(
+            update(Organization)
+            .where(Organization.id == organization_id)
+            .values(content_version=Organization.content_version + 1)
+            .returning(Organization.content_version)
+        ).scalar()
+        db.session.commit()
+        version = version or 0
+
+        with self._lock:
+            self._versions[organization_id] = (version, time.monotonic())
+        self.logger.info(
+            f"[bump] Organization {organization_id} content version is now {version}"
+        )
+        return version
+
+
+content_versions = ContentVersionRegistry()
@@ -0,0 +1,73 @@
+import threading
+
+import numpy as np
+
+from extensions import get_logger
+from modules.shared.services.bedrock_errors import BedrockError
+
+EMBEDDING_DIMENSION = 1024
+
+
+def embed_text(bedrock_service, text):
+    """Embedding of `text` as a list, or None when it cannot be computed."""
+    if not text:
+        return None
+    try:
+        embedding = bedrock_service.generate_embedding(text)
+    except BedrockError:
+        embedding = None
+    if not isinstance(embedding, list) or len(embedding) != EMBEDDING_DIMENSION:
+        get_logger("[EmbeddingDeduplicator]").warning(
+            f"[embed_text] No embedding for {text[:80]!r}"
+        )
+        return None
+    return embedding
+
+
+class EmbeddingDeduplicator:
+    """
+    Drops generated items whose text is too close to one already kept.
+
+    Holds the normalized embeddings of the items kept so far (seeded with the
+    existing rows) and accepts a new item only when its cosine similarity to
+    every one of them is below `threshold`. One instance may be shared by
+    several threads, e.g. the stages of a generation job.
+    """
+
+    def __init__(self, bedrock_service, threshold=0.9):
+        self.bedrock_service = bedrock_service
+        self.threshold = threshold
+        self._kept = np.empty((0, EMBEDDING_DIMENSION), dtype=np.float32)
+        self._lock = threading.Lock()
+
+    def embed(self, text):
+        return embed_text(self.bedrock_service, text)
+
+    def add_existing(self, embeddings):
+        rows = [
+            e for e in embeddings if e is not None and len(e) == EMBEDDING_DIMENSION
+        ]
+        if rows:
+            rows = self._normalize(np.asarray(rows))
+            with self._lock:
+                self._kept = np.vstack([self._kept, rows])
+
+    def keep(self, embedding):
+        """Whether an item with this embedding is new; if so it is remembered."""
+        if embedding is None:
+            return True
+        vector = self._normalize(np.asarray(embedding)[None, :])
+        with self._lock:
+            if (
+                len(self._kept)
+                and float((self._kept @ vector[0]).max()) >= self.threshold
+            ):
+                return False
+            self._kept = np.vstack([self._kept, vector])
+        return True
+
+    def _normalize(self, matrix):
+        matrix = np.array(matrix, dtype=np.float32)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return matrix / norms
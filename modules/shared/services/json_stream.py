@@ -0,0 +1,79 @@
+import json
+
+
+class JsonArrayStreamParser:
+    """
+    Incremental parser for a JSON array that arrives in pieces, such as a
+    model response streamed token by token.
+
+    `feed()` returns the elements of the top-level array that were completed
+    by the new text, each parsed with `json.loads`, so a caller can act on
+    the first element while later ones are still being generated. Text before
+    the opening bracket (prose, a code fence) is skipped. Only object and
+    array elements are emitted.
+    """
+
+    def __init__(self):
+        self._buffer = ""
+        self._position = 0
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        self._element_start = None
+        self.started = False
+        self.finished = False
+
+    def feed(self, text):
+        if self.finished or not text:
+            return []
+
+        self._buffer += text
+        elements = []
+        buffer = self._buffer
+        i = self._position
+        while i < len(buffer):
+            char = buffer[i]
+
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == "\\":
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+            elif not self.started:
+                if char == "[":
+                    self.started = True
+                    self._depth = 1
+            elif char == '"':
+                self._in_string = True
+            elif char in "{[":
+                if self._depth == 1:
+                    self._element_start = i
+                self._depth += 1
+            elif char in "}]":
+                self._depth -= 1
+                if self._depth == 1 and self._element_start is not None:
+                    elements.append(json.loads(buffer[self._element_start : i + 1]))
+                    self._element_start = None
+                elif self._depth == 0:
+                    self.finished = True
+                    break
+            i += 1
+
+        # Keep only the element in progress
+        keep_from = self._element_start if self._element_start is not None else i
+        self._buffer = buffer[keep_from:]
+        self._position = i - keep_from
+        if self._element_start is not None:
+            self._element_start = 0
+        return elements
+
+
+def iter_json_array(chunks):
+    """Yield the elements of a JSON array streamed as text chunks."""
+    parser = JsonArrayStreamParser()
+    for chunk in chunks:
+        yield from parser.feed(chunk)
+        if parser.finished:
+            return
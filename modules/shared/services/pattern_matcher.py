@@ -0,0 +1,85 @@
+from collections import deque
+
+
+class PatternMatcher:
+    """
+    Aho-Corasick automaton over named groups of patterns.
+
+    `count(text)` scans the text once and returns, per group, how many
+    distinct patterns of that group occur in it, which is what
+    `sum(1 for p in patterns if p in text)` gives per group but without one
+    scan per pattern. Matching is case-sensitive; callers lowercase both
+    sides when they want otherwise.
+    """
+
+    def __init__(self, groups):
+        self.group_names = list(groups)
+        self.patterns = []
+        pattern_groups = {}
+        for group_index, name in enumerate(self.group_names):
+            for pattern in groups[name]:
+                if not pattern:
+                    continue
+                if pattern not in pattern_groups:
+                    pattern_groups[pattern] = set()
+                    self.patterns.append(pattern)
+                pattern_groups[pattern].add(group_index)
+        self._pattern_groups = [
+            tuple(sorted(pattern_groups[pattern])) for pattern in self.patterns
+        ]
+        self._build()
+
+    def _build(self):
+        goto = [{}]
+        outputs = [set()]
+        for pattern_index, pattern in enumerate(self.patterns):
+            state = 0
+            for char in pattern:
+                if char not in goto[state]:
+                    goto.append({})
+                    outputs.append(set())
+                    goto[state][char] = len(goto) - 1
+                state = goto[state][char]
+            outputs[state].add(pattern_index)
+
+        # Breadth-first, so a state's failure target is complete before the
+        # state itself. Transitions are completed into a DFA: each state knows
+        # its next state for every character that appears in some pattern,
+        # and any other character goes back to the root.
+        fail = [0] * len(goto)
+        transitions = [dict(goto[0])]
+        transitions.extend({} for _ in range(len(goto) - 1))
+        queue = deque(goto[0].values())
+        while queue:
+            state = queue.popleft()
+            outputs[state] |= outputs[fail[state]]
+            transitions[state] = dict(transitions[fail[state]])
+            for char, target in goto[state].items():
+                fail[target] = transitions[fail[state]].get(char, 0)
+                queue.append(target)
+            transitions[state].update(goto[state])
+
+        self._transitions = transitions
+        self._outputs = [frozenset(output) if output else None for output in outputs]
+
+    def matches(self, text):
+        """Indices (into `patterns`) of the distinct patterns found in `text`."""
+        transitions = self._transitions
+        outputs = self._outputs
+        found = set()
+        state = 0
+        for char in text:
+            state = transitions[state].get(char, 0)
+            output = outputs[state]
+            if output is not None:
+                found |= output
+        return found
+
+    def count(self, text):
+        counts = dict.fromkeys(self.group_names, 0)
+        if not text:
+            return counts
+        for pattern_index in self.matches(text):
+            for group_index in self._pattern_groups[pattern_index]:
+                counts[self.group_names[group_index]] += 1
+        return counts
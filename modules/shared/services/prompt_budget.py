@@ -0,0 +1,80 @@
+import os
+
+from modules.shared.services.tokenizer import token_counter
+
+MODEL_CONTEXT_WINDOWS = [
+    # (model id prefix, context window in tokens)
+    ("anthropic.claude-3", 200000),
+    ("amazon.nova-pro", 300000),
+    ("amazon.nova-lite", 300000),
+    ("amazon.nova-micro", 128000),
+]
+DEFAULT_CONTEXT_WINDOW = 100000
+
+# Upper bound on prompt size regardless of the model's window, since latency
+# and cost grow with input length.
+MAX_INPUT_TOKENS = int(os.getenv("PROMPT_MAX_INPUT_TOKENS", "160000"))
+
+
+def context_window_for(model_id):
+    for prefix, window in MODEL_CONTEXT_WINDOWS:
+        if model_id.startswith(prefix):
+            return window
+    return DEFAULT_CONTEXT_WINDOW
+
+
+class PromptBudget:
+    """
+    Token budget for one model call.
+
+    The usable input is the model's context window minus the tokens reserved
+    for the output and a safety margin for tokenizer drift, capped at
+    `max_input_tokens`. `pack()` fills what is left after the fixed part of
+    the prompt with the highest scoring items that fit.
+    """
+
+    def __init__(
+        self,
+        model_id,
+        max_output_tokens,
+        max_input_tokens=None,
+        safety_margin=0.05,
+    ):
+        self.model_id = model_id
+        self.max_output_tokens = max_output_tokens
+        self.counter = token_counter(model_id)
+
+        window = context_window_for(model_id)
+        usable = int(window * (1 - safety_margin)) - max_output_tokens
+        self.max_input_tokens = min(usable, max_input_tokens or MAX_INPUT_TOKENS)
+
+    def count(self, text):
+        return self.counter.count(text)
+
+    def available(self, fixed_prompt=""):
+        return max(0, self.max_input_tokens - self.count(fixed_prompt))
+
+    def pack(self, items, text, score=None, budget=None, separator="\n"):
+        """
+        Greedily select items by descending `score` (input order when no score
+        is given) while their texts fit in `budget` tokens. Returns the selected
+        items in input order.
+        """
+        if budget is None:
+            budget = self.available()
+        separator_tokens = self.count(separator)
+
+        indexed = list(enumerate(items))
+        if score is not None:
+            indexed.sort(key=lambda pair: score(pair[1]), reverse=True)
+
+        selected = []
+        used = 0
+        for position, item in indexed:
+            tokens = self.count(text(item) or "") + separator_tokens
+            if used + tokens > budget:
+                continue
+            selected.append(position)
+            used += tokens
+
+        return [items[position] for position in sorted(selected)]
@@ -0,0 +1,151 @@
+import os
+import threading
+
+from extensions import get_logger
+
+# Prompt templates are laid out from the most to the least stable part, with
+# CACHE_BREAK between the parts. Everything before a break is a prefix that
+# Bedrock can cache and reuse for the next call with the same prefix (for
+# about five minutes); the text after the last break is never cached.
+CACHE_BREAK = "\n<<cache_break>>\n"
+
+PROMPT_CACHE_ENABLED = os.getenv("PROMPT_CACHE_ENABLED", "true").lower() == "true"
+# Model id fragments of the models that accept cache points; the others get
+# the prompt as a single block. The default generator models (Claude 3 Sonnet,
+# Claude 3.5 Sonnet v1 and Claude 3 Haiku) are not among them.
+PROMPT_CACHE_MODELS = [
+    model.strip()
+    for model in os.getenv(
+        "PROMPT_CACHE_MODELS",
+        "anthropic.claude-3-5-haiku,anthropic.claude-3-7-sonnet,"
+        "anthropic.claude-sonnet-4,anthropic.claude-opus-4,amazon.nova",
+    ).split(",")
+    if model.strip()
+]
+# Bedrock accepts at most 4 cache points per request
+MAX_CACHE_POINTS = 4
+# A prefix shorter than this is not cached by Bedrock, so no cache point is
+# sent after it (1024 tokens for most models, 2048 for the Claude Haiku ones)
+PROMPT_CACHE_MIN_TOKENS = int(os.getenv("PROMPT_CACHE_MIN_TOKENS", "1024"))
+
+
+def supports_prompt_cache(model_id):
+    return PROMPT_CACHE_ENABLED and any(
+        model in model_id for model in PROMPT_CACHE_MODELS
+    )
+
+
+def prompt_text(prompt):
+    """The prompt as plain text, without its cache breaks."""
+    return prompt.replace(CACHE_BREAK, "\n")
+
+
+def _segments(prompt, model_id):
+    if CACHE_BREAK not in prompt or not supports_prompt_cache(model_id):
+        return [prompt_text(prompt)]
+    # Bedrock rejects blank text blocks
+    return [segment for segment in prompt.split(CACHE_BREAK) if segment.strip()]
+
+
+def _cache_points(segments):
+    """Positions of the segments followed by a cache point."""
+    points = set()
+    prefix_chars = 0
+    for position, segment in enumerate(segments[:-1]):
+        prefix_chars += len(segment)
+        # About 4 characters per token, like estimate_tokens
+        if prefix_chars // 4 >= PROMPT_CACHE_MIN_TOKENS:
+            points.add(position)
+            if len(points) == MAX_CACHE_POINTS:
+                break
+    return points
+
+
+def anthropic_content(prompt, model_id):
+    """Content blocks of an Anthropic messages request, with a cache_control per break."""
+    segments = _segments(prompt, model_id)
+    points = _cache_points(segments)
+    blocks = []
+    for position, segment in enumerate(segments):
+        block = {"type": "text", "text": segment}
+        if position in points:
+            block["cache_control"] = {"type": "ephemeral"}
+        blocks.append(block)
+    return blocks
+
+
+def converse_content(prompt, model_id):
+    """Content of a Converse message, with a cachePoint per break."""
+    segments = _segments(prompt, model_id)
+    points = _cache_points(segments)
+    content = []
+    for position, segment in enumerate(segments):
+        content.append({"text": segment})
+        if position in points:
+            content.append({"cachePoint": {"type": "default"}})
+    return content
+
+
+class PromptCacheStats:
+    """Input tokens per model, split into uncached, read from cache and written to cache."""
+
+    def __init__(self):
+        self.logger = get_logger("[PromptCache]")
+        self._lock = threading.Lock()
+        self._models = {}
+
+    def record(self, model_id, input_tokens=0, cache_read=0, cache_write=0):
+        with self._lock:
+            stats = self._models.setdefault(
+                model_id,
+                {
+                    "calls": 0,
+                    "input_tokens": 0,
+                    "cache_read_tokens": 0,
+                    "cache_write_tokens": 0,
+                },
+            )
+            stats["calls"] += 1
+            stats["input_tokens"] += input_tokens or 0
+            stats["cache_read_tokens"] += cache_read or 0
+            stats["cache_write_tokens"] += cache_write or 0
+        if cache_read or cache_write:
+            self.logger.debug(
+                f"[record] {model_id}: {cache_read} tokens read from cache, "
+                f"{cache_write} written, {input_tokens} uncached"
+            )
+
+    def record_anthropic(self, model_id, usage):
+        if usage:
+            self.record(
+                model_id,
+                usage.get("input_tokens"),
+                usage.get("cache_read_input_tokens"),
+                usage.get("cache_creation_input_tokens"),
+            )
+
+    def record_converse(self, model_id, usage):
+        if usage:
+            self.record(
+                model_id,
+                usage.get("inputTokens"),
+                usage.get("cacheReadInputTokens"),
+                usage.get("cacheWriteInputTokens"),
+            )
+
+    def snapshot(self):
+        with self._lock:
+            models = {model_id: dict(stats) for model_id, stats in self._models.items()}
+        for stats in models.values():
+            total = (
+                stats["input_tokens"]
+                + stats["cache_read_tokens"]
+                + stats["cache_write_tokens"]
+            )
+            stats["cache_read_ratio"] = (
+                round(stats["cache_read_tokens"] / total, 3) if total else 0.0
+            )
+        return models
+
+
+prompt_cache_stats = PromptCacheStats()
@@ -0,0 +1,97 @@
+import os
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+from flask import Response
+
+
+class CachedResponse:
+    def __init__(self, body, last_modified=None, mimetype="application/json"):
+        self.body = body
+        self.etag = hashlib.sha1(body).hexdigest()
+        self.last_modified = last_modified
+        self.mimetype = mimetype
+        self.created = time.monotonic()
+
+    def to_response(self, request, max_age=0):
+        """Response with validators, turned into a 304 when the client's copy is current."""
+        response = Response(self.body, mimetype=self.mimetype)
+        response.set_etag(self.etag)
+        if self.last_modified is not None:
+            response.last_modified = self.last_modified
+        response.cache_control.private = True
+        response.cache_control.max_age = max_age
+        response.cache_control.must_revalidate = True
+        return response.make_conditional(request)
+
+
+class ResponseCache:
+    """
+    In-process LRU cache of serialized read responses.
+
+    Entries belong to a scope, e.g. ("flashcards", course_id). `invalidate()`
+    bumps the scope's generation, which makes every entry cached under the
+    previous one unreachable; they are then evicted as the LRU fills. Other
+    worker processes only see the invalidation through `ttl_seconds`.
+    """
+
+    def __init__(self, max_entries=2000, ttl_seconds=60):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._generations = {}
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, scope, key):
+        with self._lock:
+            cache_key = (scope, self._generations.get(scope, 0), key)
+            entry = self._entries.get(cache_key)
+            if entry is None or time.monotonic() - entry.created > self.ttl_seconds:
+                self._entries.pop(cache_key, None)
+                self._misses += 1
+                return None
+            self._entries.move_to_end(cache_key)
+            self._hits += 1
+            return entry
+
+    def set(self, scope, key, entry, generation=None):
+        """
+        Store `entry`. Pass the `generation()` read before building it so an
+        invalidation that happened meanwhile is not overwritten by stale data.
+        """
+        with self._lock:
+            current = self._generations.get(scope, 0)
+            if generation is not None and generation != current:
+                return
+            self._entries[(scope, current, key)] = entry
+            self._entries.move_to_end((scope, current, key))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def generation(self, scope):
+        with self._lock:
+            return self._generations.get(scope, 0)
+
+    def invalidate(self, scope):
+        with self._lock:
+            self._generations[scope] = self._generations.get(scope, 0) + 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "entries": len(self._entries),
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_rate": round(self._hits / lookups, 3) if lookups else 0.0,
+            }
+
+
+response_cache = ResponseCache(
+    max_entries=int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "2000")),
+    ttl_seconds=float(os.getenv("RESPONSE_CACHE_TTL_SECONDS", "60")),
+)
@@ -0,0 +1,194 @@
+import os
+import json
+import hashlib
+import threading
+from concurrent.futures import Future
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from flask import jsonify, request
+from sqlalchemy import delete, text
+from sqlalchemy.exc import OperationalError
+
+from extensions import db, get_logger
+from modules.document.entity import IdempotencyRecords
+
+# How long a response is replayed for a request with the same Idempotency-Key
+IDEMPOTENCY_TTL_SECONDS = int(os.getenv("IDEMPOTENCY_TTL_SECONDS", "86400"))
+# Without a key, an identical payload only gets the stored response this soon
+# after the first run finished (double clicks, client retries)
+COALESCE_REPLAY_SECONDS = int(os.getenv("COALESCE_REPLAY_SECONDS", "60"))
+# How long a request waits for an identical one running in another process
+SINGLE_FLIGHT_WAIT_SECONDS = int(os.getenv("SINGLE_FLIGHT_WAIT_SECONDS", "900"))
+
+
+class SingleFlightTimeout(Exception):
+    pass
+
+
+class SingleFlight:
+    """
+    Runs a request once per key; identical requests share its response.
+
+    Within a process, a request whose key is in flight waits on the first
+    one's future. Across processes the run holds a Postgres advisory lock on
+    the key, and the response is stored in IdempotencyRecords so whoever was
+    waiting on the lock (or comes later, until the record expires) gets it
+    instead of running again. Responses with a 5xx status are not stored.
+    """
+
+    def __init__(self):
+        self.logger = get_logger("[SingleFlight]")
+        self._lock = threading.Lock()
+        self._inflight = {}
+
+    def run(self, key, request_hash, fn, replay_seconds):
+        """
+        `fn()` returns (body, status). Returns (body, status, shared), where
+        `shared` tells whether the response comes from another request.
+        """
+        with self._lock:
+            inflight = self._inflight.get(key)
+            if inflight is None:
+                future = Future()
+                self._inflight[key] = (future, request_hash)
+
+        if inflight is not None:
+            future, leader_hash = inflight
+            if leader_hash != request_hash:
+                return self._key_reused(key)
+            self.logger.info(f"[run] Joining in-flight request {key}")
+            body, status, _ = future.result()
+            return body, status, True
+
+        try:
+            result = self._run_once(key, request_hash, fn, replay_seconds)
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+    def _run_once(self, key, request_hash, fn, replay_seconds):
+        record = self._stored(key)
+        if record is None:
+            try:
+                with self._advisory_lock(key):
+                    # Another process may have finished while we waited
+                    record = self._stored(key)
+                    if record is None:
+                        body, status = fn()
+                        if status < 500:
+                            self._store(key, request_hash, body, status, replay_seconds)
+                        return body, status, False
+            except SingleFlightTimeout:
+                return (
+                    {"error": "An identical request is still running, retry later"},
+                    409,
+                    True,
+                )
+
+        if record.request_hash != request_hash:
+            return self._key_reused(key)
+        self.logger.info(f"[_run_once] Replaying stored response for {key}")
+        return json.loads(record.body), record.status_code, True
+
+    def _key_reused(self, key):
+        self.logger.warning(f"[run] {key} was used for a different request")
+        return (
+            {"error": "Idempotency-Key was already used for a different request"},
+            422,
+            False,
+        )
+
+    @contextmanager
+    def _advisory_lock(self, key):
+        if db.engine.dialect.name != "postgresql":
+            yield
+            return
+
+        # Session-level lock on a connection of its own, held for the whole
+        # run; lock_timeout bounds the wait for another process's run
+        lock_id = int.from_bytes(
+            hashlib.sha256(key.encode("utf-8")).digest()[:8], "big", signed=True
+        )
+        with db.engine.connect() as connection:
+            connection.execute(
+                text(f"SET LOCAL lock_timeout = {SINGLE_FLIGHT_WAIT_SECONDS * 1000}")
+            )
+            try:
+                connection.execute(
+                    text("SELECT pg_advisory_lock(:lock_id)"), {"lock_id": lock_id}
+                )
+            except OperationalError as e:
+                connection.rollback()
+                raise SingleFlightTimeout(key) from e
+            connection.commit()
+            try:
+                yield
+            finally:
+                connection.execute(
+                    text("SELECT pg_advisory_unlock(:lock_id)"), {"lock_id": lock_id}
+                )
+                connection.commit()
+
+    def _stored(self, key):
+        return IdempotencyRecords.query.filter(
+            IdempotencyRecords.key == key,
+            IdempotencyRecords.expires_at > datetime.utcnow(),
+        ).first()
+
+    def _store(self, key, request_hash, body, status, replay_seconds):
+        now = datetime.utcnow()
+        try:
+            db.session.execute(
+                delete(IdempotencyRecords).where(IdempotencyRecords.expires_at <= now)
+            )
+            db.session.merge(
+                IdempotencyRecords(
+                    key=key,
+                    request_hash=request_hash,
+                    status_code=status,
+                    body=json.dumps(body),
+                    created_at=now,
+                    expires_at=now + timedelta(seconds=replay_seconds),
+                )
+            )
+            db.session.commit()
+        except Exception as e:
+            # The response is still returned, only not replayable
+            db.session.rollback()
+            self.logger.error(f"[_store] Could not store response for {key}: {e}")
+
+
+single_flight = SingleFlight()
+
+
+def coalesced_response(endpoint, fingerprint, fn):
+    """
+    JSON response of `fn()` -> (body, status), run once for identical requests.
+
+    Requests are identical when they have the same Idempotency-Key header, or
+    without one, the same `fingerprint` (the payload fields that determine
+    the work, e.g. the course id).
+    """
+    request_hash = hashlib.sha256(
+        json.dumps(fingerprint, sort_keys=True, default=str).encode("utf-8")
+    ).hexdigest()
+    idempotency_key = request.headers.get("Idempotency-Key")
+    if idempotency_key:
+        key = f"{endpoint}:key:{idempotency_key}"
+        replay_seconds = IDEMPOTENCY_TTL_SECONDS
+    else:
+        key = f"{endpoint}:{request_hash}"
+        replay_seconds = COALESCE_REPLAY_SECONDS
+
+    body, status, shared = single_flight.run(key, request_hash, fn, replay_seconds)
+    response = jsonify(body)
+    response.status_code = status
+    if shared:
+        response.headers["Idempotent-Replayed"] = "true"
+    return response
@@ -0,0 +1,251 @@
+import os
+import time
+import uuid
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from extensions import get_logger
+from modules.shared.services.concurrency import submit_with_app_context
+
+PENDING = "pending"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+BLOCKED = "blocked"
+
+_stage_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("JOB_STAGE_WORKERS", "8")),
+    thread_name_prefix="job-stage",
+)
+
+
+class Stage:
+    def __init__(self, name, fn, deps):
+        self.name = name
+        self.fn = fn
+        self.deps = tuple(deps)
+        self.status = PENDING
+        self.attempts = 0
+        self.started_at = None
+        self.finished_at = None
+        self.seconds = None
+        self.error = None
+        self.result = None
+
+    def as_dict(self, include_result=False):
+        data = {
+            "name": self.name,
+            "deps": list(self.deps),
+            "status": self.status,
+            "attempts": self.attempts,
+            "started_at": self.started_at.isoformat() if self.started_at else None,
+            "finished_at": self.finished_at.isoformat() if self.finished_at else None,
+            "seconds": self.seconds,
+            "error": self.error,
+        }
+        if include_result:
+            data["result"] = self.result
+        return data
+
+
+class Job:
+    """
+    A graph of stages run on the shared stage pool.
+
+    A stage starts as soon as every stage it depends on has succeeded, and
+    is called with the job, so it can add stages of its own while running
+    (e.g. one per module as modules are generated). A failed stage blocks
+    its dependents until it is retried.
+
+    Progress is also kept as a log of events numbered from 1, for clients
+    that follow a job: the stages' own `emit()` calls, a "stage" event each
+    time a stage finishes and a "done" event each time the job settles.
+    """
+
+    def __init__(self, name, params=None):
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.params = params or {}
+        self.created_at = datetime.utcnow()
+        self.logger = get_logger("[Job]")
+        self._stages = OrderedDict()
+        self._events = []
+        self._condition = threading.Condition()
+
+    def add_stage(self, name, fn, deps=()):
+        with self._condition:
+            if name in self._stages:
+                raise ValueError(f"Stage {name} already exists in job {self.id}")
+            self._stages[name] = Stage(name, fn, deps)
+            ready = self._ready_stages()
+        self._start(ready)
+
+    def retry(self, name):
+        """Run a failed stage again; stages it blocked run once it succeeds."""
+        with self._condition:
+            stage = self._stages.get(name)
+            if stage is None:
+                raise KeyError(name)
+            if stage.status != FAILED:
+                raise ValueError(
+                    f"Stage {name} is {stage.status}, only failed stages can be retried"
+                )
+            stage.status = PENDING
+            stage.error = None
+            for other in self._stages.values():
+                if other.status == BLOCKED:
+                    other.status = PENDING
+            ready = self._ready_stages()
+        self._start(ready)
+
+    def emit(self, event, data):
+        with self._condition:
+            self._events.append((event, data))
+            self._condition.notify_all()
+
+    def events(self, after=0, timeout=None):
+        """
+        Events after the `after`-th as (id, event, data); waits up to
+        `timeout` seconds for one if there is none yet.
+        """
+        with self._condition:
+            if len(self._events) <= after:
+                self._condition.wait(timeout)
+            return [
+                (event_id, event, data)
+                for event_id, (event, data) in enumerate(
+                    self._events[after:], start=after + 1
+                )
+            ]
+
+    def result(self, name):
+        with self._condition:
+            return self._stages[name].result
+
+    def wait(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            while not self._done():
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+            return True
+
+    @property
+    def status(self):
+        with self._condition:
+            return self._status()
+
+    def as_dict(self, include_results=False):
+        with self._condition:
+            return {
+                "job_id": self.id,
+                "name": self.name,
+                "params": self.params,
+                "status": self._status(),
+                "created_at": self.created_at.isoformat(),
+                "stages": [
+                    stage.as_dict(include_results) for stage in self._stages.values()
+                ],
+            }
+
+    def _status(self):
+        statuses = {stage.status for stage in self._stages.values()}
+        if RUNNING in statuses or PENDING in statuses:
+            return RUNNING
+        if FAILED in statuses or BLOCKED in statuses:
+            return FAILED
+        return SUCCEEDED
+
+    def _done(self):
+        return all(
+            stage.status in (SUCCEEDED, FAILED, BLOCKED)
+            for stage in self._stages.values()
+        )
+
+    def _ready_stages(self):
+        # Called with the condition held. Marks the stages that can start as
+        # running and the ones that never can as blocked.
+        ready = []
+        for stage in self._stages.values():
+            if stage.status != PENDING:
+                continue
+            deps = [self._stages.get(dep) for dep in stage.deps]
+            if any(dep is not None and dep.status in (FAILED, BLOCKED) for dep in deps):
+                stage.status = BLOCKED
+            elif all(dep is not None and dep.status == SUCCEEDED for dep in deps):
+                stage.status = RUNNING
+                ready.append(stage)
+        if ready or self._done():
+            self._condition.notify_all()
+        return ready
+
+    def _start(self, stages):
+        for stage in stages:
+            submit_with_app_context(_stage_executor, self._run, stage)
+
+    def _run(self, stage):
+        with self._condition:
+            stage.attempts += 1
+            stage.started_at = datetime.utcnow()
+        started = time.perf_counter()
+        try:
+            result = stage.fn(self)
+            status, error = SUCCEEDED, None
+        except Exception as e:
+            self.logger.error(f"[_run] Job {self.id} stage {stage.name} failed: {e}")
+            result, status, error = None, FAILED, str(e)
+
+        with self._condition:
+            stage.seconds = round(time.perf_counter() - started, 3)
+            stage.finished_at = datetime.utcnow()
+            stage.result = result
+            stage.error = error
+            stage.status = status
+            ready = self._ready_stages()
+            self._events.append(("stage", stage.as_dict()))
+            if self._done():
+                self._events.append(("done", {"status": self._status()}))
+            self._condition.notify_all()
+        self.logger.info(
+            f"[_run] Job {self.id} stage {stage.name} {status} in {stage.seconds}s"
+        )
+        self._start(ready)
+
+
+class JobRegistry:
+    """Recent jobs of this process by id; the oldest finished ones are dropped first."""
+
+    def __init__(self, max_jobs=200):
+        self.max_jobs = max_jobs
+        self._lock = threading.Lock()
+        self._jobs = OrderedDict()
+
+    def add(self, job):
+        with self._lock:
+            self._jobs[job.id] = job
+            if len(self._jobs) > self.max_jobs:
+                for job_id, old in list(self._jobs.items()):
+                    if len(self._jobs) <= self.max_jobs:
+                        break
+                    if old.status != RUNNING:
+                        del self._jobs[job_id]
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def find_running(self, name, params):
+        with self._lock:
+            jobs = list(self._jobs.values())
+        for job in reversed(jobs):
+            if job.name == name and job.params == params and job.status == RUNNING:
+                return job
+        return None
+
+
+job_registry = JobRegistry(max_jobs=int(os.getenv("JOB_REGISTRY_MAX_JOBS", "200")))
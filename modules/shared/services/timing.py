@@ -0,0 +1,40 @@
+import time
+import threading
+from contextlib import contextmanager
+
+
+class StageTimer:
+    """Collects wall-clock durations of named stages, including concurrent ones."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._started = time.perf_counter()
+        self.stages = {}
+
+    @contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - started)
+
+    def timed(self, name, fn):
+        def run(*args, **kwargs):
+            with self.stage(name):
+                return fn(*args, **kwargs)
+
+        return run
+
+    def record(self, name, seconds):
+        with self._lock:
+            self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def as_dict(self):
+        with self._lock:
+            stages = {name: round(s * 1000, 1) for name, s in self.stages.items()}
+        stages["total"] = round((time.perf_counter() - self._started) * 1000, 1)
+        return stages
+
+    def summary(self):
+        return " ".join(f"{name}={ms}ms" for name, ms in self.as_dict().items())
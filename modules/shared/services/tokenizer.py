@@ -0,0 +1,73 @@
+import threading
+
+import tiktoken
+
+from extensions import get_logger
+
+
+# Bedrock does not publish tokenizers for Claude 3 or Nova. cl100k_base is the
+# closest public BPE; the factor corrects for it undercounting those models.
+MODEL_TOKENIZERS = [
+    # (model id prefix, tiktoken encoding, correction factor)
+    ("gpt2", "gpt2", 1.0),
+    ("anthropic.", "cl100k_base", 1.15),
+    ("amazon.nova", "cl100k_base", 1.1),
+    ("amazon.titan", "cl100k_base", 1.1),
+]
+DEFAULT_TOKENIZER = ("cl100k_base", 1.15)
+
+# Rough characters-per-token ratio used when an encoding cannot be loaded.
+FALLBACK_CHARS_PER_TOKEN = 3.5
+
+
+class TokenCounter:
+    def __init__(self, encoding_name, factor=1.0):
+        self.encoding_name = encoding_name
+        self.factor = factor
+        self.logger = get_logger("[TokenCounter]")
+        try:
+            self.encoding = tiktoken.get_encoding(encoding_name)
+        except Exception as e:
+            self.logger.warning(
+                f"Could not load tokenizer '{encoding_name}', estimating from length: {e}"
+            )
+            self.encoding = None
+
+    def count(self, text):
+        if not text:
+            return 0
+        if self.encoding is None:
+            return int(len(text) / FALLBACK_CHARS_PER_TOKEN * self.factor) + 1
+        tokens = len(self.encoding.encode(text, disallowed_special=()))
+        return int(tokens * self.factor + 0.5)
+
+    def truncate(self, text, max_tokens):
+        if not text or self.count(text) <= max_tokens:
+            return text
+        if self.encoding is None:
+            max_chars = int(max_tokens / self.factor * FALLBACK_CHARS_PER_TOKEN)
+            return text[:max_chars]
+        tokens = self.encoding.encode(text, disallowed_special=())
+        return self.encoding.decode(tokens[: int(max_tokens / self.factor)])
+
+
+_counters = {}
+_counters_lock = threading.Lock()
+
+
+def token_counter(model_id=None):
+    encoding_name, factor = DEFAULT_TOKENIZER
+    for prefix, name, model_factor in MODEL_TOKENIZERS:
+        if model_id and model_id.startswith(prefix):
+            encoding_name, factor = name, model_factor
+            break
+
+    with _counters_lock:
+        key = (encoding_name, factor)
+        if key not in _counters:
+            _counters[key] = TokenCounter(encoding_name, factor)
+        return _counters[key]
+
+
+def count_tokens(text, model_id=None):
+    return token_counter(model_id).count(text)
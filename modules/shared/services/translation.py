@@ -1,3 +1,6 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
 import boto3
 from langdetect import detect_langs, DetectorFactory
 from extensions import get_logger
@@ -5,6 +8,12 @@ from extensions import get_logger
 # Ensure consistent language detection
 DetectorFactory.seed = 0
 
+# Shared by all services so concurrent batches stay within Translate limits
+_translation_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("TRANSLATION_WORKERS", "8")),
+    thread_name_prefix="translate",
+)
+
 
 class TranslationService:
     allowed_langs = {"en", "fr", "ar"}
@@ -91,4 +100,13 @@ class TranslationService:
         if not text:
             return {"en": None, "fr": None, "ar": None}
         en, fr, ar = self.translate_to_all_languages(text)
-        return {"en": en, "fr": fr, "ar": ar}
\ No newline at end of file
+        return {"en": en, "fr": fr, "ar": ar}
+
+    def translate_many(self, texts):
+        """
+        Translate a batch of texts concurrently, each distinct text once.
+        Returns a dict from text to its {"en", "fr", "ar"} versions.
+        """
+        unique = list(dict.fromkeys(text for text in texts if text))
+        translated = _translation_executor.map(self._translate_and_assign, unique)
+        return dict(zip(unique, translated))
@@ -0,0 +1,70 @@
+from datetime import datetime
+
+from sqlalchemy import func
+from sqlalchemy.dialects.postgresql import insert
+
+from extensions import db, get_logger
+from modules.document.entity import (
+    DocumentChunks,
+    Documents,
+    GenerationWatermarks,
+    Modules,
+    Paragraphs,
+    Sections,
+)
+
+FLASHCARDS = "flashcards"
+QUESTIONS = "questions"
+
+logger = get_logger("[GenerationWatermarks]")
+
+
+def get_watermark(course_id, kind):
+    """Last source row id already generated from, or None if nothing was."""
+    return (
+        db.session.query(GenerationWatermarks.last_source_id)
+        .filter_by(course_id=course_id, kind=kind)
+        .scalar()
+    )
+
+
+def latest_source_id(course_id, kind):
+    """Id of the newest row of the course that `kind` is generated from."""
+    if kind == FLASHCARDS:
+        query = (
+            db.session.query(func.max(DocumentChunks.id))
+            .join(Documents, DocumentChunks.document_id == Documents.id)
+            .filter(Documents.course_id == course_id)
+        )
+    else:
+        query = (
+            db.session.query(func.max(Paragraphs.id))
+            .join(Sections, Sections.id == Paragraphs.section_id)
+            .join(Modules, Modules.id == Sections.module_id)
+            .filter(Modules.course_id == course_id)
+        )
+    return query.scalar()
+
+
+def set_watermark(course_id, kind, last_source_id):
+    """Record that rows up to `last_source_id` were used. Never moves back."""
+    statement = insert(GenerationWatermarks).values(
+        course_id=course_id,
+        kind=kind,
+        last_source_id=last_source_id,
+        updated_at=datetime.utcnow(),
+    )
+    statement = statement.on_conflict_do_update(
+        index_elements=[GenerationWatermarks.course_id, GenerationWatermarks.kind],
+        set_={
+            "last_source_id": func.greatest(
+                GenerationWatermarks.last_source_id, statement.excluded.last_source_id
+            ),
+            "updated_at": statement.excluded.updated_at,
+        },
+    )
+    db.session.execute(statement)
+    db.session.commit()
+    logger.info(
+        f"[set_watermark] Course {course_id} {kind} watermark at {last_source_id}"
+    )
@@ -0,0 +1,110 @@
+"""AsyncBedrockService against the local Bedrock stub of benchmarks/bedrock_stub.py."""
+
+import asyncio
+
+import pytest
+from aiohttp.test_utils import TestServer
+
+from benchmarks.bedrock_stub import EMBEDDING_DIMENSION, BedrockStub
+from modules.shared.services.bedrock_async import AsyncBedrockService
+from modules.shared.services.bedrock_scheduler import INTERACTIVE, bedrock_scheduler
+
+STREAM_MODEL = "anthropic.claude-3-5-sonnet-20240620-v1:0"
+# Only used here, so its scheduler lane starts empty with the limit below
+LIMITED_MODEL = "anthropic.stub-limited-v1:0"
+
+
+@pytest.fixture(autouse=True)
+def credentials(monkeypatch):
+    # Requests are signed, the stub does not check them
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "stub")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "stub")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+
+
+def run_against_stub(scenario, **stub_options):
+    """Run `scenario(service, stub)` with a service pointed at a fresh stub."""
+    stub_options = {
+        "latency": 0.01,
+        "chunks": 5,
+        "chunk_interval": 0.01,
+        **stub_options,
+    }
+    stub = BedrockStub(**stub_options)
+
+    async def main():
+        server = TestServer(stub.app())
+        await server.start_server()
+        service = AsyncBedrockService(
+            priority=INTERACTIVE, endpoint_url=str(server.make_url(""))
+        )
+        try:
+            return await scenario(service, stub)
+        finally:
+            await service.close()
+            await server.close()
+
+    return asyncio.run(main())
+
+
+def test_streamed_answer():
+    async def scenario(service, stub):
+        return [text async for text in service.stream_text("hi", model_id=STREAM_MODEL)]
+
+    chunks = run_against_stub(scenario)
+
+    assert "".join(chunks) == "token0 token1 token2 token3 token4 "
+
+
+def test_embedding():
+    async def scenario(service, stub):
+        return await service.generate_embedding("hello")
+
+    embedding = run_against_stub(scenario)
+
+    assert len(embedding) == EMBEDDING_DIMENSION
+
+
+def test_converse():
+    async def scenario(service, stub):
+        return await service.invoke_model_with_texttt(
+            "hi", model_id="amazon.nova-pro-v1:0"
+        )
+
+    assert run_against_stub(scenario) == "stub answer"
+
+
+def test_cancelled_stream_frees_its_slot(monkeypatch):
+    monkeypatch.setitem(
+        bedrock_scheduler.model_limits, LIMITED_MODEL, {"concurrency": 1}
+    )
+
+    async def scenario(service, stub):
+        first_chunk = asyncio.Event()
+
+        async def read():
+            async for _ in service.stream_text("hi", model_id=LIMITED_MODEL):
+                first_chunk.set()
+
+        reader = asyncio.create_task(read())
+        await asyncio.wait_for(first_chunk.wait(), timeout=5)
+        in_flight = bedrock_scheduler.metrics()["models"][LIMITED_MODEL]["in_flight"]
+        reader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await reader
+
+        # With its only slot back, the next stream of the model gets through
+        after = bedrock_scheduler.metrics()["models"][LIMITED_MODEL]["in_flight"]
+        chunks = await asyncio.wait_for(
+            _collect(service.stream_text("hi", model_id=LIMITED_MODEL)), timeout=5
+        )
+        return in_flight, after, chunks
+
+    in_flight, after, chunks = run_against_stub(scenario, chunks=50)
+
+    assert (in_flight, after) == (1, 0)
+    assert len(chunks) == 50
+
+
+async def _collect(stream):
+    return [text async for text in stream]